@@ -1,4 +1,4 @@
-import ctypes, struct, time, math
+import sys, ctypes, struct, time, math
 
 from pycca.asm import *
 
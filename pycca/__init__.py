@@ -1,5 +1,13 @@
 # -*- coding: utf-8 -*-
 __version__ = '0.2.0'
 
-from . import asm, cc
+from . import asm
+
+
+def __getattr__(name):
+    # pycca.cc needs most of pycca.asm, so it is imported on first use
+    if name == 'cc':
+        import importlib
+        return importlib.import_module('.cc', __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
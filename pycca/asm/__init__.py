@@ -52,9 +52,99 @@ else:
     
 ARCH = 32  # PyVM only supports 32-bit code
 
-from .instructions import *
-from .register import *
-from .pointer import byte, word, dword, qword
-from .codepage import CodePage
+# Names exported by the package are imported on first use (PEP 562), so that
+# ``import pycca.asm`` does not build every instruction class or load the
+# memory and caching machinery. These few can be imported on their own:
+_single_exports = {
+    'byte': 'pointer',
+    'word': 'pointer',
+    'dword': 'pointer',
+    'qword': 'pointer',
+    'CodePage': 'codepage',
+    'mkfunction': 'codepage',
+}
+
+# The others are collected by _all_exports() when one of them is first used.
+_exports = None
+
+# Submodules that may be accessed as attributes before they are imported
+_submodules = frozenset([
+    'benchmark', 'cache', 'code', 'codepage', 'incremental', 'instruction',
+    'instructions', 'instructions_new', 'instrument', 'label', 'linker',
+    'memory', 'modrm', 'module', 'parser', 'pointer', 'register', 'util',
+])
+
+# Importing the submodule pycca.asm.label sets the package attribute of the
+# same name, so this function is bound before that can happen.
 from .label import label
-from .util import *
+
+
+def _import(module):
+    # __import__, unlike importlib, shows up in ``python -X importtime``
+    name = '%s.%s' % (__name__, module)
+    __import__(name)
+    return sys.modules[name]
+
+
+def _public(module):
+    """Return the public names defined by *module*: those in its 
+    ``__all__``, or else all names that are not private, modules or the
+    ``long`` compatibility alias.
+    """
+    names = getattr(module, '__all__', None)
+    if names is not None:
+        return {name: getattr(module, name) for name in names}
+    return {name: value for name, value in vars(module).items()
+            if not name.startswith('_') and name != 'long'
+            and not isinstance(value, type(sys))}
+
+
+def _all_exports():
+    """Return a dict of the names exported by the package other than those
+    in _single_exports: every instruction class in instructions.py (and its
+    aliases from :data:`parser.mnemonic_aliases 
+    <pycca.asm.parser.mnemonic_aliases>`), the registers, the helpers in 
+    util.py and :func:`label`.
+    """
+    global _exports
+    if _exports is None:
+        import keyword
+        instructions = _import('instructions')
+        parser = _import('parser')
+        exports = {name: cls for name, cls in vars(instructions).items()
+                   if isinstance(cls, type) and issubclass(cls, instructions.Instruction)}
+        mnemonics = parser.get_mnemonics()
+        for alias, name in parser.mnemonic_aliases.items():
+            if name in mnemonics and alias.isidentifier() and not keyword.iskeyword(alias):
+                exports.setdefault(alias, mnemonics[name])
+        exports.update(_public(_import('register')))
+        exports.update(_public(_import('util')))
+        exports['label'] = label
+        for name in _single_exports:
+            exports.pop(name, None)
+        _exports = exports
+    return _exports
+
+
+def __getattr__(name):
+    module = _single_exports.get(name)
+    if module is not None:
+        value = getattr(_import(module), name)
+    elif name in _submodules:
+        # importing a submodule binds it here
+        return _import(name)
+    elif name == '__all__':
+        value = sorted(set(_all_exports()) | set(_single_exports))
+    elif name.startswith('_'):
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    else:
+        try:
+            value = _all_exports()[name]
+        except KeyError:
+            raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_all_exports()) | set(_single_exports))
@@ -0,0 +1,558 @@
+# -'- coding: utf-8 -'-
+"""
+Benchmarks for the stages of the assembler pipeline.
+
+Synthetic listings of several kinds are assembled and each stage is timed
+separately:
+
+    parse    splitting lines, parsing operands and creating instructions
+    encode   generating machine code for every instruction
+    layout   relaxing branches and writing the code into one image
+    resolve  applying relocations
+
+Results can be saved as JSON and compared with an earlier run::
+
+    python -m pycca.asm.benchmark --sizes 1000 100000 -o new.json --compare old.json
+
+Micro-benchmarks (see :data:`MICRO`) time single steps of a stage against
+the way they used to be done::
+
+    python -m pycca.asm.benchmark --micro
+"""
+
+import re, sys, json, time, struct, platform, argparse, tracemalloc
+
+from .. import __version__
+from . import ARCH, pointer, parser
+from .instruction import Instruction, Label, OpcodeDescriptor, encoding_cache
+from .parser import _eval_ns, _split_lines, _parse_statement
+from .codepage import CodePage, CodePageBuilder
+from .code import Relocation, _numpy
+
+STAGES = ('parse', 'encode', 'layout', 'resolve')
+SIZES = (10**3, 10**4, 10**5, 10**6)
+
+
+#   Source generators
+# ----------------------------------------
+
+def _generate(make, n):
+    return '\n'.join(make[i % len(make)](i) for i in range(n))
+
+
+def alu_source(n):
+    """Return *n* lines of register and immediate arithmetic.
+    """
+    return _generate([
+        lambda i: 'l%d:' % i,
+        lambda i: '    mov eax, %d' % i,
+        lambda i: '    add ecx, eax',
+        lambda i: '    sub edx, %d' % (i & 0xff),
+        lambda i: '    imul eax, ebx',
+        lambda i: '    xor esi, edi',
+        lambda i: '    and eax, 0x%x' % (i * 2654435761 & 0xffffff),
+        lambda i: '    or edx, 1',
+        lambda i: '    cmp eax, ecx',
+        lambda i: '    inc ebx',
+        lambda i: '    neg edi',
+        lambda i: '    test eax, eax',
+    ], n)
+
+
+def branch_source(n):
+    """Return *n* lines in which most instructions jump to or call a label,
+    some near and some far away.
+    """
+    return _generate([
+        lambda i: 'b%d:' % i,
+        lambda i: '    cmp eax, %d' % (i & 0x7f),
+        lambda i: '    jz b%d' % (i - 2),
+        lambda i: '    jne b%d' % max(i - 3 - 296, 0),
+        lambda i: '    call b%d' % (i // 2 // 8 * 8),
+        lambda i: '    jl b%d' % (i - 5),
+        lambda i: '    jmp b%d' % (i - 6),
+        lambda i: '    ret',
+    ], n)
+
+
+def memory_source(n):
+    """Return *n* lines of instructions with memory operands in all
+    addressing forms.
+    """
+    return _generate([
+        lambda i: 'm%d:' % i,
+        lambda i: '    mov eax, dword ptr [ebp + %d]' % (i % 128),
+        lambda i: '    mov dword ptr [ebx + 4*ecx + %d], edx' % (i % 4096),
+        lambda i: '    lea esi, [edi + 2*eax + 0x10]',
+        lambda i: '    add eax, dword ptr [esi]',
+        lambda i: '    sub dword ptr [esp + 8*edx], %d' % (i & 0x7f),
+        lambda i: '    movzx ecx, byte ptr [eax + %d]' % (i % 300),
+        lambda i: '    mov eax, dword ptr [m%d]' % (i - 7),
+        lambda i: '    cmp dword ptr [ebp - %d], 0' % (4 + i % 64),
+    ], n)
+
+
+def data_source(n):
+    """Return *n* lines made up mostly of data directives.
+    """
+    return _generate([
+        lambda i: 'd%d:' % i,
+        lambda i: '    .long %d, %d, %d' % (i, i * 3, i * 7),
+        lambda i: '    .ascii "item %d"' % i,
+        lambda i: '    .asciz "name_%d"' % i,
+        lambda i: '    .long d%d' % (i - 4),
+        lambda i: '    mov eax, d%d' % (i - 5),
+    ], n)
+
+
+GENERATORS = {
+    'alu': alu_source,
+    'branch': branch_source,
+    'memory': memory_source,
+    'data': data_source,
+}
+
+
+#   Running
+# ----------------------------------------
+
+def _parse(source):
+    """Return the labels and code objects in *source*, without encoding any
+    instructions.
+    """
+    eval_ns = _eval_ns.copy()
+    items = []
+    for item in list(_split_lines(source.split('\n'), eval_ns)):
+        if not isinstance(item, Label):
+            item = _parse_statement(item, eval_ns, encode=False)
+        items.append(item)
+    return items
+
+
+def _pipeline(source, times=None):
+    """Assemble *source* one stage at a time, adding the time taken by each
+    stage to the *times* dict. Returns (number of instructions, code size).
+    """
+    if times is None:
+        times = dict.fromkeys(STAGES, 0.0)
+    encoding_cache.clear()
+
+    start = time.perf_counter()
+    items = _parse(source)
+    t = time.perf_counter()
+    times['parse'] += t - start
+
+    start = t
+    count = 0
+    for item in items:
+        if not isinstance(item, (Label, bytes)):
+            item.code
+            count += 1
+    t = time.perf_counter()
+    times['encode'] += t - start
+
+    start = t
+    CodePage.relax_branches(items)
+    size = sum(len(item) for item in items if not isinstance(item, Label))
+    builder = CodePageBuilder(size)
+    builder.extend(items)
+    t = time.perf_counter()
+    times['layout'] += t - start
+
+    start = t
+    builder.link(0)
+    times['resolve'] += time.perf_counter() - start
+    return count, size
+
+
+def run(kind, lines, repeat=1, memory=True):
+    """Benchmark assembling *lines* lines of the given *kind* of source (see
+    :data:`GENERATORS`).
+
+    Instructions and data directives are both counted as instructions. Each
+    stage's time is the best of *repeat* runs. If *memory* is True, the
+    pipeline is run once more under :mod:`tracemalloc` to measure peak memory
+    use. Returns a dict of results.
+    """
+    source = GENERATORS[kind](lines)
+    best = None
+    for i in range(repeat):
+        times = dict.fromkeys(STAGES, 0.0)
+        count, size = _pipeline(source, times)
+        if best is None:
+            best = times
+        else:
+            best = {stage: min(best[stage], times[stage]) for stage in STAGES}
+
+    total = sum(best.values())
+    result = {
+        'kind': kind,
+        'lines': lines,
+        'instructions': count,
+        'bytes': size,
+        'times': best,
+        'total': total,
+        'rates': {stage: count / best[stage] if best[stage] else None for stage in STAGES},
+        'rate': count / total if total else None,
+        'peak_memory': None,
+    }
+
+    if memory:
+        tracemalloc.start()
+        try:
+            _pipeline(source)
+            result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def run_suite(kinds=None, sizes=SIZES, repeat=1, memory=True, log=None):
+    """Run :func:`run` for every combination of *kinds* (by default, all
+    generators) and *sizes*. If *log* is a file, each result is written to it
+    as it is produced.
+
+    Returns a dict holding the results and a description of the environment,
+    which may be passed to :func:`save_results`.
+    """
+    if kinds is None:
+        kinds = list(GENERATORS)
+    results = []
+    for kind in kinds:
+        for lines in sizes:
+            result = run(kind, lines, repeat=repeat, memory=memory)
+            results.append(result)
+            if log is not None:
+                log.write(format_results([result], header=not results[:-1]))
+                log.flush()
+    return {
+        'pycca': __version__,
+        'arch': ARCH,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+
+#   Micro-benchmarks
+# ----------------------------------------
+#
+# Each returns a list of (name, seconds, count, unit) rows, after checking
+# that the variants it times produce the same output.
+
+def best_time(fn, repeat=3):
+    """Return the best wall time of *repeat* calls to *fn*.
+    """
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        dt = time.perf_counter() - start
+        best = dt if best is None else min(best, dt)
+    return best
+
+
+def _check(ok, name):
+    if not ok:
+        raise RuntimeError("Benchmark %r: variants produced different results." % name)
+
+
+def _encoded(instrs):
+    # instructions that refer to labels are encoded as Code objects
+    return [getattr(code, 'code', code) for code in (i.code for i in instrs)]
+
+
+def _instructions(kind, lines):
+    return [item for item in _parse(GENERATORS[kind](lines)) 
+            if isinstance(item, Instruction)]
+
+
+def micro_descriptors(lines=4000, kind='memory'):
+    """Encode instructions with their pre-parsed opcode descriptors, and
+    parsing the mode strings for every instruction as was done before.
+    """
+    instrs = _instructions(kind, lines)
+    expected = _encoded(instrs)
+
+    def encode():
+        for instr in instrs:
+            instr._invalidate()
+            instr.generate_code()
+
+    def encode_reparsing():
+        for instr in instrs:
+            instr._invalidate()
+            OpcodeDescriptor(instr.use_sig, instr.mode, instr.operand_enc)
+            instr.generate_code()
+
+    t_pre = best_time(encode)
+    _check(_encoded(instrs) == expected, 'descriptors')
+    t_parse = best_time(encode_reparsing)
+    return [('encode (pre-parsed descriptors)', t_pre, len(instrs), 'instr'),
+            ('encode (parsing mode strings)', t_parse, len(instrs), 'instr')]
+
+
+def micro_encoding_cache(lines=4000, kind='memory'):
+    """Parse and encode a listing with and without the encoding cache.
+    """
+    source = GENERATORS[kind](lines)
+
+    def encode():
+        return _encoded(i for i in _parse(source) if isinstance(i, Instruction))
+
+    expected = encode()
+    try:
+        encoding_cache.enabled = False
+        t_nocache = best_time(encode)
+    finally:
+        encoding_cache.enabled = True
+    encoding_cache.clear()
+    t_cache = best_time(encode)
+    _check(encode() == expected, 'encoding_cache')
+    count = len(expected)
+    return [('parse + encode (no cache)', t_nocache, count, 'instr'),
+            ('parse + encode (cached)', t_cache, count, 'instr')]
+
+
+def _operands(source):
+    """Return the operand strings of all statements in *source*, and a
+    namespace defining its labels.
+    """
+    ns = dict(_eval_ns)
+    operands = []
+    for item in _split_lines(source.split('\n'), ns):
+        if isinstance(item, Label):
+            continue
+        ops = parser._statement_re.match(item[1]).group(2)
+        if ops is not None and not item[1].startswith('.'):
+            operands.extend(op.strip() for op in ops.split(','))
+    return operands, ns
+
+
+def micro_operands(lines=4000, kind='memory'):
+    """Parse operands with :func:`parser.parse_operand`, and as the former
+    parser did: a regex for the size prefix, then eval().
+    """
+    ops, ns = _operands(GENERATORS[kind](lines))
+
+    def parse_eval():
+        out = []
+        for op in ops:
+            _, ptype, op = re.match(r'((byte|word|dword|qword)\s+ptr )?(.*)', op).groups()
+            arg = eval(op, {'__builtins__': {}}, ns)
+            if ptype is not None:
+                arg = getattr(pointer, ptype)(arg)
+            out.append(arg)
+        return out
+
+    def parse():
+        return [parser.parse_operand(op, ns) for op in ops]
+
+    for a, b in zip(parse_eval(), parse()):
+        if isinstance(a, list):
+            a = pointer.Pointer(a)
+        _check(a == b and type(a) is type(b) and 
+               getattr(a, 'bits', None) == getattr(b, 'bits', None), 'operands')
+    return [('operands (eval)', best_time(parse_eval), len(ops), 'op'),
+            ('operands (parse_operand)', best_time(parse), len(ops), 'op')]
+
+
+def micro_parse_lines(lines=100000, kind='memory'):
+    """Break the time taken by :func:`parser.parse_asm` down into its steps.
+    """
+    source = GENERATORS[kind](lines)
+    
+    def split():
+        return list(_split_lines(source.split('\n'), dict(_eval_ns)))
+
+    statements = [s for s in split() if not isinstance(s, Label)]
+    mnemonics = parser.get_mnemonics()
+
+    def classify():
+        for lineno, line, origline in statements:
+            mnemonics[parser._statement_re.match(line).group(1)]
+
+    ops, ns = _operands(source)
+
+    def parse_operands():
+        for op in ops:
+            parser.parse_operand(op, ns)
+
+    def parse():
+        return parser.parse_asm(source)
+
+    _check(len(parse()) == len(split()), 'parse_lines')
+    return [(name, best_time(fn, repeat=1), lines, 'line')
+            for name, fn in [('split lines / labels', split),
+                             ('classify + mnemonic lookup', classify),
+                             ('parse operands', parse_operands),
+                             ('parse_asm (total)', parse)]]
+
+
+def micro_rebase(relocations=1000000):
+    """Link, then rebase, an image made up of absolute references (like a
+    jump table), with and without NumPy.
+    """
+    n = relocations
+    builder = CodePageBuilder(4 * n)
+    builder.size = 4 * n
+    builder.labels = {'table': 0, 'end': 4 * n}
+    builder.relocations = [Relocation(4*i, 'I', 'abs', 'end' if i & 1 else 'table', i)
+                           for i in range(n)]
+
+    t_link = best_time(lambda: builder.link(0x1000), repeat=1)
+    builder.rebase_table()
+    rows = [('link', t_link, n, 'reloc')]
+    results = set()
+    for use_numpy in [False, True] if _numpy() is not None else [False]:
+        bases = iter(range(0x10000, 0x100000, 0x10000))
+        t = best_time(lambda: builder.rebase(next(bases), use_numpy=use_numpy))
+        rows.append(('rebase (%s)' % ('numpy' if use_numpy else 'python'), t, n, 'reloc'))
+        results.add(builder.rebase(0x2000000, use_numpy=use_numpy))
+    image = results.pop()
+    _check(not results and struct.unpack_from('4I', image, 0) == 
+           (0x2000000, 0x2000000 + 4*n + 1, 0x2000002, 0x2000000 + 4*n + 3), 'rebase')
+    return rows
+
+
+MICRO = {
+    'descriptors': micro_descriptors,
+    'encoding_cache': micro_encoding_cache,
+    'operands': micro_operands,
+    'parse_lines': micro_parse_lines,
+    'rebase': micro_rebase,
+}
+
+
+def run_micro(names=None, log=None):
+    """Run the micro-benchmarks in *names* (by default, all of :data:`MICRO`)
+    and return a dict mapping each name to its rows. If *log* is a file,
+    each result is written to it as it is produced.
+    """
+    results = {}
+    for name in names or MICRO:
+        results[name] = MICRO[name]()
+        if log is not None:
+            log.write(format_micro(results[name]))
+            log.flush()
+    return results
+
+
+#   Reporting
+# ----------------------------------------
+
+def save_results(suite, path):
+    with open(path, 'w') as fh:
+        json.dump(suite, fh, indent=1)
+
+
+def load_results(path):
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def format_results(results, header=True):
+    """Return a text table of *results* (a list of dicts from :func:`run`).
+    """
+    lines = []
+    if header:
+        lines.append('%-8s %8s %9s' % ('kind', 'lines', 'instr/s') +
+                     ''.join(' %9s' % stage for stage in STAGES) + ' %10s' % 'peak')
+    for r in results:
+        row = '%-8s %8d %9s' % (r['kind'], r['lines'], _rate(r['rate']))
+        row += ''.join(' %8.3fs' % r['times'][stage] for stage in STAGES)
+        peak = r['peak_memory']
+        row += ' %9s' % ('-' if peak is None else '%.1fM' % (peak / 2**20))
+        lines.append(row)
+    return '\n'.join(lines) + '\n'
+
+
+def format_micro(rows):
+    """Return a text table of the rows returned by a micro-benchmark.
+    """
+    return ''.join('%-40s %8.2f us/%s\n' % (name, 1e6 * seconds / count, unit)
+                   for name, seconds, count, unit in rows)
+
+
+def _rate(rate):
+    if rate is None:
+        return '-'
+    if rate >= 1e6:
+        return '%.2fM' % (rate / 1e6)
+    return '%.1fk' % (rate / 1e3)
+
+
+def compare(old, new):
+    """Compare two suites returned by :func:`run_suite` (or loaded with
+    :func:`load_results`).
+
+    Returns a list of ``(kind, lines, stage, old time, new time, ratio)`` for
+    each stage (and ``'total'``) of every benchmark present in both. A ratio
+    above 1 means *new* is slower.
+    """
+    previous = {(r['kind'], r['lines']): r for r in old['results']}
+    rows = []
+    for r in new['results']:
+        o = previous.get((r['kind'], r['lines']))
+        if o is None:
+            continue
+        for stage in STAGES + ('total',):
+            t_old = o['total'] if stage == 'total' else o['times'][stage]
+            t_new = r['total'] if stage == 'total' else r['times'][stage]
+            ratio = t_new / t_old if t_old else None
+            rows.append((r['kind'], r['lines'], stage, t_old, t_new, ratio))
+    return rows
+
+
+def format_comparison(rows, threshold=0.1):
+    """Return a text table of the rows returned by :func:`compare`. Changes
+    larger than *threshold* (as a fraction) are flagged.
+    """
+    lines = ['%-8s %8s %-8s %10s %10s %8s' % ('kind', 'lines', 'stage', 'old', 'new', 'change')]
+    for kind, n, stage, t_old, t_new, ratio in rows:
+        if ratio is None:
+            change = flag = ''
+        else:
+            change = '%+.1f%%' % (100 * (ratio - 1))
+            flag = ''
+            if ratio > 1 + threshold:
+                flag = '  slower'
+            elif ratio < 1 - threshold:
+                flag = '  faster'
+        lines.append('%-8s %8d %-8s %9.4fs %9.4fs %8s%s' % (kind, n, stage, t_old, t_new,
+                                                         change, flag))
+    return '\n'.join(lines) + '\n'
+
+
+def main(argv=None):
+    cli = argparse.ArgumentParser(prog='python -m pycca.asm.benchmark',
+                                     description='Benchmark the stages of the pycca assembler.')
+    cli.add_argument('--kinds', nargs='+', choices=sorted(GENERATORS),
+                        help='kinds of source to assemble (default: all)')
+    cli.add_argument('--sizes', nargs='+', type=int, default=list(SIZES),
+                        help='numbers of lines (default: %(default)s)')
+    cli.add_argument('--repeat', type=int, default=1,
+                        help='report the best of this many runs')
+    cli.add_argument('--no-memory', action='store_true',
+                        help='do not measure peak memory use')
+    cli.add_argument('-o', '--output', help='write results to this JSON file')
+    cli.add_argument('--compare', metavar='JSON',
+                        help='compare with results saved by an earlier run')
+    cli.add_argument('--micro', nargs='*', choices=sorted(MICRO), metavar='NAME',
+                        help='run these micro-benchmarks (default: all) instead')
+    args = cli.parse_args(argv)
+
+    if args.micro is not None:
+        return run_micro(args.micro, log=sys.stdout)
+    suite = run_suite(kinds=args.kinds, sizes=args.sizes, repeat=args.repeat,
+                      memory=not args.no_memory, log=sys.stdout)
+    if args.output:
+        save_results(suite, args.output)
+    if args.compare:
+        print()
+        sys.stdout.write(format_comparison(compare(load_results(args.compare), suite)))
+    return suite
+
+
+if __name__ == '__main__':
+    main()
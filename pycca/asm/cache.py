@@ -0,0 +1,185 @@
+# -'- coding: utf-8 -'-
+"""
+On-disk cache of assembled code.
+
+Assembling the same source again yields the same image, labels and
+relocations, so these can be stored in a cache directory (much like
+``__pycache__``) and reused by later processes without parsing or encoding
+anything. See the *cache* argument to :class:`CodePage`.
+"""
+
+import os, hashlib, tempfile
+
+from .. import __version__
+from . import ARCH
+from .module import dump_module, load_module
+from .register import Register
+from .pointer import Pointer
+from .label import Label
+
+# Increment when the layout of cache entries changes
+CACHE_FORMAT = 3
+
+
+def _stable_repr(value):
+    """Return a string that identifies *value* in any process, or raise 
+    TypeError if it has none (the repr of most objects includes their 
+    address).
+    """
+    if value is None or isinstance(value, (bool, int, float, str, bytes)):
+        return '%s:%r' % (type(value).__name__, value)
+    if isinstance(value, Register):
+        return 'Register(%r, %r, %r)' % (value._val, value._name, value._bits)
+    if isinstance(value, Pointer):
+        return 'Pointer(%s)' % ', '.join(_stable_repr(getattr(value, attr)) 
+                                         for attr in Pointer.__slots__)
+    if isinstance(value, Label):
+        return 'Label(%r)' % value.name
+    if isinstance(value, (tuple, list)):
+        return '%s(%s)' % (type(value).__name__, ', '.join(map(_stable_repr, value)))
+    raise TypeError("%s values cannot be cached" % type(value).__name__)
+
+
+class AssemblyCache(object):
+    """A directory of assembled images, keyed by a hash of the assembly
+    source and everything else that affects its output.
+
+    Entries are stored as module files (see :mod:`pycca.asm.module`) and
+    written atomically, so several processes may share one directory. Once
+    the entries take more than *max_size* bytes, the least recently used 
+    ones are removed.
+    """
+    suffix = '.pyccache'
+
+    def __init__(self, path, max_size=64*1024*1024):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def key(source, namespace=None, **options):
+        """Return the cache key for assembling *source* with *namespace* and
+        any other *options* that affect the output (such as ``relax``).
+
+        The key also covers the pycca version, ARCH and cache format.
+        Namespace values may be numbers, strings, registers, pointers, labels
+        and tuples or lists of these. If the namespace holds anything else,
+        which could not be recognized by another process, None is returned
+        and the source should not be cached.
+        """
+        h = hashlib.sha256()
+        header = (__version__, ARCH, CACHE_FORMAT, sorted(options.items()))
+        h.update(repr(header).encode())
+        h.update(b'\0')
+        h.update(source.encode())
+        if namespace:
+            try:
+                values = [(name, _stable_repr(value)) for name, value in namespace.items()]
+            except TypeError:
+                return None
+            h.update(b'\0')
+            h.update(repr(sorted(values)).encode())
+        return h.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + self.suffix)
+
+    def get(self, key, lines=False):
+        """Return ``(image, labels, relocations)`` for *key*, or None if it is
+        not cached. If *lines* is True, the entry's line table is returned as
+        a fourth item.
+        """
+        fname = self._file(key)
+        try:
+            with load_module(fname) as module:
+                image = bytes(module.code)
+                labels = module.labels
+                relocations = module.relocations
+                line_table = module.lines if lines else None
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception:
+            # truncated or stale entry; treat as a miss
+            self.misses += 1
+            self._remove(fname)
+            return None
+
+        # mark as recently used
+        try:
+            os.utime(fname)
+        except OSError:
+            pass
+
+        self.hits += 1
+        if lines:
+            return image, labels, relocations, line_table
+        return image, labels, relocations
+
+    def put(self, key, image, labels, relocations, lines=None):
+        """Store an assembled image under *key*, with an optional line table
+        of (code offset, line number) pairs.
+        """
+        data = dump_module(image, labels, relocations, lines=lines)
+
+        # write to a temporary file, then atomically move it into place
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(data)
+            os.replace(tmp, self._file(key))
+        except BaseException:
+            self._remove(tmp)
+            raise
+        self.evict()
+
+    def entries(self):
+        """Return a list of (mtime, size, path) for all cache entries, oldest
+        first.
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(self.suffix):
+                continue
+            fname = os.path.join(self.path, name)
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fname))
+        entries.sort()
+        return entries
+
+    def size(self):
+        """Total size in bytes of all cache entries.
+        """
+        return sum(e[1] for e in self.entries())
+
+    def evict(self, max_size=None):
+        """Remove the least recently used entries until the cache holds no
+        more than *max_size* bytes (by default, the cache's *max_size*).
+        Returns the number of entries removed.
+        """
+        max_size = self.max_size if max_size is None else max_size
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        removed = 0
+        for mtime, size, fname in entries:
+            if total <= max_size:
+                break
+            self._remove(fname)
+            total -= size
+            removed += 1
+        return removed
+
+    def clear(self):
+        self.evict(0)
+
+    @staticmethod
+    def _remove(fname):
+        try:
+            os.remove(fname)
+        except OSError:
+            pass
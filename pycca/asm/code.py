@@ -1,5 +1,189 @@
 import struct
 
+# numpy is optional and slow to import, so it is only imported once a table
+# large enough to need it is packed; see _numpy().
+_numpy_module = False
+
+
+# Code objects for 'expr' relocations, compiled once per distinct expression
+_expr_cache = {}
+
+# Below this many values, scatter_pack does not bother with numpy
+SCATTER_MIN = 64
+
+
+def _numpy():
+    """Return the numpy module, importing it on first use, or None if it is
+    not installed.
+    """
+    global _numpy_module
+    if _numpy_module is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy_module = numpy
+    return _numpy_module
+
+
+def __getattr__(name):
+    # ``code.numpy`` is imported lazily
+    if name == 'numpy':
+        return _numpy()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def scatter_pack(buf, packing, offsets, values, base=0, use_numpy=None):
+    """For every i, pack ``base + values[i]`` with the struct format *packing*
+    and write it at ``offsets[i]`` in *buf* (a bytearray).
+    
+    *offsets* and *values* may be lists or (if numpy is available) integer
+    arrays. Large tables are written with a single numpy scatter unless 
+    *use_numpy* is False; otherwise this falls back to ``struct.pack_into``.
+    Out-of-range values raise ``struct.error`` either way.
+    """
+    if len(offsets) == 0:
+        return
+    if use_numpy is None:
+        use_numpy = len(offsets) >= SCATTER_MIN and _numpy() is not None
+    if use_numpy:
+        numpy = _numpy()
+        values = numpy.asarray(values, dtype=numpy.int64)
+        lo = base + int(values.min())
+        hi = base + int(values.max())
+        # beyond int64, leave it to struct
+        use_numpy = -2**63 <= lo and hi < 2**63
+    
+    if not use_numpy:
+        # iterating over numpy scalars is slow
+        if hasattr(offsets, 'tolist'):
+            offsets = offsets.tolist()
+        if hasattr(values, 'tolist'):
+            values = values.tolist()
+        pack_into = struct.pack_into
+        for offset, value in zip(offsets, values):
+            pack_into(packing, buf, offset, base + value)
+        return
+    
+    size = struct.calcsize(packing)
+    kind = 'i' if packing.islower() else 'u'
+    dtype = numpy.dtype('<%s%d' % (kind, size))
+    offsets = numpy.asarray(offsets, dtype=numpy.intp)
+    
+    # check range like struct.pack would
+    info = numpy.iinfo(dtype)
+    if lo < info.min or hi > info.max:
+        raise struct.error("relocation value out of range for format '%s'" % packing)
+    
+    packed = (values + base).astype(dtype)
+    if not (offsets % size).any():
+        # all aligned: scatter whole words
+        view = numpy.frombuffer(buf, dtype=dtype, count=len(buf) // size)
+        view[offsets // size] = packed
+    else:
+        view = numpy.frombuffer(buf, dtype=numpy.uint8)
+        view[offsets[:, None] + numpy.arange(size)] = packed.view(numpy.uint8).reshape(-1, size)
+
+
+class Relocation(object):
+    """A value to be written into machine code once symbol addresses are known.
+    
+    *kind* determines how the value is computed from the program's symbols:
+    
+    * ``'abs'``: address of *symbol* plus *addend*
+    * ``'rel'``: address of *symbol* plus *addend*, relative to the address of
+      the next instruction (``next_instr_addr``)
+    * ``'expr'``: *symbol* is an arbitrary python expression that is evaluated
+      using the program's symbols as local variables
+      
+    The value is packed with the struct format *packing* and written at
+    *offset*.
+    
+    Within a :class:`Code` object, *offset* is relative to the start of that
+    code. Relocations returned by :meth:`placed` instead describe a location
+    in a complete image, and also record the image offsets of the start 
+    (*instr*) and end (*end*) of the instruction they belong to.
+    """
+    __slots__ = ('offset', 'packing', 'kind', 'symbol', 'addend', 'instr', 'end')
+    
+    ABS = 'abs'
+    REL = 'rel'
+    EXPR = 'expr'
+    
+    def __init__(self, offset: int, packing: str, kind: str, symbol: str, addend: int=0):
+        if kind not in (self.ABS, self.REL, self.EXPR):
+            raise ValueError("Invalid relocation kind %r" % kind)
+        self.offset = offset
+        self.packing = packing
+        self.kind = kind
+        self.symbol = symbol
+        self.addend = addend
+        self.instr = None
+        self.end = None
+        
+    def __repr__(self):
+        return "Relocation(%d, %r, %r, %r, %d)" % (self.offset, self.packing,
+                                                   self.kind, self.symbol, self.addend)
+        
+    def moved(self, delta: int) -> 'Relocation':
+        """Return a copy of this relocation with its offset (and, if placed,
+        its instruction offsets) shifted by *delta*.
+        """
+        reloc = Relocation(self.offset + delta, self.packing, self.kind,
+                           self.symbol, self.addend)
+        if self.instr is not None:
+            reloc.instr = self.instr + delta
+            reloc.end = self.end + delta
+        return reloc
+    
+    def placed(self, start: int, length: int) -> 'Relocation':
+        """Return a copy of this relocation for code of *length* bytes that 
+        has been written to an image at offset *start*.
+        """
+        reloc = Relocation(self.offset + start, self.packing, self.kind,
+                           self.symbol, self.addend)
+        reloc.instr = start
+        reloc.end = start + length
+        return reloc
+        
+    def resolve(self, symbols, base: int=0) -> int:
+        """Compute the value of a placed relocation for an image loaded at 
+        address *base*. *symbols* maps names to absolute addresses; for 
+        expressions, its ``instr_addr`` and ``next_instr_addr`` entries are
+        updated in place.
+        
+        For a relocation that has not been placed, the instruction addresses
+        are instead read from those entries of *symbols*.
+        """
+        kind = self.kind
+        try:
+            if kind == 'abs':
+                return symbols[self.symbol] + self.addend
+            elif kind == 'rel':
+                if self.end is None:
+                    return symbols[self.symbol] + self.addend - symbols['next_instr_addr']
+                return symbols[self.symbol] + self.addend - (base + self.end)
+        except KeyError as err:
+            raise NameError("name '%s' is not defined" % err.args[0])
+        
+        if self.instr is not None:
+            symbols['instr_addr'] = base + self.instr
+            symbols['next_instr_addr'] = base + self.end
+        code = _expr_cache.get(self.symbol)
+        if code is None:
+            code = compile(self.symbol, '<relocation>', 'eval')
+            _expr_cache[self.symbol] = code
+        return eval(code, symbols)
+        
+    def value(self, symbols) -> int:
+        """Compute the value to be written, given a dict of symbol addresses
+        that includes ``instr_addr`` and ``next_instr_addr``. This is 
+        :meth:`resolve` for a relocation that has not been placed.
+        """
+        if self.instr is not None:
+            raise ValueError("Relocation has been placed; use resolve().")
+        return self.resolve(symbols)
+
 
 class Code(object):
     """Represents partially compiled machine code with a table of unresolved
@@ -8,6 +192,8 @@ class Code(object):
     Code instances can be compiled to a complete machine code string once all
     expression values can be determined.
     """
+    __slots__ = ('code', 'replacements')
+    
     def __init__(self, code: bytes):
         self.code = code
         self.replacements = []
@@ -20,36 +206,54 @@ class Code(object):
         packed with *packing* and written into the code at *index*. The expression
         is evaluated using the program's symbols as local variables.
         """
-        self.replacements.append((index, expr, packing))
+        if expr.isidentifier():
+            # plain symbol; no need to go through the python compiler
+            self.relocate(index, expr, packing)
+        else:
+            self.replacements.append(Relocation(index, packing, Relocation.EXPR, expr))
+        
+    def relocate(self, index: int, symbol: str, packing: str, addend: int=0, relative: bool=False):
+        """
+        Add a replacement starting at *index* that resolves to the address
+        of *symbol* plus *addend*.
+        
+        If *relative* is True, the value is made relative to the address of
+        the next instruction, as used by branches and rip-relative pointers.
+        """
+        kind = Relocation.REL if relative else Relocation.ABS
+        self.replacements.append(Relocation(index, packing, kind, symbol, addend))
         
     def __len__(self):
         return len(self.code)
     
     def compile(self, symbols) -> bytes:
-        code = self.code
-        # print(f'replacements: "{self.replacements}"')
-        for i, expr, packing in self.replacements:
-            val = eval(expr, symbols)
-            
-            val = struct.pack(packing, val)
-            # print(f'compile -> expr="{expr}" val="{val}" packing="{packing}"')
-            code = code[:i] + val + code[i+len(val):]
-        return code
+        code = bytearray(self.code)
+        self.compile_into(code, 0, symbols)
+        return bytes(code)
+
+    def compile_into(self, buf, offset: int, symbols) -> None:
+        """Write the resolved machine code into *buf* (a bytearray or writable
+        memoryview) starting at *offset*.
+        
+        Replacements are packed in place, so the cost is linear in the size
+        of the code.
+        """
+        buf[offset:offset+len(self.code)] = self.code
+        for reloc in self.replacements:
+            struct.pack_into(reloc.packing, buf, offset + reloc.offset, reloc.value(symbols))
 
     def __add__(self, x) -> 'Code':
         if isinstance(x, Code):
             code = Code(self.code + x.code)
-            for index, expr, packing in self.replacements:
-                code.replace(index, expr, packing)
-            for index, expr, packing in x.replacements:
-                code.replace(index+len(self.code), expr, packing)
+            code.replacements.extend(self.replacements)
+            shift = len(self.code)
+            code.replacements.extend(r.moved(shift) for r in x.replacements)
             return code
             
         elif isinstance(x, (bytes, bytearray)):
             append = bytes(x)
             code = Code(self.code + append)
-            for index, expr, packing in self.replacements:
-                code.replace(index, expr, packing)
+            code.replacements.extend(self.replacements)
             return code
         
         else:
@@ -60,6 +264,5 @@ class Code(object):
             raise TypeError("Cannot add Code to type %s" % type(x))
         prepend = bytes(x)
         code = Code(prepend + self.code)
-        for index, expr, packing in self.replacements:
-            code.replace(index+len(prepend), expr, packing)
+        code.replacements.extend(r.moved(len(prepend)) for r in self.replacements)
         return code
@@ -1,18 +1,210 @@
 # -'- coding: utf-8 -'-
 
-import sys, mmap, ctypes
-from .instruction import Instruction, Code, Label
-from .parser import parse_asm
+import sys, mmap, ctypes, time, struct, weakref, itertools, collections
+from .instruction import Instruction, RelBranchInstruction, Code, Label
+from .code import Relocation, scatter_pack, _numpy
+from .parser import parse_asm, iter_parse_asm, undefined_label_error
+from .memory import HOST_ARCH, default_pool
+from .cache import AssemblyCache
+from .module import Module, load_module, save_module
+from .instrument import activated, phase
+from . import ARCH
 
 from .label import Const
 
 
+class CodePageBuilder(object):
+    """Assembles a stream of code objects into a single machine code image.
+    
+    Items are written to the image as they are appended and then discarded;
+    only the image itself, the label offsets and the relocations still to be
+    applied are kept. If the final *size* of the image is known it may be 
+    given to allocate the image once.
+    
+    Branches are not relaxed, since that requires the whole program.
+    """
+    def __init__(self, size=None):
+        self.image = bytearray(size or 0)
+        self.size = 0
+        self.labels = {}
+        self.relocations = []
+        self.base = None
+        self.symbols = None
+        self._based = None
+        self._rebase_table = None
+    
+    @classmethod
+    def from_image(cls, image, labels, relocations):
+        """Create a builder holding an already assembled *image*, with its
+        label offsets and placed relocations.
+        """
+        builder = cls()
+        builder.image = bytearray(image)
+        builder.size = len(image)
+        builder.labels = dict(labels)
+        builder.relocations = list(relocations)
+        return builder
+        
+    def append(self, item):
+        """Write one label, instruction, constant, Code or bytes object to the
+        end of the image.
+        """
+        if self.base is not None:
+            self._unlink()
+        ptr = self.size
+        if isinstance(item, Label):
+            self.labels[item.name] = ptr
+            return
+        
+        if isinstance(item, (Instruction, Const)):
+            item = item.code
+        
+        if isinstance(item, Code):
+            size = len(item.code)
+            self.image[ptr:ptr+size] = item.code
+            self.relocations.extend(r.placed(ptr, size) for r in item.replacements)
+        else:
+            size = len(item)
+            self.image[ptr:ptr+size] = item
+        self.size = ptr + size
+        
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+            
+    def append_image(self, image, labels, relocations, origin=0):
+        """Write an already assembled *image* to the end of this one. *labels*
+        and the placed *relocations* are offsets in a larger image at which
+        *image* started at *origin*.
+        """
+        if self.base is not None:
+            self._unlink()
+        ptr = self.size
+        size = len(image)
+        shift = ptr - origin
+        self.image[ptr:ptr+size] = image
+        for name, offset in labels.items():
+            if name in self.labels:
+                raise NameError('Duplicate symbol "%s"' % name)
+            self.labels[name] = offset + shift
+        self.relocations.extend(r.moved(shift) for r in relocations)
+        self.size = ptr + size
+            
+    def _unlink(self):
+        # The image changed after it was linked: it must be linked again
+        # before it can be rebased, and the rebase tables are out of date.
+        self.base = None
+        self._based = None
+        self._rebase_table = None
+            
+    def link(self, base=0, symbols=None):
+        """Return the image with all relocations applied, as if loaded at
+        address *base*. Extra symbol addresses may be given in *symbols*.
+        """
+        addrs = {name: base + offset for name, offset in self.labels.items()}
+        if symbols is not None:
+            addrs.update(symbols)
+            
+        image = self.image
+        for reloc in self.relocations:
+            struct.pack_into(reloc.packing, image, reloc.offset, reloc.resolve(addrs, base))
+        if symbols != self.symbols:
+            # the table holds the values of external symbols
+            self._rebase_table = None
+        self.base = base
+        self.symbols = symbols
+        return bytes(image[:self.size])
+    
+    def based_relocations(self):
+        """Return the relocations whose value depends on the load address: 
+        absolute references to labels in the image, references relative to
+        the next instruction to external symbols, and expressions. 
+        
+        Relative references within the image, and absolute references to
+        external symbols, are the same wherever the image is loaded.
+        """
+        if self._based is None:
+            labels = self.labels
+            self._based = [r for r in self.relocations 
+                           if r.kind == 'expr' or (r.kind == 'abs') == (r.symbol in labels)]
+        return self._based
+    
+    def rebase_table(self):
+        """Return ``(groups, relative, exprs)`` describing how to rebase the
+        image.
+        
+        *groups* maps each struct packing to a pair of sequences (numpy arrays
+        if numpy is available): the offsets of absolute label references, and
+        their values for an image at address 0. *relative* is the same for
+        relative references to external symbols, whose values decrease as
+        the base address increases. *exprs* lists the expression relocations,
+        which must be evaluated one at a time.
+        """
+        if self._rebase_table is None:
+            labels = self.labels
+            symbols = self.symbols or {}
+            groups = {}
+            relative = {}
+            exprs = []
+            for reloc in self.based_relocations():
+                if reloc.kind == 'abs':
+                    offsets, values = groups.setdefault(reloc.packing, ([], []))
+                    offsets.append(reloc.offset)
+                    values.append(reloc.resolve(labels))
+                elif reloc.kind == 'rel':
+                    offsets, values = relative.setdefault(reloc.packing, ([], []))
+                    offsets.append(reloc.offset)
+                    values.append(reloc.resolve(symbols))
+                else:
+                    exprs.append(reloc)
+            numpy = _numpy()
+            if numpy is not None:
+                groups, relative = [
+                    {packing: (numpy.array(offsets, dtype=numpy.intp), 
+                               numpy.array(values, dtype=numpy.int64))
+                     for packing, (offsets, values) in table.items()}
+                    for table in (groups, relative)]
+            self._rebase_table = (groups, relative, exprs)
+        return self._rebase_table
+    
+    def rebase(self, base, use_numpy=None):
+        """Return the image relocated to address *base*, after it has been
+        linked by :meth:`link`.
+        
+        Only the relocations returned by :meth:`based_relocations` are 
+        rewritten, so this is much cheaper than linking again. Absolute 
+        references are written with :func:`code.scatter_pack` (vectorized 
+        with numpy, if available, unless *use_numpy* is False).
+        """
+        if self.base is None:
+            raise RuntimeError("Image must be linked before it can be rebased.")
+        if base == self.base:
+            return bytes(self.image[:self.size])
+        
+        groups, relative, exprs = self.rebase_table()
+        image = self.image
+        for packing, (offsets, values) in groups.items():
+            scatter_pack(image, packing, offsets, values, base, use_numpy=use_numpy)
+        for packing, (offsets, values) in relative.items():
+            scatter_pack(image, packing, offsets, values, -base, use_numpy=use_numpy)
+        
+        if exprs:
+            addrs = {name: base + offset for name, offset in self.labels.items()}
+            if self.symbols is not None:
+                addrs.update(self.symbols)
+            for reloc in exprs:
+                struct.pack_into(reloc.packing, image, reloc.offset, reloc.resolve(addrs, base))
+        self.base = base
+        return bytes(image[:self.size])
+
+
 class CodePage(object):
     """Compiles assembly, loads machine code into executable memory, and 
     generates python functions for accessing the code.
     
-    Initialize with either an assembly string or a list of 
-    :class:`Instruction <pycc.asm.Instruction>` instances. The *namespace*
+    Initialize with either an assembly string, a list of 
+    :class:`Instruction <pycc.asm.Instruction>` instances, or a 
+    :class:`CodePageBuilder` (see :meth:`from_lines`). The *namespace*
     argument may be used to define extra symbols when compiling from an 
     assembly string. 
     
@@ -20,74 +212,345 @@ class CodePage(object):
     sequence of asm commands are compiled and written. The memory page(s) may 
     contain multiple functions; use get_function(label) to create functions 
     beginning at a specific location in the code.
+    
+    The code is assembled for address 0. The first call to :meth:`load` or 
+    :meth:`get_function` copies it into executable memory allocated from
+    *pool* (by default, :data:`memory.default_pool`), relocated to the 
+    address it was loaded at (:attr:`page_addr`). :attr:`labels` always holds
+    offsets from the start of the page. The memory is released by 
+    :meth:`close`, or when the CodePage is garbage collected.
+    
+    :attr:`relocations` lists every location in :attr:`code` that refers to
+    a symbol (see :class:`code.Relocation`: offset, kind, symbol and addend),
+    so the image can be moved to another address with :meth:`rebase`
+    without assembling it again.
+    
+    Branches to labels are relaxed to their short (rel8) form wherever the
+    target is in range; pass ``relax=False`` to always use the 32-bit form.
+    
+    When assembling a string, *cache* may give a directory (or an
+    :class:`AssemblyCache <pycca.asm.cache.AssemblyCache>`) in which to keep
+    the assembled code; if the same source was assembled before, it is 
+    loaded from there without parsing or encoding it. Sources whose 
+    *namespace* holds values other than numbers, strings, registers, 
+    pointers and labels are not cached.
+    
+    If an :class:`Instrumentation <pycca.asm.instrument.Instrumentation>` is
+    given as *instrument*, it collects timings and counts for each phase of
+    assembly.
     """
-    def __init__(self, asm, namespace=None):
+    def __init__(self, asm, namespace=None, relax=True, pool=None, cache=None,
+                 instrument=None):
         self.labels = {}
+        self.relocations = []
+        self.page_addr = 0
+        self.pool = default_pool if pool is None else pool
+        self.memory = None
+        self._finalizer = None
+        self._builder = None
+        self._functions = {}
+        self.relax = relax
+        self.compile_time = None
+        self.instrument = instrument
+        with activated(instrument):
+            self._assemble(asm, namespace, cache)
+        
+    def _assemble(self, asm, namespace, cache):
+        instrument = self.instrument
+        relax = self.relax
+        if isinstance(asm, CodePageBuilder):
+            # already assembled; no instruction listing is kept
+            self.asm = None
+            start = time.perf_counter()
+            self.code = self._link(asm)
+            self.compile_time = time.perf_counter() - start
+            return
+        
+        key = None
         if isinstance(asm, str):
-            asm = parse_asm(asm, namespace=namespace)
+            if cache is not None:
+                if not isinstance(cache, AssemblyCache):
+                    cache = AssemblyCache(cache)
+                with phase(instrument, 'cache'):
+                    key = cache.key(asm, namespace, relax=relax)
+                    # None if the namespace cannot be cached
+                    entry = None if key is None else cache.get(key)
+                if instrument is not None and key is not None:
+                    instrument.counters['assembly_cache.%s' % 
+                                        ('misses' if entry is None else 'hits')] += 1
+                if entry is not None:
+                    # no instruction listing for cached code either
+                    self.asm = None
+                    start = time.perf_counter()
+                    self.code = self._link(CodePageBuilder.from_image(*entry))
+                    self.compile_time = time.perf_counter() - start
+                    return
+            asm = parse_asm(asm, namespace=namespace, instrument=instrument)
         else:
             if namespace is not None:
                 raise TypeError("Namespace argument may only be used with "
                                 "string assembly type.")
+            if cache is not None:
+                raise TypeError("Cache argument may only be used with "
+                                "string assembly type.")
+            if instrument is not None:
+                instrument.count_instructions(asm)
         
         self.asm = asm
-        self.page_addr = 0
         
         # Compile machine code and write to the page.
         self.code = self.compile(asm)
-        self._length = None
+        if key is not None:
+            cache.put(key, self.code, self.labels, self.relocations)
+        
+    @classmethod
+    def from_lines(cls, lines, namespace=None, workers=None, shard_lines=10000):
+        """Assemble *lines* (a string or any iterable of lines, such as an 
+        open file) without holding all parsed instructions in memory.
+        
+        If *workers* is given, the lines are split into shards of 
+        *shard_lines* lines that are parsed and encoded by that many worker
+        processes (or in this process, if *workers* is 1). Each worker returns
+        the image, labels and relocations of its shard; these are then joined
+        and linked here. At most ``2 * workers`` shards are read ahead of the
+        one being joined. *namespace* must be picklable.
+        
+        See :func:`iter_parse_asm <pycca.asm.parser.iter_parse_asm>`.
+        """
+        references = {}
+        if workers is None:
+            builder = CodePageBuilder()
+            builder.extend(iter_parse_asm(lines, namespace=namespace, references=references))
+            _check_references(builder, references)
+            return cls(builder)
+        
+        if isinstance(lines, str):
+            lines = lines.split('\n')
+        shards = _shards(lines, shard_lines, namespace)
+        builder = CodePageBuilder()
+        if workers == 1:
+            for shard in shards:
+                _join_shard(builder, _encode_shard(shard), references)
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            # Executor.map would read all shards at once; keep only a few
+            # in flight so that the source is still streamed
+            pending = collections.deque()
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for shard in shards:
+                    if len(pending) >= 2 * workers:
+                        _join_shard(builder, pending.popleft().result(), references)
+                    pending.append(pool.submit(_encode_shard, shard))
+                while pending:
+                    _join_shard(builder, pending.popleft().result(), references)
+        _check_references(builder, references)
+        return cls(builder)
+        
+    @classmethod
+    def from_module(cls, module):
+        """Create a CodePage from a :class:`Module <pycca.asm.module.Module>`
+        or the path of a module file written by :meth:`save`.
+        """
+        if not isinstance(module, Module):
+            with load_module(module) as module:
+                return cls.from_module(module)
+        if module.arch != ARCH:
+            raise TypeError("Module %s contains %d-bit code; ARCH is %d." 
+                            % (module.path, module.arch, ARCH))
+        builder = CodePageBuilder.from_image(module.code, module.labels, 
+                                             module.relocations)
+        return cls(builder)
+    
+    def save(self, path, lines=None, listing=True):
+        """Write the code, labels and relocations to a module file at *path*
+        (see :mod:`pycca.asm.module`).
+        
+        A line table may be given in *lines*; if *listing* is True and the
+        instructions are available, the output of :meth:`dump` is included.
+        """
+        text = self.dump() if listing and self.asm is not None else None
+        save_module(path, self._builder.rebase(0), self.labels, self.relocations,
+                    lines=lines, listing=text)
+        # rebase(0) only changes the builder's copy
+        self._builder.rebase(self.page_addr)
         
     def __len__(self):
-        return sum(map(len, self.asm))
+        return len(self.code)
 
     def compile(self, asm):
-        ptr = self.page_addr
-        # First locate all labels
-        for cmd in asm:
-            ptr += len(cmd)
-            if isinstance(cmd, Label):
-                self.labels[cmd.name] = ptr
-                
-        # now compile
-        symbols = self.labels.copy()
-        code = b''
-        for cmd in asm:
-            if isinstance(cmd, Label):
-                continue
+        """Assemble *asm* into a single machine code image.
+        
+        The image size is measured first so that it can be allocated once;
+        each item is then written into it and unresolved symbols are patched
+        in place.
+        """
+        start = time.perf_counter()
+        instrument = self.instrument
+        
+        with phase(instrument, 'relax'):
+            self.relax_branches(asm, enable=self.relax)
+        
+        with phase(instrument, 'layout'):
+            size = sum(len(cmd) for cmd in asm if not isinstance(cmd, Label))
+            builder = CodePageBuilder(size)
+            builder.extend(asm)
+        code = self._link(builder)
             
-            if isinstance(cmd, (Instruction, Const)):
-                # if there are unresolved symbols
-                if isinstance(cmd.code, Code):
-                    # Make some special symbols available when resolving
-                    # expressions:
-                    symbols['instr_addr'] = self.page_addr + len(code)
-                    symbols['next_instr_addr'] = symbols['instr_addr'] + len(cmd)
-                    
-                    # actually resolve `cmd.code`
-                    cmd._code = cmd.code.compile(symbols)
-                    
-                assert isinstance(cmd.code, bytes)
-                cmd = cmd.code
-            code += cmd
-        # TODO: could just return a `Code` instance, which'll hopefully make the code relocatable
+        self.compile_time = time.perf_counter() - start
         return code
+    
+    def _link(self, builder):
+        self._builder = builder
+        self.labels = dict(builder.labels)
+        self.relocations = builder.relocations
+        if self.instrument is not None:
+            self.instrument.relocations(builder.relocations)
+        if builder.base == self.page_addr and builder.symbols is None:
+            # already linked for this address
+            return bytes(builder.image[:builder.size])
+        with phase(self.instrument, 'resolve'):
+            return builder.link(self.page_addr)
+    
+    def load(self):
+        """Copy the code into executable memory, if that has not been done yet,
+        and return its address.
+        
+        Absolute references in the code are relocated to the load address, 
+        so :attr:`code` changes accordingly.
+        
+        The memory is made executable by :meth:`get_function`; until then,
+        the pool may pack other code into the same arena. To run the code 
+        by other means, call ``self.memory.seal()`` first.
+        """
+        if self.memory is None:
+            block = self.pool.store(len(self.code), self._builder.rebase)
+            code = self._builder.rebase(block.addr)
+            self.memory = block
+            self.page_addr = block.addr
+            self.code = code
+            self._finalizer = weakref.finalize(self, block.free)
+        return self.page_addr
+    
+    def close(self):
+        """Release the executable memory holding this code. Functions 
+        previously returned by :meth:`get_function` must not be called 
+        afterward.
+        """
+        if self._finalizer is not None:
+            self._finalizer()
+            self._finalizer = None
+        self.memory = None
+        self._functions.clear()
+        self.code = self._builder.rebase(0)
+        self.page_addr = 0
+    
+    def rebase(self, base):
+        """Relocate :attr:`code` to address *base* and return it.
+        
+        This does not move code that has been loaded into executable memory
+        (see :meth:`load`); it is meant for images that are run elsewhere.
+        """
+        if self.memory is not None:
+            raise ValueError("Cannot rebase a loaded CodePage; close() it first.")
+        self.code = self._builder.rebase(base)
+        self.page_addr = base
+        return self.code
+    
+    def get_function(self, label=None):
+        """Create and return a python function that points to a specific label
+        within the compiled code block, or the first byte if no label is given.
+        
+        The return value is a *ctypes* function; it is recommended to set the 
+        restype and argtypes properties on the function before calling it.
+        Functions are cached, so repeated calls with the same label return the
+        same object.
+        """
+        func = self._functions.get(label)
+        if func is not None:
+            return func
+        
+        if ARCH != HOST_ARCH:
+            raise RuntimeError("Cannot run %d-bit code in a %d-bit process."
+                               % (ARCH, HOST_ARCH))
+        addr = self.load()
+        self.memory.seal()
+        if label is not None:
+            addr += self.labels[label]
+        
+        # Turn this pointer into a callable python function
+        func = ctypes.CFUNCTYPE(None)(addr)
+        # the function must not outlive its memory
+        func.codepage = self
+        self._functions[label] = func
+        return func
+
+    @staticmethod
+    def relax_branches(asm, enable=True):
+        """Choose the smallest encoding for every branch to a label in *asm*.
+        
+        All relaxable branches start out short; any whose target turns out to
+        be out of rel8 range (or outside of *asm*) is grown to rel32 and the 
+        layout is repeated until no more branches change. Since branches only
+        ever grow, this always reaches a fixed point.
+        
+        Returns the number of layout passes made. If *enable* is False, all 
+        branches are reset to their long form instead.
+        """
+        branches = [cmd for cmd in asm 
+                    if isinstance(cmd, RelBranchInstruction) and cmd.relaxable]
+        for cmd in branches:
+            cmd.short = enable
+        if not enable or not branches:
+            return 0
+        
+        passes = 0
+        while True:
+            passes += 1
+            labels = {}
+            ends = []
+            ptr = 0
+            for cmd in asm:
+                if isinstance(cmd, Label):
+                    labels[cmd.name] = ptr
+                else:
+                    ptr += len(cmd)
+                    if isinstance(cmd, RelBranchInstruction) and cmd.short:
+                        ends.append((cmd, ptr))
+            
+            grown = False
+            for cmd, end in ends:
+                target = labels.get(cmd.args[0])
+                if target is None or not -128 <= target - end <= 127:
+                    cmd.short = False
+                    grown = True
+            if not grown:
+                return passes
+
+    @property
+    def compile_rate(self):
+        """Assembly throughput of the last call to :meth:`compile`, in bytes
+        per second.
+        """
+        if not self.compile_time:
+            return float('inf')
+        return len(self.code) / self.compile_time
 
     def dump(self):
         """Return a string representation of the machine code and assembly
         instructions contained in the code page.
         """
+        if self.asm is None:
+            raise TypeError("CodePage was streamed or loaded from a cache; "
+                            "no instruction listing is available.")
         code = ''
         ptr = 0
         indent = ''
         for instr in self.asm:
-            hex = ''
-            
-            if isinstance(instr, Instruction):
-                hex = ''.join(f'{b:02x}' for b in instr.code)
-            elif isinstance(instr, Const): # just raw data
-                if not instr.code:
-                    continue
-                hex = ''.join(f'{b:02x}' for b in instr.code)
+            # resolved bytes live in the image; instructions keep their
+            # unresolved templates
+            hex = self.code[ptr:ptr+len(instr)].hex()
+            if isinstance(instr, Const) and not hex:
+                continue
               
             pad = ' ' * (40 - len(hex))
             
@@ -103,3 +566,63 @@ class CodePage(object):
             ptr += len(hex)//2
         return code
 
+
+
+def _shards(lines, shard_lines, namespace):
+    """Split *lines* into ``(lines, namespace, first_line)`` shards.
+    """
+    lines = iter(lines)
+    first_line = 1
+    while True:
+        shard = list(itertools.islice(lines, shard_lines))
+        if not shard:
+            return
+        yield shard, namespace, first_line
+        first_line += len(shard)
+
+
+def _encode_shard(shard):
+    """Assemble one shard in a worker process. Returns its image, labels,
+    relocations (as tuples, which are much cheaper to pickle) and the lines
+    on which names assumed to be labels were first used.
+    """
+    lines, namespace, first_line = shard
+    builder = CodePageBuilder()
+    references = {}
+    builder.extend(iter_parse_asm(lines, namespace=namespace, first_line=first_line,
+                                  references=references))
+    relocations = [(r.offset, r.packing, r.kind, r.symbol, r.addend, r.instr, r.end)
+                   for r in builder.relocations]
+    return bytes(builder.image[:builder.size]), builder.labels, relocations, references
+
+
+def _join_shard(builder, result, references):
+    image, labels, relocations, shard_references = result
+    # shards are joined in order, so the first use is kept
+    for name, line in shard_references.items():
+        references.setdefault(name, line)
+    ptr = builder.size
+    builder.append_image(image, labels, ())
+    for offset, packing, kind, symbol, addend, instr, end in relocations:
+        reloc = Relocation(offset + ptr, packing, kind, symbol, addend)
+        reloc.instr = instr + ptr
+        reloc.end = end + ptr
+        builder.relocations.append(reloc)
+
+
+def _check_references(builder, references):
+    """Raise NameError, with its line, for the first name in streamed source
+    that was taken to be a label but is not defined in *builder*.
+    """
+    undefined = [(line, name) for name, line in references.items()
+                 if name not in builder.labels]
+    if undefined:
+        raise undefined_label_error(min(undefined)[1], references)
+
+
+def mkfunction(code, namespace=None):
+    """Convenience function that creates a CodePage from the supplied 
+    assembly and returns a function pointing to its first byte.
+    """
+    page = CodePage(code, namespace=namespace)
+    return page.get_function()
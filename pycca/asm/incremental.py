@@ -0,0 +1,180 @@
+# -'- coding: utf-8 -'-
+"""
+Incremental reassembly of assembly sources that change a little at a time.
+"""
+
+import struct
+
+from .instruction import Instruction, Label
+from .parser import (_eval_ns, _StreamNamespace, _split_lines, _parse_statement,
+                     undefined_label_error)
+from .codepage import CodePage, CodePageBuilder
+
+
+class _Region(object):
+    """The code between one label and the next.
+    """
+    __slots__ = ('key', 'labels', 'image', 'relocations', 'values', 'count',
+                 'start', 'placed', 'statements', 'lines')
+
+    def __init__(self, key, labels, builder, count, statements):
+        self.key = key
+        # label names and their offsets within the region
+        self.labels = labels
+        self.image = builder.image[:builder.size]
+        # relocations placed relative to the start of the region
+        self.relocations = builder.relocations
+        # last value written for each relocation
+        self.values = [None] * len(self.relocations)
+        self.count = count
+        self.start = None
+        self.placed = None
+        # index of the statement each relocation comes from, and the current
+        # line numbers of the statements
+        self.statements = statements
+        self.lines = None
+
+
+class IncrementalAssembler(object):
+    """Assembles successive versions of a source, re-encoding only what
+    changed.
+
+    The source is divided into regions, each starting at a label. On every
+    call to :meth:`assemble`, regions whose text is unchanged are reused;
+    only new or edited regions are parsed and encoded. Later regions are
+    shifted into place, and only relocations whose value changed are
+    patched. After each call, :attr:`reencoded` holds the number of
+    instructions that were encoded and :attr:`repatched` the number of
+    relocations written.
+
+    As with :meth:`CodePage.from_lines`, labels may be used before they are
+    defined and branches are not relaxed.
+    """
+    def __init__(self, namespace=None):
+        self.namespace = namespace
+        self.regions = []
+        self.labels = {}
+        self.reencoded = 0
+        self.repatched = 0
+
+    def _split(self, source, eval_ns):
+        """Return a list of (label names, statements) for each region of
+        *source*. Only the first region may have no labels.
+        """
+        regions = []
+        labels = []
+        statements = []
+        for item in _split_lines(source.split('\n'), eval_ns):
+            if isinstance(item, Label):
+                if labels or statements:
+                    regions.append((tuple(labels), statements))
+                labels = [item.name]
+                statements = []
+            else:
+                statements.append(item)
+        if labels or statements:
+            regions.append((tuple(labels), statements))
+        return regions
+
+    def _encode(self, key, labels, statements, eval_ns):
+        builder = CodePageBuilder()
+        count = 0
+        sources = []
+        for name in labels:
+            builder.append(Label(name))
+        for i, stmt in enumerate(statements):
+            item = _parse_statement(stmt, eval_ns)
+            if isinstance(item, Instruction):
+                count += 1
+            builder.append(item)
+            sources.extend([i] * (len(builder.relocations) - len(sources)))
+        return _Region(key, list(builder.labels.items()), builder, count, sources)
+
+    def assemble(self, source):
+        """Assemble *source* and return a new :class:`CodePage`.
+        """
+        try:
+            return self._assemble(source)
+        except Exception:
+            # regions may have been partly patched; start over next time
+            self.regions = []
+            self.labels = {}
+            raise
+
+    def _assemble(self, source):
+        eval_ns = _StreamNamespace(_eval_ns)
+        if self.namespace is not None:
+            eval_ns.update(self.namespace)
+
+        old = {region.key: region for region in self.regions}
+        regions = []
+        reencoded = 0
+        for labels, statements in self._split(source, eval_ns):
+            key = (labels, tuple(s[1] for s in statements))
+            region = old.pop(key, None)
+            if region is None:
+                region = self._encode(key, labels, statements, eval_ns)
+                reencoded += region.count
+            # the region may have moved to other lines
+            region.lines = [s[0] for s in statements]
+            regions.append(region)
+
+        # lay out regions, noting which labels and regions moved
+        ptr = 0
+        labels = {}
+        moved_regions = set()
+        for i, region in enumerate(regions):
+            if region.start != ptr:
+                region.start = ptr
+                region.placed = None
+                moved_regions.add(i)
+            for name, offset in region.labels:
+                labels[name] = ptr + offset
+            ptr += len(region.image)
+        moved = {name for name, addr in labels.items() if self.labels.get(name) != addr}
+        # references to deleted labels must be looked up again, and fail
+        moved.update(name for name in self.labels if name not in labels)
+
+        # patch relocations whose value may have changed
+        repatched = 0
+        symbols = None
+        for i, region in enumerate(regions):
+            region_moved = i in moved_regions
+            for j, reloc in enumerate(region.relocations):
+                kind = reloc.kind
+                if region.values[j] is not None:
+                    # expressions may refer to any label
+                    target_moved = moved if kind == 'expr' else reloc.symbol in moved
+                    if not target_moved and (kind == 'abs' or not region_moved):
+                        continue
+                if kind == 'expr':
+                    if symbols is None:
+                        symbols = dict(labels)
+                    value = reloc.resolve(symbols, region.start)
+                else:
+                    try:
+                        value = reloc.resolve(labels, region.start)
+                    except NameError:
+                        line = region.lines[region.statements[j]]
+                        raise undefined_label_error(reloc.symbol, {reloc.symbol: line})
+                if value != region.values[j]:
+                    struct.pack_into(reloc.packing, region.image, reloc.offset, value)
+                    region.values[j] = value
+                    repatched += 1
+
+        image = bytearray(ptr)
+        relocations = []
+        for region in regions:
+            image[region.start:region.start+len(region.image)] = region.image
+            if region.placed is None:
+                region.placed = [r.moved(region.start) for r in region.relocations]
+            relocations.extend(region.placed)
+
+        self.regions = regions
+        self.labels = labels
+        self.reencoded = reencoded
+        self.repatched = repatched
+
+        builder = CodePageBuilder.from_image(image, labels, relocations)
+        builder.base = 0
+        return CodePage(builder)
@@ -1,6 +1,6 @@
 # -'- coding: utf-8 -'-
 
-import struct, collections
+import time, struct, collections
 
 from .register import Register
 from .pointer import Pointer, pack_int, pack_uint, rex
@@ -8,12 +8,164 @@ from .modrm import ModRmSib
 from .util import long
 from .label import Label
 from .code import Code
-from . import ARCH
+from . import ARCH, instrument
 
 
+# Operand encoding kinds used by OpcodeDescriptor.operands
+ENC_NONE = 0      # operand is not encoded
+ENC_OPCODE = 1    # register is added to the last opcode byte
+ENC_RM = 2        # ModR/M r/m field
+ENC_REG = 3       # ModR/M reg field
+ENC_IMM = 4       # immediate data
+ENC_IMPLICIT = 5  # operand is implied by the opcode ('1', 'CL')
+ENC_INVALID = 6   # unrecognized encoding string
 
 
-class Instruction(object):
+class OpcodeDescriptor(object):
+    """Pre-parsed form of one entry in an instruction's *modes* table.
+    
+    Parses the opcode string (like ``'REX.W + 81 /0'``) and the operand 
+    encodings (like ``'ModRM:r/m (r,w)'``) so that encoding an instruction
+    only deals with integers and bytes.
+    
+    Attributes:
+    
+    * rexw: True if the REX.W bit must be set
+    * opcode: opcode bytes
+    * reg_in_opcode: True if a register is added to the last opcode byte
+    * opcode_ext: integer stored in the ModR/M reg field (``/digit``) or None
+    * operands: tuple of ``(kind, immsize)`` for each operand, where *kind*
+      is one of the ``ENC_*`` constants and *immsize* is the size in bits of
+      immediate operands
+    * operand_enc: the original operand encoding strings
+    """
+    def __init__(self, sig, mode, operand_enc):
+        op_parts = mode[0].split(' ')
+        self.rexw = False
+        if op_parts[:2] == ['REX.W', '+']:
+            op_parts = op_parts[2:]
+            self.rexw = True
+        
+        opcode_s = op_parts[0]
+        if '+' in opcode_s:
+            opcode_s = opcode_s.partition('+')[0]
+            self.reg_in_opcode = True
+        else:
+            self.reg_in_opcode = False
+        self.opcode = bytes(bytearray.fromhex(opcode_s))
+        
+        # check for opcode extension
+        self.opcode_ext = None
+        if len(op_parts) > 1:
+            if op_parts[1] == '/r':
+                pass  # handled by operand encoding
+            elif op_parts[1][0] == '/':
+                self.opcode_ext = int(op_parts[1][1])
+                
+        self.operand_enc = operand_enc.get(mode[1], ())
+        operands = []
+        for i, enc in enumerate(self.operand_enc):
+            immsize = None
+            if enc is None:
+                kind = ENC_NONE
+            elif enc.startswith('opcode +rd'):
+                kind = ENC_OPCODE
+            elif enc.startswith('ModRM:r/m'):
+                kind = ENC_RM
+            elif enc.startswith('ModRM:reg'):
+                kind = ENC_REG
+            elif enc.startswith('imm'):
+                kind = ENC_IMM
+                try:
+                    immsize = int(sig[i][3:].rstrip('u'))
+                except (IndexError, ValueError):
+                    # only an error if an instruction actually uses this mode
+                    kind = ENC_INVALID
+            elif enc in ('1', 'CL'):
+                kind = ENC_IMPLICIT
+            else:
+                # only an error if an instruction actually uses this mode
+                kind = ENC_INVALID
+            operands.append((kind, immsize))
+        self.operands = tuple(operands)
+
+
+class EncodingCache(object):
+    """Bounded LRU cache of compiled instructions.
+    
+    Maps a key identifying an instruction class and its operands (see
+    :meth:`Instruction.cache_key`) to a tuple ``(code, use_sig, backup)``:
+    the instruction's compiled code, either final bytes or a :class:`Code`
+    template with unresolved relocations, and the mode selected for it (see
+    :meth:`Instruction.mode_index`). Entries are treated as immutable, so
+    they may be shared by any number of instructions.
+    
+    Use the module-level ``encoding_cache`` instance; set its *enabled*
+    attribute to False to bypass it, or call :meth:`clear` to empty it.
+    """
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+        
+    def __len__(self):
+        return len(self._cache)
+        
+    def get(self, key):
+        """Return the code cached for *key*, or None.
+        """
+        try:
+            code = self._cache[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._cache.move_to_end(key)
+        self.hits += 1
+        return code
+        
+    def put(self, key, code):
+        """Store *code* for *key*, discarding the least recently used entry
+        if the cache is full.
+        """
+        self._cache[key] = code
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+            
+    def clear(self):
+        """Remove all entries and reset the hit/miss counters.
+        """
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """Return a dict with hits, misses, current size and maxsize.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 
+                'size': len(self._cache), 'maxsize': self.maxsize}
+            
+
+encoding_cache = EncodingCache()
+
+
+class InstructionType(type):
+    """Metaclass for instructions.
+    
+    Gives every Instruction subclass an empty ``__slots__`` unless it defines
+    its own, so that instances do not carry a ``__dict__``. Subclasses that 
+    need extra instance attributes must list them in ``__slots__``.
+    """
+    def __new__(mcls, name, bases, namespace, **kwds):
+        namespace.setdefault('__slots__', ())
+        return super().__new__(mcls, name, bases, namespace, **kwds)
+
+
+class Instruction(object, metaclass=InstructionType):
+    __slots__ = ('args', '_sig', '_clean_args', '_use_sig', '_mode', 
+                 '_prefixes', '_rex_byte', '_opcode', '_operands', '_code')
+    
     # Variables to be overridden by Instruction subclasses:
     modes = {}  # maps operand signature to instruction modes
     operand_enc = {}  # maps operand type to encoding mode
@@ -21,18 +173,17 @@ class Instruction(object):
     address_size = 'seg'  # address size is usually determined by code segment
     operand_size = 'reg'  # operand size is usually determined by register size
     
+    _descriptors = {}  # maps operand signature to OpcodeDescriptor
+    
+    def __init_subclass__(cls, **kwds):
+        super().__init_subclass__(**kwds)
+        # Parse the modes table once, when the instruction class is defined
+        cls._descriptors = {sig: OpcodeDescriptor(sig, mode, cls.operand_enc)
+                            for sig, mode in cls.modes.items()}
+    
     def __init__(self, *args):
-        self.args = []
-        for arg in args:
-            if isinstance(arg, list):
-                # print(f"\tinstruction.Instruction.__init__() -> about to create a pointer")
-                arg = Pointer(arg)
-            #elif isinstance(arg, str):
-                #try:
-                    #arg = bytes(arg)
-                #except TypeError:
-                    #raise TypeError("Invalid string argument; use bytes instead.")
-            self.args.append(arg)
+        self.args = tuple(Pointer(arg) if isinstance(arg, list) else arg
+                          for arg in args)
 
         # Analysis of input arguments and the corresponding instruction
         # mode to use 
@@ -50,6 +201,20 @@ class Instruction(object):
         # Complete, assembled instruction or Code instance
         self._code = None
 
+    def _invalidate(self):
+        """Discard the selected mode and compiled code so that they are
+        regenerated on next access.
+        """
+        self._sig = None
+        self._clean_args = None
+        self._use_sig = None
+        self._mode = None
+        self._prefixes = None
+        self._rex_byte = None
+        self._opcode = None
+        self._operands = None
+        self._code = None
+
     def __len__(self):
         return len(self.code)
 
@@ -114,6 +279,12 @@ class Instruction(object):
             self.select_instruction_mode()
         return self._mode
 
+    @property
+    def descriptor(self):
+        """The pre-parsed :class:`OpcodeDescriptor` for the selected mode.
+        """
+        return self._descriptors[self.use_sig]
+
     @property
     def prefixes(self):
         """List of string prefixes to use in the compiled instruction.
@@ -155,8 +326,59 @@ class Instruction(object):
         final machine code after symbols are resolved.
         """
         if self._code is None:
-            self.generate_code()
+            cache = encoding_cache
+            key = self.cache_key() if cache.enabled else None
+            entry = None if key is None else cache.get(key)
+            stats = instrument.active.get()
+            if stats is not None:
+                stats.encoded(self, cached=entry is not None)
+            if entry is None:
+                if stats is None:
+                    self.generate_code()
+                else:
+                    start = time.perf_counter()
+                    self.generate_code()
+                    stats.times['encode'] += time.perf_counter() - start
+                if key is not None:
+                    found = self.mode_index().get(self._sig)
+                    backup = None if found is None else found[2]
+                    cache.put(key, (self._code, self._use_sig, backup))
+                # The code is final; drop intermediate encoding state (it is
+                # regenerated if requested again)
+                self._sig = None
+                self._clean_args = None
+                self._prefixes = None
+                self._rex_byte = None
+                self._opcode = None
+                self._operands = None
+            else:
+                self._code, use_sig, backup = entry
+                if self._use_sig is None and use_sig is not None:
+                    # the mode is selected as if the code were generated
+                    self._use_sig = use_sig
+                    if stats is not None:
+                        stats.mode_selected(self, use_sig, backup, 0.0)
         return self._code    
+
+    def cache_key(self):
+        """Return a hashable key that determines the compiled code of this
+        instruction, or None if it cannot be cached.
+        
+        Subclasses whose encoding depends on state other than the class and
+        arguments must extend this key.
+        """
+        key = [type(self)]
+        for arg in self.args:
+            if isinstance(arg, Pointer):
+                key.append(arg.key)
+            elif isinstance(arg, Register):
+                key.append(arg)
+            elif isinstance(arg, (int, long, str, bytes)):
+                # type is included so that eg. 1 and True do not collide
+                key.append((type(arg), arg))
+            else:
+                return None
+        return tuple(key)
         
     @property
     def asm(self):
@@ -241,21 +463,69 @@ class Instruction(object):
         self._sig = tuple(sig)
         self._clean_args = tuple(clean_args)
 
+    @classmethod
+    def arch_modes(cls):
+        """The subset of :attr:`modes` supported by the current ARCH.
+        
+        This is computed once per class.
+        """
+        modes = cls.__dict__.get('_arch_modes')
+        if modes is None:
+            archind = 2 if ARCH == 64 else 3
+            modes = collections.OrderedDict([sm for sm in list(cls.modes.items()) if sm[1][archind]])
+            cls._arch_modes = modes
+        return modes
+
+    @classmethod
+    def mode_index(cls):
+        """Per-class cache mapping argument signatures (as returned by the 
+        `sig` property) to the mode selected for them.
+        
+        Each value is a tuple ``(use_sig, mode, backup)``, where *backup* is
+        True if no preferred mode was found, or None if the signature cannot be
+        encoded. Entries are added by :meth:`select_instruction_mode`.
+        """
+        index = cls.__dict__.get('_mode_index')
+        if index is None:
+            index = cls._mode_index = {}
+        return index
+
     def select_instruction_mode(self):
         """Select a compatible instruction mode from self.modes based on the 
         signature of arguments provided.
         
         Sets self.use_sig to the compatible signature selected.
         Sets self.mode to the instruction mode selected.
+        
+        The result depends only on the instruction class and the argument
+        signature, so it is looked up in :meth:`mode_index` and only searched
+        for on the first use of each signature.
         """
-        modes = self.modes
-        sigs__ = self.sig
+        stats = instrument.active.get()
+        if stats is not None:
+            start = time.perf_counter()
         
-        # filter out modes not supported by this arch
-        archind = 2 if ARCH == 64 else 3
-        modes = collections.OrderedDict([sm for sm in list(modes.items()) if sm[1][archind]])
+        sig = self.sig
+        index = self.mode_index()
+        try:
+            found = index[sig]
+        except KeyError:
+            found = index[sig] = self.search_instruction_mode(sig)
         
-        orig_sig = sigs__
+        if found is None:
+            raise TypeError(f'Argument types not accepted for instruction {self.name}: {sig}')
+        self._use_sig, self._mode, backup = found
+        
+        if stats is not None:
+            stats.mode_selected(self, self._use_sig, backup, time.perf_counter() - start)
+
+    def search_instruction_mode(self, sigs__):
+        """Search the modes supported by this arch for one compatible with the 
+        argument signature *sigs__*.
+        
+        Returns ``(use_sig, mode, backup)`` or None if no mode is compatible.
+        """
+        modes = self.arch_modes()
         
         #print("Select instruction mode for sig:", sig)
         #print "Available modes:", modes
@@ -269,9 +539,7 @@ class Instruction(object):
             #   => ('CL', '1'), ('CL', 'imm8'), ('r32', '1'), ('r32', 'imm8')
             
             if sig in modes:
-                self._use_sig = sig
-                self._mode = modes[sig]
-                return
+                return sig, modes[sig], False
             
             # Check each instruction mode one at a time to see whether it is compatible
             # with supplied arguments.
@@ -304,20 +572,16 @@ class Instruction(object):
                     else:
                         raise RuntimeError("Invalid return type from check_mode().")
                 if usemode is True:
-                    self._use_sig = mode
-                    self._mode = modes[mode]
-                    return
+                    return mode, modes[mode], False
                 elif usemode is not False:
                     if backup_mode is None or backup_mode[0] < usemode:
                         backup_mode = (usemode, mode)
         
         # Didn't find any definite hits, see if a backup mode is available.
         if backup_mode is not None:
-            self._use_sig = backup_mode[1]
-            self._mode = modes[backup_mode[1]]
-            return
+            return backup_mode[1], modes[backup_mode[1]], True
 
-        raise TypeError(f'Argument types not accepted for instruction {self.name}: {orig_sig}')
+        return None
 
     def check_mode(self, sig, mode):
         """Return True if an argument of type *sig* may be used to satisfy
@@ -395,32 +659,9 @@ class Instruction(object):
         
         Sets self._prefixes, self._rex_byte, self._opcode, and self._operands
         """
-        # parse opcode string (todo: these should be pre-parsed)
-        mode = self.mode
-        
-        op_parts = mode[0].split(' ')
-        rexw = False
-        if op_parts[:2] == ['REX.W', '+']:
-            op_parts = op_parts[2:]
-            rexw = True
-        
-        opcode_s = op_parts[0]
-        if '+' in opcode_s:
-            opcode_s = opcode_s.partition('+')[0]
-            reg_in_opcode = True
-        else:
-            reg_in_opcode = False
-        
-        # assemble initial opcode
-        opcode = bytearray.fromhex(opcode_s)
-        
-        # check for opcode extension
-        opcode_ext = None
-        if len(op_parts) > 1:
-            if op_parts[1] == '/r':
-                pass  # handled by operand encoding
-            elif op_parts[1][0] == '/':
-                opcode_ext = int(op_parts[1][1])
+        descr = self.descriptor
+        opcode = bytearray(descr.opcode)
+        opcode_ext = descr.opcode_ext
 
         # Parse operands into encodable pieces
         prefixes, rex_byt, opcode_reg, modrm_reg, modrm_rm, imm = self.parse_operands()
@@ -443,7 +684,13 @@ class Instruction(object):
         operands = []
         if modrm_rm is not None:
             #print('instruction.generate_instruction_parts ModRM:', modrm_reg, modrm_rm)
-            modrm = ModRmSib(modrm_reg, modrm_rm)
+            stats = instrument.active.get()
+            if stats is None:
+                modrm = ModRmSib(modrm_reg, modrm_rm)
+            else:
+                start = time.perf_counter()
+                modrm = ModRmSib(modrm_reg, modrm_rm)
+                stats.times['modrm'] += time.perf_counter() - start
             operands.append(modrm.code)
             rex_byt |= modrm.rex
             
@@ -452,7 +699,7 @@ class Instruction(object):
             operands.append(imm)
         
         # encode REX byte
-        if rexw:
+        if descr.rexw:
             rex_byt |= rex.w
         
         if rex_byt == 0:
@@ -497,9 +744,7 @@ class Instruction(object):
             6. imm: immediate string
         """
         clean_args = self.clean_args
-        operand_enc = self.operand_enc
-        use_sig = self.use_sig
-        mode = self.mode
+        operands = self.descriptor.operands
         
         reg = None
         rm = None
@@ -512,17 +757,16 @@ class Instruction(object):
 
         for i,arg in enumerate(clean_args):
             # look up encoding for this operand
-            enc = operand_enc[mode[1]][i]
-            if enc is None:
+            enc, immsize = operands[i]
+            if enc == ENC_NONE:
                 continue
-            #print "operand encoding:", i, arg, enc 
-            if enc.startswith('opcode +rd'):
+            if enc == ENC_OPCODE:
                 opcode_reg = arg.val
                 if arg.rex:
                     rex_byt = rex_byt | rex.b
                 if arg.bits == 16 and b'\x66' not in prefixes:
                     prefixes.append(b'\x66')
-            elif enc.startswith('ModRM:r/m'):
+            elif enc == ENC_RM:
                 rm = arg
                 if arg.bits == 16 and b'\x66' not in prefixes:
                     prefixes.append(b'\x66')
@@ -530,13 +774,11 @@ class Instruction(object):
                     addrpfx = arg.prefix
                     if addrpfx != b'':
                         prefixes.append(addrpfx)  # adds 0x67 prefix if needed
-            elif enc.startswith('ModRM:reg'):
+            elif enc == ENC_REG:
                 if arg.bits == 16 and b'\x66' not in prefixes:
                     prefixes.append(b'\x66')
                 reg = arg
-            elif enc.startswith('imm'):
-                immsize = int(use_sig[i][3:].rstrip('u'))
-                
+            elif enc == ENC_IMM:
                 if isinstance(arg, (int, long)):
                     # pack integer operand
                     styp = {8: 'b', 16: 'h', 32: 'i', 64: 'q'}
@@ -553,11 +795,12 @@ class Instruction(object):
                 
                 # pad with 0 if the operand is too small
                 imm = arg + b'\0'*((immsize-opsize)//8)
-            elif enc in ('1', 'CL'):
+            elif enc == ENC_IMPLICIT:
                 # do nothing: the presence of these is encoded in the opcode already
                 ...
             else:
-                raise RuntimeError("Invalid operand encoding: %s" % enc)
+                raise RuntimeError("Invalid operand encoding: %s" % 
+                                   self.descriptor.operand_enc[i])
         
         # GAS prefers 67 before 66
         prefixes.sort(reverse=True)
@@ -568,11 +811,45 @@ class Instruction(object):
 class RelBranchInstruction(Instruction):
     """Instruction supporting branching to a relative memory location.
     
-    Subclasses must set _addr_offset and _instr_len attributes.
+    Branches to a label are encoded with a 32-bit displacement unless
+    :attr:`short` is set, in which case the 8-bit form is used. 
+    :class:`CodePage <pycca.asm.CodePage>` sets this during branch relaxation.
     """
+    __slots__ = ('_label', '_short')
+    
     def __init__(self, addr):
         self._label = None
+        self._short = False
         Instruction.__init__(self, addr)
+        
+    @property
+    def relaxable(self):
+        """True if this instruction branches to a label and has a rel8 mode,
+        so that it may be shortened once the label address is known.
+        """
+        if not isinstance(self.args[0], str) or len(self.args) != 1:
+            return False
+        mode = self.modes.get(('rel8',))
+        return mode is not None and bool(mode[2 if ARCH == 64 else 3])
+        
+    def cache_key(self):
+        key = Instruction.cache_key(self)
+        return None if key is None else key + (self._short,)
+        
+    @property
+    def short(self):
+        """If True, a label operand is encoded as rel8 rather than rel32.
+        """
+        return self._short
+        
+    @short.setter
+    def short(self, short):
+        short = bool(short)
+        if short != self._short:
+            if short and not self.relaxable:
+                raise TypeError("Instruction %s has no short form." % self)
+            self._short = short
+            self._invalidate()
             
     def read_signature(self):
         if len(self.args) != 1:
@@ -584,8 +861,12 @@ class RelBranchInstruction(Instruction):
             
             # Generate relative call to label / offset
             self._label = addr
-            self._sig = (('rel32',), )
-            self._clean_args = [struct.pack('i', 0)]
+            if self._short:
+                self._sig = (('rel8',), )
+                self._clean_args = [struct.pack('b', 0)]
+            else:
+                self._sig = (('rel32',), )
+                self._clean_args = [struct.pack('i', 0)]
         else:
             Instruction.read_signature(self)
          
@@ -617,7 +898,7 @@ class RelBranchInstruction(Instruction):
                 # Set a Code instance that will insert the correct address once
                 # the label is resolved.
                 code = Code(code)
-                code.replace(addr_offset, "%s - next_instr_addr" % self._label, op_pack)
+                code.relocate(addr_offset, self._label, op_pack, relative=True)
                 self._code = code # This has unresolved labels!
             elif isinstance(self._label, (int, long)):
                 # Adjust offset to account for size of instruction
@@ -193,6 +193,8 @@ class mov(Instruction):
     """
     name = 'mov'
     
+    __slots__ = ('_label',)
+    
     modes = collections.OrderedDict([
         (('r/m8', 'r8'),   ['88 /r', 'mr', True, True]),
         (('r/m16', 'r16'), ['89 /r', 'mr', True, True]),
@@ -267,7 +269,7 @@ class mov(Instruction):
         
         from .code import Code    
         code = Code(code)
-        code.replace(addr_offset, f"{self._label}", 'i') # absolute address!
+        code.relocate(addr_offset, self._label, 'i') # absolute address!
         self._code = code # This has unresolved labels!
 
 
@@ -1628,7 +1630,12 @@ class jmp(RelBranchInstruction):
 
 def _jcc(name, opcodes, doc):
     """Create a jcc instruction class.
+    
+    *opcodes* is either [short, near] or just the near opcode, in which case
+    the short opcode is derived from its condition code.
     """
+    if isinstance(opcodes, str):
+        opcodes = ['%02x' % (0x70 | (bytearray.fromhex(opcodes)[-1] & 0xf)), opcodes]
       
     modes = {
         ('rel8',): [opcodes[0], 'i', True, True],
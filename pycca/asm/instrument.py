@@ -0,0 +1,155 @@
+# -'- coding: utf-8 -'-
+"""
+Optional instrumentation of the assembler.
+
+Pass an :class:`Instrumentation` to :class:`CodePage <pycca.asm.CodePage>` or
+:func:`parse_asm <pycca.asm.parser.parse_asm>` to find out where assembly time
+goes::
+
+    inst = Instrumentation()
+    page = CodePage(src, instrument=inst)
+    print(inst.stats())
+
+While an Instrumentation is active (see :meth:`Instrumentation.activate`),
+every instruction that is encoded reports to it; otherwise the assembler
+only pays for checking :data:`active`.
+"""
+
+import time, contextlib, contextvars, collections
+
+# The Instrumentation that is currently collecting data, if any. Each thread
+# (and asyncio task) has its own.
+active = contextvars.ContextVar('pycca_instrumentation', default=None)
+
+
+class Instrumentation(object):
+    """Collects timings and counters while code is assembled.
+
+    * :attr:`times`: seconds spent in each phase. ``split`` and ``parse`` are
+      the passes of :func:`parse_asm`; ``relax``, ``layout`` and ``resolve``
+      the steps of :meth:`CodePage.compile`; ``cache`` looking up the
+      assembly cache. ``encode`` is the time spent generating instruction
+      code wherever it happens (mostly during ``parse``) and includes
+      ``mode_selection`` and ``modrm``.
+    * :attr:`mnemonics`: number of instructions of each mnemonic in the
+      assembled code.
+    * :attr:`modes`: number of times each ``(mnemonic, signature)`` mode was
+      selected. A mode is selected whenever an instruction is encoded (again,
+      if branch relaxation changes its form), including when its code is
+      taken from the encoding cache.
+    * :attr:`backups`: per mnemonic, how often only a "backup" mode was
+      compatible (see :meth:`Instruction.select_instruction_mode`).
+    * :attr:`counters`: ``encoded`` instructions, relocations by kind
+      (``relocations.abs`` etc.), and hits and misses of the encoding and
+      assembly caches.
+
+    If *callback* is given, it is called as ``callback(phase, seconds)``
+    whenever a phase ends.
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.times = collections.defaultdict(float)
+        self.mnemonics = collections.Counter()
+        self.modes = collections.Counter()
+        self.backups = collections.Counter()
+        self.counters = collections.Counter()
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Context manager that makes this the :data:`active`
+        instrumentation in the current thread.
+        """
+        token = active.set(self)
+        try:
+            yield self
+        finally:
+            active.reset(token)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager that adds the time spent inside it to phase
+        *name*.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.times[name] += seconds
+            if self.callback is not None:
+                self.callback(name, seconds)
+
+    def count_instructions(self, items):
+        """Count the instructions in a list of code objects by mnemonic.
+        """
+        from .instruction import Instruction
+        for item in items:
+            if isinstance(item, Instruction):
+                self.mnemonics[item.name] += 1
+
+    def encoded(self, instr, cached):
+        """Record that the code of *instr* was generated, or taken from the
+        encoding cache if *cached* is True.
+        """
+        self.counters['encoded'] += 1
+        self.counters['encoding_cache.hits' if cached else 'encoding_cache.misses'] += 1
+
+    def mode_selected(self, instr, use_sig, backup, seconds):
+        self.modes[(instr.name, use_sig)] += 1
+        if backup:
+            self.backups[instr.name] += 1
+        self.times['mode_selection'] += seconds
+
+    def relocations(self, relocations):
+        """Count *relocations* by kind.
+        """
+        for reloc in relocations:
+            self.counters['relocations.' + reloc.kind] += 1
+
+    def hit_rate(self, name):
+        """Return the fraction of hits among lookups of cache *name*
+        (``encoding_cache`` or ``assembly_cache``), or None if there were none.
+        """
+        hits = self.counters[name + '.hits']
+        total = hits + self.counters[name + '.misses']
+        return hits / total if total else None
+
+    def stats(self):
+        """Return all collected data as a dict of plain dicts.
+        """
+        return {
+            'times': dict(self.times),
+            'instructions': sum(self.mnemonics.values()),
+            'mnemonics': dict(self.mnemonics),
+            'modes': {'%s %s' % (name, ', '.join(sig)): n
+                      for (name, sig), n in self.modes.items()},
+            'backups': dict(self.backups),
+            'counters': dict(self.counters),
+            'encoding_cache_hit_rate': self.hit_rate('encoding_cache'),
+            'assembly_cache_hit_rate': self.hit_rate('assembly_cache'),
+        }
+
+    def reset(self):
+        self.times.clear()
+        self.mnemonics.clear()
+        self.modes.clear()
+        self.backups.clear()
+        self.counters.clear()
+
+
+def phase(instrument, name):
+    """Return :meth:`instrument.phase(name) <Instrumentation.phase>`, or a
+    context manager that does nothing if *instrument* is None.
+    """
+    if instrument is None:
+        return contextlib.nullcontext()
+    return instrument.phase(name)
+
+
+def activated(instrument):
+    """Return :meth:`instrument.activate() <Instrumentation.activate>`, or a
+    context manager that does nothing if *instrument* is None.
+    """
+    if instrument is None:
+        return contextlib.nullcontext()
+    return instrument.activate()
@@ -14,6 +14,8 @@ def label(name):
 class Label(object):
     """Marks or references a location in assembly code. 
     """
+    __slots__ = ('name',)
+    
     def __init__(self, name):
         self.name = name
         
@@ -93,7 +95,7 @@ class Long(Const):
             except ValueError:
                 code = Code(b'\0' * 4)
                 # load absolute address
-                code.replace(0, f"{entry}", 'i')
+                code.relocate(0, entry, 'i')
                 unresolved.append(code)
             else:
                 unresolved.append(Code(code))
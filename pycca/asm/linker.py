@@ -0,0 +1,339 @@
+# -'- coding: utf-8 -'-
+"""
+Linking of separately assembled modules into one CodePage.
+
+Each module is assembled on its own and keeps its encoding until its source
+changes, so editing one module only reassembles that module. Labels are
+private to their module unless exported; any other name a module refers to is
+imported from the modules that export it.
+"""
+
+import re, bisect
+
+from . import instructions
+from .instruction import Label
+from .parser import (iter_parse_asm, mnemonics, _split_lines, _statement_re,
+                     _StreamNamespace)
+from .codepage import CodePage, CodePageBuilder
+from .cache import AssemblyCache
+
+# Mnemonics after which execution never continues with the next statement
+_terminators = frozenset(name for name, cls in mnemonics.items()
+                         if cls in (instructions.jmp, instructions.ret))
+
+_identifier_re = re.compile(r'[a-zA-Z_][a-zA-Z0-9_]*')
+
+
+def _barriers(source):
+    """Return the set of labels in *source* that cannot be reached by falling
+    through from the code before them: those that start the source or follow
+    an unconditional jump or return.
+    """
+    barriers = set()
+    barrier = True
+    for item in _split_lines(source.split('\n'), _StreamNamespace()):
+        if isinstance(item, Label):
+            if barrier:
+                barriers.add(item.name)
+        else:
+            m = _statement_re.match(item[1])
+            barrier = m is not None and m.group(1) in _terminators
+    return barriers
+
+
+def _line_table(relocations, references):
+    """Return the line table stored with a cached module: the offset of the
+    first relocation of each name in *references*, and the line it was 
+    first used on.
+    """
+    table = {}
+    for reloc in relocations:
+        sym = reloc.symbol
+        if reloc.kind != 'expr' and sym not in table and references.get(sym) is not None:
+            table[sym] = (reloc.offset, references[sym])
+    return sorted(table.values())
+
+
+def _line_references(relocations, lines):
+    """Invert :func:`_line_table`: map each name to its line."""
+    lines = dict(lines)
+    return {reloc.symbol: lines[reloc.offset] for reloc in relocations
+            if reloc.kind != 'expr' and reloc.offset in lines}
+
+
+class LinkUnit(object):
+    """One assembled module: its image, label offsets and relocations, and
+    the names it exports and imports.
+    """
+    def __init__(self, name, key, image, labels, relocations, exports=None,
+                 barriers=(), references=None):
+        self.name = name
+        self.key = key
+        self.image = image
+        self.labels = labels
+        self.relocations = relocations
+        # labels that code cannot fall through into
+        self.barriers = set(barriers)
+        if exports is None:
+            exports = labels.keys()
+        self.exports = set(exports)
+        for sym in self.exports:
+            if sym not in labels:
+                raise NameError('Module "%s" exports undefined symbol "%s"'
+                                % (name, sym))
+        self.imports = {r.symbol for r in relocations
+                        if r.kind != 'expr' and r.symbol not in labels}
+        # line on which each import is first used, if known
+        self.lines = {sym: line for sym, line in (references or {}).items()
+                      if sym in self.imports}
+
+    def qualified(self, sym):
+        """Return the name of one of this module's labels in the linked page:
+        exported labels keep their name, others are prefixed with the module
+        name (``module.label``).
+        """
+        if sym in self.exports:
+            return sym
+        return '%s.%s' % (self.name, sym)
+
+    def regions(self):
+        """Return a list of ``(start, end, labels)`` for each label-delimited
+        region of the image. Code before the first label forms a region with
+        no labels.
+        """
+        offsets = {}
+        for sym, offset in self.labels.items():
+            offsets.setdefault(offset, []).append(sym)
+        starts = sorted(offsets)
+        if not starts or starts[0] > 0:
+            starts.insert(0, 0)
+        ends = starts[1:] + [len(self.image)]
+        return [(start, end, offsets.get(start, [])) for start, end in zip(starts, ends)]
+
+    def __repr__(self):
+        return "<LinkUnit %s: %d bytes, %d exports, %d imports>" % (
+            self.name, len(self.image), len(self.exports), len(self.imports))
+
+
+class Linker(object):
+    """Lays out several independently assembled modules into one image and
+    resolves references between them.
+
+    Modules are added with :meth:`add` and kept in the order they were first
+    added; :meth:`link` returns a new :class:`CodePage`. A module whose
+    source and namespace have not changed is not assembled again, unless 
+    the namespace holds values that :meth:`AssemblyCache.key
+    <pycca.asm.cache.AssemblyCache.key>` cannot identify.
+    If *cache* gives a directory (or an :class:`AssemblyCache
+    <pycca.asm.cache.AssemblyCache>`), encodings are also kept there for
+    later processes.
+
+    Modules are assembled like :meth:`CodePage.from_lines`, so branches are
+    not relaxed. Expressions (see :meth:`Code.replace
+    <pycca.asm.code.Code.replace>`) may only refer to exported symbols.
+
+    After each :meth:`add`, :attr:`assembled` and :attr:`reused` count the
+    modules that were assembled or taken from the cache so far. After each
+    :meth:`link` with *entries*, :attr:`removed` lists the labels of the
+    regions that were dropped and :attr:`bytes_saved` their total size.
+    """
+    def __init__(self, align=16, cache=None):
+        self.align = align
+        if cache is not None and not isinstance(cache, AssemblyCache):
+            cache = AssemblyCache(cache)
+        self.cache = cache
+        self.modules = {}
+        self.assembled = 0
+        self.reused = 0
+        self.removed = []
+        self.bytes_saved = 0
+
+    def add(self, name, source, exports=None, namespace=None):
+        """Add (or replace) module *name*, assembled from the string *source*.
+
+        *exports* lists the labels that other modules may refer to; by
+        default all labels are exported. Returns the :class:`LinkUnit`.
+        """
+        key = AssemblyCache.key(source, namespace, linkable=True)
+        old = self.modules.get(name)
+        entry = None
+        references = {}
+        if old is not None and key is not None and old.key == key:
+            entry = (old.image, old.labels, old.relocations)
+            barriers = old.barriers
+            references = old.lines
+        else:
+            barriers = _barriers(source)
+            if self.cache is not None and key is not None:
+                entry = self.cache.get(key, lines=True)
+                if entry is not None:
+                    entry, lines = entry[:3], entry[3]
+                    references = _line_references(entry[2], lines)
+        if entry is None:
+            builder = CodePageBuilder()
+            builder.extend(iter_parse_asm(source, namespace=namespace, references=references))
+            entry = (bytes(builder.image[:builder.size]), builder.labels,
+                     builder.relocations)
+            if self.cache is not None and key is not None:
+                self.cache.put(key, *entry, lines=_line_table(entry[2], references))
+            self.assembled += 1
+        else:
+            self.reused += 1
+
+        unit = LinkUnit(name, key, *entry, exports=exports, barriers=barriers,
+                        references=references)
+        self.modules[name] = unit
+        return unit
+
+    def remove(self, name):
+        del self.modules[name]
+
+    def symbols(self):
+        """Return a dict mapping each exported symbol to the module that
+        exports it.
+        """
+        symbols = {}
+        for unit in self.modules.values():
+            for sym in unit.exports:
+                if sym in symbols:
+                    raise NameError('Symbol "%s" is exported by both "%s" and "%s"'
+                                    % (sym, symbols[sym].name, unit.name))
+                symbols[sym] = unit
+        return symbols
+
+    def live_regions(self, entries, symbols=None):
+        """Return a dict mapping each module name to a sorted list of indices
+        into its :meth:`LinkUnit.regions` that are reachable from the labels
+        in *entries*.
+
+        Entries are exported symbols or ``module.label`` names. A region is
+        reachable if it holds an entry, is referred to by a reachable region
+        or can be reached by falling through from one. Code before the first
+        label of a module is always kept.
+        """
+        if symbols is None:
+            symbols = self.symbols()
+        units = list(self.modules.values())
+        regions = {unit.name: unit.regions() for unit in units}
+        # region index of each label, and region start offsets for bisection
+        index = {}
+        starts = {}
+        for unit in units:
+            index[unit.name] = {sym: i for i, (_, _, syms) in enumerate(regions[unit.name])
+                                for sym in syms}
+            starts[unit.name] = [r[0] for r in regions[unit.name]]
+
+        def locate(unit, sym):
+            if sym in unit.labels:
+                return unit, index[unit.name][sym]
+            owner = symbols.get(sym)
+            if owner is None:
+                return None
+            return owner, index[owner.name][sym]
+
+        work = []
+        for unit in units:
+            if regions[unit.name] and not regions[unit.name][0][2]:
+                work.append((unit, 0))
+        for entry in entries:
+            if entry in symbols:
+                loc = locate(symbols[entry], entry)
+            else:
+                modname, _, sym = entry.partition('.')
+                unit = self.modules.get(modname)
+                loc = locate(unit, sym) if unit is not None and sym in unit.labels else None
+            if loc is None:
+                raise NameError('Entry label "%s" is not defined' % entry)
+            work.append(loc)
+
+        # outgoing references from each region
+        refs = {}
+        for unit in units:
+            unit_refs = refs[unit.name] = [[] for _ in regions[unit.name]]
+            for reloc in unit.relocations:
+                i = bisect.bisect_right(starts[unit.name], reloc.offset) - 1
+                if reloc.kind == 'expr':
+                    unit_refs[i].extend(_identifier_re.findall(reloc.symbol))
+                else:
+                    unit_refs[i].append(reloc.symbol)
+
+        live = {unit.name: set() for unit in units}
+        while work:
+            unit, i = work.pop()
+            if i in live[unit.name]:
+                continue
+            live[unit.name].add(i)
+            for sym in refs[unit.name][i]:
+                loc = locate(unit, sym)
+                if loc is not None:
+                    work.append(loc)
+            nxt = i + 1
+            if nxt < len(regions[unit.name]):
+                syms = regions[unit.name][nxt][2]
+                if not all(sym in unit.barriers for sym in syms):
+                    work.append((unit, nxt))
+        return {name: sorted(indices) for name, indices in live.items()}
+
+    def link(self, entries=None):
+        """Lay out all modules, each aligned to *align* bytes, and return a
+        :class:`CodePage` holding the result.
+
+        If *entries* lists labels (see :meth:`live_regions`), only regions
+        reachable from them are kept; :attr:`removed` and :attr:`bytes_saved`
+        describe what was dropped.
+
+        In the page's labels, exported symbols keep their names and other
+        labels are named ``module.label``.
+        """
+        symbols = self.symbols()
+        for unit in self.modules.values():
+            for sym in unit.imports:
+                if sym not in symbols:
+                    line = unit.lines.get(sym)
+                    where = '' if line is None else ' on line %d' % line
+                    raise NameError('Module "%s" imports undefined symbol "%s"%s'
+                                    % (unit.name, sym, where))
+
+        live = None
+        self.removed = []
+        self.bytes_saved = 0
+        if entries is not None:
+            live = self.live_regions(entries, symbols)
+
+        builder = CodePageBuilder()
+        for unit in self.modules.values():
+            regions = unit.regions()
+            if live is None:
+                keep = range(len(regions))
+            else:
+                keep = live[unit.name]
+                for i, (start, end, syms) in enumerate(regions):
+                    if i not in keep:
+                        self.removed.extend(unit.qualified(sym) for sym in syms)
+                        self.bytes_saved += end - start
+                if not keep:
+                    continue
+
+            # pad with nops up to the next aligned offset
+            pad = -builder.size % self.align
+            builder.append(b'\x90' * pad)
+
+            n = len(builder.relocations)
+            if live is None:
+                labels = {unit.qualified(sym): offset for sym, offset in unit.labels.items()}
+                builder.append_image(unit.image, labels, unit.relocations)
+            else:
+                relocs = unit.relocations
+                offsets = [r.offset for r in relocs]
+                for i in keep:
+                    start, end, syms = regions[i]
+                    first = bisect.bisect_left(offsets, start)
+                    last = bisect.bisect_left(offsets, end)
+                    builder.append_image(unit.image[start:end],
+                                         {unit.qualified(sym): start for sym in syms},
+                                         relocs[first:last], origin=start)
+            # the relocations were copied, so they can be renamed in place
+            for reloc in builder.relocations[n:]:
+                if reloc.kind != 'expr' and reloc.symbol in unit.labels:
+                    reloc.symbol = unit.qualified(reloc.symbol)
+        return CodePage(builder)
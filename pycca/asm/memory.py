@@ -0,0 +1,386 @@
+# -'- coding: utf-8 -'-
+"""
+Allocation of executable memory.
+
+Memory is mapped read/write so that machine code can be copied into it, and
+then switched to read/execute before it is run; it is never writable and
+executable at the same time.
+"""
+
+import os, sys, mmap, ctypes, threading, contextlib
+
+from . import ARCH
+
+# Bits of the host process; native code can only be run if ARCH matches.
+HOST_ARCH = 64 if sys.maxsize > 2**32 else 32
+
+# Linux x86-64: place the mapping in the low 2 GB of the address space
+MAP_32BIT = 0x40
+
+
+if sys.platform == 'win32':
+    _kernel32 = ctypes.windll.kernel32
+    _kernel32.VirtualAlloc.restype = ctypes.c_void_p
+    _kernel32.VirtualAlloc.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                                       ctypes.c_ulong, ctypes.c_ulong]
+    _kernel32.VirtualProtect.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                                         ctypes.c_ulong, ctypes.POINTER(ctypes.c_ulong)]
+    _kernel32.VirtualFree.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_ulong]
+    MEM_COMMIT = 0x1000
+    MEM_RESERVE = 0x2000
+    MEM_RELEASE = 0x8000
+    PAGE_READWRITE = 0x04
+    PAGE_EXECUTE_READ = 0x20
+else:
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _libc.mprotect.restype = ctypes.c_int
+    _libc.mprotect.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+
+
+class ExecutableMemory(object):
+    """A block of page-aligned memory that machine code can be written to and
+    then executed from.
+
+    The memory starts out writable; call ``protect(True)`` to make it
+    executable (and read-only) and ``protect(False)`` to make it writable
+    again. If *low* is True, the memory is allocated below 2 GB where the
+    platform allows it, so that its addresses fit in 32-bit absolute
+    relocations.
+    """
+    __slots__ = ('size', 'addr', 'executable', '_map')
+
+    def __init__(self, size, low=False):
+        size = max(size, 1)
+        self.size = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE * mmap.PAGESIZE
+        self.executable = False
+        self.addr = None
+        self._map = None
+
+        if sys.platform == 'win32':
+            addr = _kernel32.VirtualAlloc(None, self.size, MEM_COMMIT | MEM_RESERVE,
+                                          PAGE_READWRITE)
+            if not addr:
+                raise ctypes.WinError()
+            self.addr = addr
+        else:
+            flags = mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS
+            if low and sys.platform.startswith('linux'):
+                flags |= MAP_32BIT
+            self._map = mmap.mmap(-1, self.size, flags=flags,
+                                  prot=mmap.PROT_READ | mmap.PROT_WRITE)
+            buf = ctypes.c_char.from_buffer(self._map)
+            self.addr = ctypes.addressof(buf)
+            del buf
+
+    def write(self, data, offset=0):
+        """Copy *data* into the memory at *offset*.
+        """
+        if self.addr is None:
+            raise ValueError("Memory has been released.")
+        if self.executable:
+            raise PermissionError("Cannot write to executable memory.")
+        if offset < 0 or offset + len(data) > self.size:
+            raise ValueError("Write of %d bytes at offset %d exceeds memory "
+                             "size %d." % (len(data), offset, self.size))
+        ctypes.memmove(self.addr + offset, bytes(data), len(data))
+
+    def protect(self, executable=True):
+        """Make the memory executable and read-only, or (if *executable* is
+        False) writable and not executable.
+        """
+        if self.addr is None:
+            raise ValueError("Memory has been released.")
+        if executable == self.executable:
+            return
+        if sys.platform == 'win32':
+            prot = PAGE_EXECUTE_READ if executable else PAGE_READWRITE
+            old = ctypes.c_ulong()
+            if not _kernel32.VirtualProtect(self.addr, self.size, prot, ctypes.byref(old)):
+                raise ctypes.WinError()
+        else:
+            prot = mmap.PROT_READ | (mmap.PROT_EXEC if executable else mmap.PROT_WRITE)
+            if _libc.mprotect(self.addr, self.size, prot) != 0:
+                err = ctypes.get_errno()
+                raise OSError(err, "mprotect failed: %s" % os.strerror(err))
+        self.executable = executable
+
+    def close(self):
+        """Release the memory. Any code still referring to it must no longer
+        be called.
+        """
+        if self.addr is None:
+            return
+        if sys.platform == 'win32':
+            _kernel32.VirtualFree(self.addr, 0, MEM_RELEASE)
+        else:
+            self._map.close()
+            self._map = None
+        self.addr = None
+
+    def __del__(self):
+        self.close()
+
+
+class CodeBlock(object):
+    """A region of executable memory allocated from a :class:`CodePool`.
+    """
+    __slots__ = ('pool', 'arena', 'offset', 'size', 'addr')
+    
+    def __init__(self, pool, arena, offset, size):
+        self.pool = pool
+        self.arena = arena
+        self.offset = offset
+        self.size = size
+        self.addr = arena.memory.addr + offset
+        
+    @property
+    def executable(self):
+        return self.arena.memory.executable
+        
+    def write(self, data, offset=0):
+        """Copy *data* into this block at *offset*. See :meth:`CodePool.write`.
+        """
+        self.pool.write(self, data, offset)
+        
+    def seal(self):
+        """Make this block executable. See :meth:`CodePool.seal`.
+        """
+        self.pool.seal(self)
+        
+    def free(self):
+        """Return this block to its pool.
+        """
+        self.pool.free(self)
+        
+    def __repr__(self):
+        return "<CodeBlock 0x%x, %d bytes>" % (self.addr, self.size)
+
+
+class _Arena(object):
+    __slots__ = ('memory', 'free', 'used', 'blocks', 'sealed')
+    
+    def __init__(self, size, low):
+        self.memory = ExecutableMemory(size, low=low)
+        # sorted list of [offset, size] free regions
+        self.free = [[0, self.memory.size]]
+        self.used = 0
+        self.blocks = 0
+        # made executable; never written to again
+        self.sealed = False
+        
+    def alloc(self, size, align):
+        """Reserve *size* bytes at an offset that is a multiple of *align* 
+        (first fit). Return the offset, or None if there is no room.
+        """
+        for i, (offset, length) in enumerate(self.free):
+            start = -(-offset // align) * align
+            end = start + size
+            if end > offset + length:
+                continue
+            parts = []
+            if start > offset:
+                parts.append([offset, start - offset])
+            if end < offset + length:
+                parts.append([end, offset + length - end])
+            self.free[i:i+1] = parts
+            self.used += size
+            self.blocks += 1
+            return start
+        return None
+        
+    def release(self, offset, size):
+        free = self.free
+        i = 0
+        while i < len(free) and free[i][0] < offset:
+            i += 1
+        free.insert(i, [offset, size])
+        # merge with the following and preceding regions
+        if i + 1 < len(free) and offset + size == free[i+1][0]:
+            free[i][1] += free.pop(i+1)[1]
+        if i > 0 and free[i-1][0] + free[i-1][1] == offset:
+            free[i-1][1] += free.pop(i)[1]
+        self.used -= size
+        self.blocks -= 1
+
+
+def _check_align(align):
+    if align <= 0 or align & (align - 1) or align > mmap.PAGESIZE:
+        raise ValueError("Alignment must be a power of two no larger than "
+                         "the page size (%d), not %r." % (mmap.PAGESIZE, align))
+    return align
+
+
+class CodePool(object):
+    """Allocates executable memory for many small pieces of code by packing 
+    them into shared arenas of *arena_size* bytes.
+    
+    Blocks are aligned to *align* bytes (a power of two no larger than the
+    page size) unless another alignment is requested.
+    
+    An arena stays writable, and new blocks are packed into it, until code
+    in it is about to be run: then :meth:`seal` makes it executable. Sealed
+    arenas are never made writable again, since their code may be running
+    in another thread, so new blocks are allocated from arenas that are
+    still writable or from new ones, and space freed in a sealed arena is
+    not reused. Inside a :meth:`batch`, all arenas written to are sealed
+    when the batch ends.
+    
+    Arenas are unmapped as soon as all of their blocks have been freed.
+    """
+    def __init__(self, arena_size=64*1024, align=16, low=False):
+        _check_align(align)
+        self.arena_size = arena_size
+        self.align = align
+        self.low = low
+        self.arenas = []
+        self.protect_calls = 0
+        self._dirty = []
+        self._batch = 0
+        self._lock = threading.RLock()
+        
+    def alloc(self, size, align=None):
+        """Return a new :class:`CodeBlock` of *size* bytes.
+        
+        The block is in a writable arena, but another thread may seal that 
+        arena before the block is written to; use :meth:`store` to allocate
+        and fill a block at once.
+        """
+        align = self.align if align is None else _check_align(align)
+        size = max(size, 1)
+        with self._lock:
+            for arena in self.arenas:
+                if arena.sealed:
+                    continue
+                offset = arena.alloc(size, align)
+                if offset is not None:
+                    return CodeBlock(self, arena, offset, size)
+            
+            # arenas are page aligned, so offset 0 has any allowed alignment
+            arena = _Arena(max(self.arena_size, size), self.low)
+            self.arenas.append(arena)
+            return CodeBlock(self, arena, arena.alloc(size, align), size)
+        
+    def store(self, size, code, align=None):
+        """Allocate a block of *size* bytes and write ``code(block.addr)``
+        into it, which must return at most *size* bytes. Return the block.
+        """
+        with self._lock:
+            block = self.alloc(size, align)
+            try:
+                self.write(block, code(block.addr))
+            except BaseException:
+                self.free(block)
+                raise
+            return block
+        
+    def write(self, block, data, offset=0):
+        """Copy *data* into *block* at *offset*. 
+        
+        Blocks can only be written to until their arena is sealed.
+        """
+        if offset < 0 or offset + len(data) > block.size:
+            raise ValueError("Write of %d bytes at offset %d exceeds block "
+                             "size %d." % (len(data), offset, block.size))
+        with self._lock:
+            arena = block.arena
+            if arena.sealed:
+                raise PermissionError("Cannot write to a block whose code has "
+                                      "been made executable.")
+            if arena not in self._dirty:
+                self._dirty.append(arena)
+            arena.memory.write(data, block.offset + offset)
+            
+    def seal(self, block):
+        """Make the arena holding *block* executable, so that its code can be
+        run. Nothing can be written to the arena afterward.
+        
+        Inside a batch, this is deferred until the batch ends.
+        """
+        with self._lock:
+            if self._batch == 0:
+                self._seal(block.arena)
+            
+    def _seal(self, arena):
+        if arena.sealed or arena.memory.addr is None:
+            return
+        arena.memory.protect(executable=True)
+        arena.sealed = True
+        self.protect_calls += 1
+        if arena in self._dirty:
+            self._dirty.remove(arena)
+            
+    def commit(self):
+        """Make all arenas that have been written to executable, and seal
+        them.
+        """
+        with self._lock:
+            for arena in list(self._dirty):
+                self._seal(arena)
+            self._dirty = []
+        
+    @contextlib.contextmanager
+    def batch(self):
+        """Context manager that seals every arena written to when the 
+        outermost batch ends. Code in blocks written during the batch must
+        not be run before then.
+        """
+        with self._lock:
+            self._batch += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batch -= 1
+                if self._batch == 0:
+                    self.commit()
+        
+    def free(self, block):
+        """Release *block*. Its code must no longer be called.
+        """
+        with self._lock:
+            arena = block.arena
+            if arena.memory.addr is None:
+                return
+            arena.release(block.offset, block.size)
+            if arena.blocks == 0:
+                arena.memory.close()
+                self.arenas.remove(arena)
+                if arena in self._dirty:
+                    self._dirty.remove(arena)
+            
+    def stats(self):
+        """Return a dict describing the memory held by this pool:
+        
+        * arenas, sealed, mapped, used: number of arenas (and of sealed
+          arenas) and bytes
+        * free: bytes free in writable arenas, which new blocks can use
+        * sealed_free: bytes free in sealed arenas, which cannot be used
+        * blocks: number of live blocks
+        * utilization: fraction of mapped bytes in use
+        * fragmentation: 1 - (largest usable free region / all free bytes)
+        * protect_calls: number of permission changes made so far
+        """
+        with self._lock:
+            mapped = sum(a.memory.size for a in self.arenas)
+            used = sum(a.used for a in self.arenas)
+            regions = [size for a in self.arenas if not a.sealed for _, size in a.free]
+            free = sum(regions)
+            sealed_free = sum(size for a in self.arenas if a.sealed for _, size in a.free)
+            total = free + sealed_free
+            return {
+                'arenas': len(self.arenas),
+                'sealed': sum(a.sealed for a in self.arenas),
+                'blocks': sum(a.blocks for a in self.arenas),
+                'mapped': mapped,
+                'used': used,
+                'free': free,
+                'sealed_free': sealed_free,
+                'utilization': used / mapped if mapped else 0.0,
+                'fragmentation': 1 - max(regions, default=0) / total if total else 0.0,
+                'protect_calls': self.protect_calls,
+            }
+
+
+# Pool used by CodePage unless another is given. With ARCH=32, memory is
+# allocated low so that 32-bit absolute addresses fit.
+default_pool = CodePool(low=(ARCH == 32))
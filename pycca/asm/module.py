@@ -0,0 +1,225 @@
+# -'- coding: utf-8 -'-
+"""
+Binary container for assembled code.
+
+A module file holds the machine code of a :class:`CodePage` together with its
+symbol table and relocation table, and optionally a line table (mapping code
+offsets to source lines) and a text listing. Files are memory-mapped when
+loaded; the code is exposed as a read-only memoryview of the mapping and the
+tables are decoded only when they are first used.
+
+Layout (all integers little-endian)::
+
+    header      MAGIC, format version, ARCH, then (offset, size) of each
+                section below
+    code        machine code, at an offset aligned to 16 bytes
+    symbols     (name offset, name length, value) per symbol
+    relocations (offset, instr, end, kind, packing offset, packing length, 
+                symbol offset, symbol length, addend) per relocation; see 
+                code.Relocation
+    lines       (code offset, line number) pairs
+    strings     utf-8 names referenced by the tables above
+    listing     utf-8 text
+"""
+
+import os, mmap, struct, tempfile
+
+from . import ARCH
+from .code import Relocation
+
+MAGIC = b'PYCA'
+FORMAT_VERSION = 1
+
+SECTIONS = ('code', 'symbols', 'relocations', 'lines', 'strings', 'listing')
+
+_header = struct.Struct('<4sHH' + 'II' * len(SECTIONS))
+_symbol = struct.Struct('<IIq')
+_reloc = struct.Struct('<IIIBxxxIIIIq')
+_line = struct.Struct('<II')
+
+_kinds = ('abs', 'rel', 'expr')
+
+
+class ModuleFormatError(ValueError):
+    pass
+
+
+def _align(n, align=16):
+    return -(-n // align) * align
+
+
+def dump_module(code, labels, relocations, lines=None, listing=None):
+    """Return the bytes of a module file holding *code* (bytes linked for
+    address 0), the *labels* dict of code offsets and the list of placed
+    *relocations*.
+
+    *lines* may be a sequence of (code offset, line number) pairs and
+    *listing* a string (for example, the output of :meth:`CodePage.dump`).
+    """
+    strings = bytearray()
+    string_offsets = {}
+
+    def string(s):
+        offset = string_offsets.get(s)
+        if offset is None:
+            offset = string_offsets[s] = len(strings)
+            strings.extend(s.encode('utf-8'))
+        return offset, len(s.encode('utf-8'))
+
+    symbols = bytearray()
+    for name, value in labels.items():
+        symbols += _symbol.pack(*string(name), value)
+
+    relocs = bytearray()
+    for r in relocations:
+        relocs += _reloc.pack(r.offset, r.instr, r.end, _kinds.index(r.kind),
+                              *string(r.packing), *string(r.symbol), r.addend)
+
+    line_table = bytearray()
+    for offset, lineno in (lines or ()):
+        line_table += _line.pack(offset, lineno)
+
+    sections = {
+        'code': bytes(code),
+        'symbols': symbols,
+        'relocations': relocs,
+        'lines': line_table,
+        'strings': strings,
+        'listing': (listing or '').encode('utf-8'),
+    }
+
+    ptr = _header.size
+    layout = []
+    body = bytearray()
+    for name in SECTIONS:
+        data = sections[name]
+        if name == 'code':
+            start = _align(ptr)
+            body += b'\0' * (start - ptr)
+            ptr = start
+        layout += [ptr, len(data)]
+        body += data
+        ptr += len(data)
+
+    return _header.pack(MAGIC, FORMAT_VERSION, ARCH, *layout) + body
+
+
+def save_module(path, code, labels, relocations, lines=None, listing=None):
+    """Write a module file to *path* (atomically). See :func:`dump_module`.
+    """
+    data = dump_module(code, labels, relocations, lines=lines, listing=listing)
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class Module(object):
+    """A module file loaded with :func:`load_module`.
+
+    :attr:`code` is a read-only memoryview of the mapped file. The symbol,
+    relocation and line tables are decoded the first time they are accessed.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fh:
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        try:
+            self._parse_header()
+        except Exception:
+            self.close()
+            raise
+        self._labels = None
+        self._relocations = None
+
+    def _parse_header(self):
+        if len(self._view) < _header.size:
+            raise ModuleFormatError("%s: file is too short" % self.path)
+        fields = _header.unpack_from(self._view)
+        magic, version, arch = fields[:3]
+        if magic != MAGIC:
+            raise ModuleFormatError("%s: not a pycca module" % self.path)
+        if version != FORMAT_VERSION:
+            raise ModuleFormatError("%s: unsupported module version %d"
+                                    % (self.path, version))
+        self.version = version
+        self.arch = arch
+        self.sections = {}
+        for i, name in enumerate(SECTIONS):
+            offset, size = fields[3+2*i:5+2*i]
+            if offset + size > len(self._view):
+                raise ModuleFormatError("%s: section %s is truncated"
+                                        % (self.path, name))
+            self.sections[name] = self._view[offset:offset+size]
+        self.code = self.sections['code']
+
+    def _string(self, offset, size):
+        return str(self.sections['strings'][offset:offset+size], 'utf-8')
+
+    @property
+    def labels(self):
+        """Dict of label names to code offsets.
+        """
+        if self._labels is None:
+            self._labels = {self._string(name, size): value
+                            for name, size, value in _symbol.iter_unpack(self.sections['symbols'])}
+        return self._labels
+
+    @property
+    def relocations(self):
+        """List of :class:`Relocation <pycca.asm.code.Relocation>` records,
+        placed within :attr:`code`.
+        """
+        if self._relocations is None:
+            relocs = []
+            for (offset, instr, end, kind, pack, pack_size, sym, sym_size,
+                 addend) in _reloc.iter_unpack(self.sections['relocations']):
+                reloc = Relocation(offset, self._string(pack, pack_size), _kinds[kind],
+                                   self._string(sym, sym_size), addend)
+                reloc.instr = instr
+                reloc.end = end
+                relocs.append(reloc)
+            self._relocations = relocs
+        return self._relocations
+
+    @property
+    def lines(self):
+        """List of (code offset, line number) pairs.
+        """
+        return list(_line.iter_unpack(self.sections['lines']))
+
+    @property
+    def listing(self):
+        return str(self.sections['listing'], 'utf-8')
+
+    def close(self):
+        """Unmap the file. :attr:`code` may no longer be used.
+        """
+        if self._map is None:
+            return
+        for view in getattr(self, 'sections', {}).values():
+            view.release()
+        self._view.release()
+        self._map.close()
+        self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_module(path):
+    """Memory-map the module file at *path* and return a :class:`Module`.
+    """
+    return Module(path)
@@ -1,8 +1,9 @@
 import re
-from . import instructions, register, pointer
-from .instruction import Label  #, Instruction
+from . import register, pointer
+from .instruction import Label, Instruction, RelBranchInstruction
 
 from .label import Asciz, Long, Ascii
+from .instrument import activated as _activated, phase as _phase
 
 
 # Collect all registers in a single namespace for evaluating operands.
@@ -21,13 +22,250 @@ commands = {
 }
 
 
+#   Line classification
+# ----------------------------------------
+
+# "label:" at the start of a line
+_label_re = re.compile(r'\s*([a-zA-Z_][a-zA-Z0-9_]*)')
+# "mnemonic operands" or ".directive arguments"
+_statement_re = re.compile(r'(\.?[a-zA-Z_][a-zA-Z0-9_]*)([ \t].*)?$')
+# comma-separated directive arguments
+_directive_args_re = re.compile(r'^(?:(?:"[^"]+"|\d+|[a-zA-Z0-9_.]+),\s*)*(?:"[^"]+"|\d+|[a-zA-Z0-9_.]+)\s*$')
+_directive_arg_re = re.compile(r'"[^"]+"|[a-zA-Z0-9_.]+')
+
+# Alternative spellings of supported instructions. Names that have their own
+# instruction class are never aliased.
+mnemonic_aliases = {
+    'retn': 'ret',
+    'cltd': 'cdq',
+    'cbtw': 'cbw',
+    'cwtl': 'cwde',
+    'setnz': 'setne',
+    'setng': 'setle',
+    'cmovnz': 'cmovne',
+}
+
+
+def _build_mnemonics():
+    """Return a dict mapping every mnemonic accepted in assembly source to its
+    instruction class.
+    """
+    from . import instructions
+    table = {}
+    for attr, obj in vars(instructions).items():
+        if (not isinstance(obj, type) or not issubclass(obj, Instruction) or
+                obj in (Instruction, RelBranchInstruction)):
+            continue
+        table[attr] = obj
+        # classes like `or_` are named after a python keyword
+        name = vars(obj).get('name')
+        if isinstance(name, str):
+            table.setdefault(name, obj)
+    for alias, name in mnemonic_aliases.items():
+        if name in table:
+            table.setdefault(alias, table[name])
+    return table
+
+# Built on first use, so that importing the parser does not import every
+# instruction class
+_mnemonics = None
+
+
+def get_mnemonics():
+    """Return the dict built by :func:`_build_mnemonics`, building it (and
+    importing the instruction classes) on first use. It is also available as
+    ``parser.mnemonics``.
+    """
+    global _mnemonics
+    if _mnemonics is None:
+        _mnemonics = _build_mnemonics()
+    return _mnemonics
+
+
+def __getattr__(name):
+    if name == 'mnemonics':
+        return get_mnemonics()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+#   Operand parsing
+# ----------------------------------------
+
+_operand_token = re.compile(r"""\s*(?:
+    (?P<num>0[xX][0-9a-fA-F]+|0[bB][01]+|0[oO][0-7]+|[0-9]+)|
+    (?P<name>\.?[a-zA-Z_][a-zA-Z0-9_.]*)|
+    (?P<op>[-+*()\[\]])
+    )""", re.VERBOSE)
+
+_ptr_sizes = ('byte', 'word', 'dword', 'qword')
+
+# Sources tend to repeat the same operands, so token lists are memoized.
+_token_cache = {}
+_token_cache_size = 4096
+
+
+def _tokenize_operand(text):
+    """Split an operand into a tuple of (kind, text) tokens, where kind is
+    'num', 'name' or 'op'.
+    """
+    tokens = _token_cache.get(text)
+    if tokens is not None:
+        return tokens
+    
+    tokens = []
+    pos = 0
+    end = len(text.rstrip())
+    while pos < end:
+        m = _operand_token.match(text, pos)
+        if m is None:
+            raise SyntaxError('invalid syntax at "%s"' % text[pos:].strip())
+        tokens.append((m.lastgroup, m.group(m.lastgroup)))
+        pos = m.end()
+    
+    tokens = tuple(tokens)
+    if len(_token_cache) >= _token_cache_size:
+        _token_cache.clear()
+    _token_cache[text] = tokens
+    return tokens
+
+
+class _OperandParser(object):
+    """Recursive-descent parser for a single Intel-syntax operand::
+    
+        operand := [size "ptr"] ["offset"] expr
+        expr    := term (("+" | "-") term)*
+        term    := unary ("*" unary)*
+        unary   := ("-" | "+") unary | atom
+        atom    := number | name | name "(" expr ")" | "(" expr ")" 
+                 | "[" expr "]"
+    
+    Values are combined with the usual operators, so ``ebx + 4*ecx`` builds 
+    a Pointer exactly as it would in Python code. Names are looked up in
+    *namespace*; "." in names is replaced by "_", as for labels.
+    """
+    def __init__(self, text, namespace):
+        self.tokens = _tokenize_operand(text)
+        self.pos = 0
+        self.namespace = namespace
+        
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+    
+    def take(self, text=None):
+        tok = self.peek()
+        if tok[0] is None:
+            raise SyntaxError('unexpected end of operand')
+        if text is not None and tok[1] != text:
+            raise SyntaxError('expected "%s" but found "%s"' % (text, tok[1]))
+        self.pos += 1
+        return tok
+    
+    def parse(self):
+        size = None
+        kind, text = self.peek()
+        if (kind == 'name' and text in _ptr_sizes and 
+                self.pos + 1 < len(self.tokens) and self.tokens[self.pos+1][1] == 'ptr'):
+            size = text
+            self.pos += 2
+        if self.peek() == ('name', 'offset'):
+            self.pos += 1
+            
+        value = self.expr()
+        if self.pos < len(self.tokens):
+            raise SyntaxError('unexpected "%s"' % self.tokens[self.pos][1])
+        if size is not None:
+            value = getattr(pointer, size)(value)
+        return value
+        
+    def expr(self):
+        value = self.term()
+        while True:
+            op = self.peek()
+            if op == ('op', '+'):
+                self.pos += 1
+                value = value + self.term()
+            elif op == ('op', '-'):
+                self.pos += 1
+                value = value - self.term()
+            else:
+                return value
+    
+    def term(self):
+        value = self.unary()
+        while self.peek() == ('op', '*'):
+            self.pos += 1
+            value = value * self.unary()
+        return value
+    
+    def unary(self):
+        op = self.peek()
+        if op == ('op', '-'):
+            self.pos += 1
+            return -self.unary()
+        elif op == ('op', '+'):
+            self.pos += 1
+            return self.unary()
+        return self.atom()
+    
+    def atom(self):
+        kind, text = self.take()
+        if kind == 'num':
+            return int(text, 0)
+        elif kind == 'name':
+            name = text.replace('.', '_')
+            try:
+                value = self.namespace[name]
+            except KeyError:
+                raise NameError("name '%s' is not defined" % name)
+            if self.peek() == ('op', '('):
+                self.pos += 1
+                arg = self.expr()
+                self.take(')')
+                if not callable(value):
+                    raise TypeError("'%s' is not callable" % name)
+                value = value(arg)
+            return value
+        elif text == '(':
+            value = self.expr()
+            self.take(')')
+            return value
+        elif text == '[':
+            value = self.expr()
+            self.take(']')
+            return pointer.Pointer([value])
+        raise SyntaxError('unexpected "%s"' % text)
+
+
+def parse_operand(text, namespace=None):
+    """Parse a single Intel-syntax operand such as ``eax``, ``0x10``, 
+    ``label`` or ``dword ptr [ebx + 4*ecx - 8]``, returning the Register, 
+    Pointer, int or label name it describes.
+    
+    Names are resolved in *namespace* (by default, only registers and 
+    ``st``).
+    """
+    if namespace is None:
+        namespace = _eval_ns
+    return _parse_operand(text, namespace)
+
+
+def _parse_operand(text, namespace):
+    # fast path for the most common operands: a register or a label
+    if text in namespace:
+        return namespace[text]
+    return _OperandParser(text, namespace).parse()
+
+
 def process_command(match):
     cmd, args = match.groups()
     cmd = cmd.strip()
-    args = args.strip().encode().decode('unicode_escape') if args else None
+    args = args.strip().encode().decode('unicode_escape') if args else ''
 
-    args_list = re.match(r'^(?:(?:("[^"]+")|(\d+)|([a-zA-Z0-9_.]+)),\s*)*(?:(?:("[^"]+")|(\d+)|([a-zA-Z0-9_.]+))\s*)$', args).groups()
-    args_list = list(filter(None, args_list))
+    if args and _directive_args_re.match(args) is None:
+        raise SyntaxError('Invalid arguments to assembler command "%s": %s' % (cmd, args))
+    args_list = _directive_arg_re.findall(args)
   
     try:
         result = commands[cmd](*args_list)
@@ -39,22 +277,44 @@ def process_command(match):
     return result
 
 
-def parse_asm(asm, namespace=None):
-    """Parse assembly code and return a list of code objects that may be used
-    to construct a CodePage.
+class _StreamNamespace(dict):
+    """Operand namespace used while streaming: labels may be referenced 
+    before they are defined, so any unknown name is taken to be a label and 
+    left for the linker to resolve.
     
-    The *namespace* argument may a dict that defines symbols used in the 
-    assembly.
+    *references* maps each such name to the first line (:attr:`lineno` at
+    the time) on which it was used, so that an undefined one can be reported
+    with its line.
     """
-    code = []
-    eval_ns = _eval_ns.copy()
-    if namespace is not None:
-        eval_ns.update(namespace)
+    def __init__(self, *args):
+        dict.__init__(self, *args)
+        self.references = {}
+        self.lineno = None
         
-    # first pass: strip comments and labels
-    clean = []
-    for i,line in enumerate(asm.split('\n')):
-        lineno = i + 1
+    def __missing__(self, name):
+        self.references.setdefault(name, self.lineno)
+        return name
+
+
+def undefined_label_error(name, references):
+    """Return a NameError for a label *name* that was assumed while streaming
+    (see *references* in :func:`iter_parse_asm`) but never defined.
+    """
+    line = references.get(name)
+    if line is None:
+        return NameError("name '%s' is not defined" % name)
+    return NameError('Name "%s" on assembly line %d is not a register or a defined '
+                     'label' % (name, line))
+
+
+def _split_lines(lines, eval_ns, first_line=1):
+    """Strip comments and labels from *lines*.
+    
+    Yields a :class:`Label` for each label definition (adding it to 
+    *eval_ns*) and a ``(lineno, line, origline)`` tuple for each remaining
+    statement. Lines are numbered from *first_line*.
+    """
+    for lineno, line in enumerate(lines, first_line):
         line = line.strip()
         origline = line
         if line == '':
@@ -75,119 +335,135 @@ def parse_asm(asm, namespace=None):
         else:
             # create label if needed
             a = a.replace('.', '_')
-            m = re.match(r'\s*([a-zA-Z_][a-zA-Z0-9_]*)', a)
+            m = _label_re.match(a)
             if m is None:
                 raise SyntaxError('Expected label name before ":" on assembly '
                                   'line %d: "%s"' % (lineno, origline))
             label = m.groups()[0]
-            clean.append(Label(label))
-            line = b
             if label in eval_ns:
                 raise NameError('Duplicate symbol "%s" on assembly line %d: "%s"'
                                 % (label, lineno, origline))
                 
             eval_ns[label] = label
+            yield Label(label)
+            line = b
         
         line = line.strip()
         if line == '':
             continue
 
-        clean.append((lineno, line, origline))
-        
-    # second pass: generate instructions
-    for line in clean:
-        if isinstance(line, Label):
-            code.append(line)
-            continue
-        else:
-            lineno, line, origline = line
-        
-        m = re.match(r'([a-zA-Z_][a-zA-Z0-9_]*)([ \t].*)?$', line)
-        if m is None:
-            # check if it's an instruction for this program (starts with a literal dot)
-            m2 = re.match(r'(\.[a-zA-Z_][a-zA-Z0-9_]*)([ \t].*)?$', line)
-            
-            if m2 is not None:
-                data = process_command(m2)
-                code.append(data)
-                continue
-            
-            raise SyntaxError('Expected instruction mnemonic or assembler command on assembly line %d:'
-                              ' "%s"' % (lineno, origline))
-        
-        mnem, ops = m.groups()
-        mnem = mnem.strip()
-        
-        if mnem in ('or', 'and'):
-            mnem += '_'
-        
-        # Get instruction class
-        try:
-            icls = getattr(instructions, mnem)
-        except AttributeError:
-            raise NameError('Unknown instruction "%s" on assembly line %d:' %
-                            (mnem, lineno))
-        
-        # Use python eval to parse operands
-        args = []
-        if ops is not None:
-            ops = ops.split(',')
-            
-            for j, op in enumerate(ops):
-                op = op.strip()
-                
-                # parse pointer size
-                m = re.match(r'((byte|word|dword|qword)\s+ptr )?(.*)', op)
-                _, ptype, op = m.groups()
-                
-                # parse `offset`
-                try:
-                    left, op = op.split('offset')
-                except ValueError:  # no `offset` found
-                    left, op = '', op
-                
-                if left.strip():
-                    raise SyntaxError(f'Error parsing operand "{op}" on assembly line {lineno}:\n    Unknown??')
-                
-                op = op.replace('.', '_')
+        yield (lineno, line, origline)
 
-                # TODO: Why do we need this?
-                try:
-                    ev = eval_ns[op]
-                except KeyError:
-                    ev = op
-                
-                # eval operand
-                try:
-                    # print('asm.parser.parse_asm: op:', op)
-                    arg = eval(op, {'__builtins__': {}}, eval_ns)
-                except Exception as err:
-                    # this may be an expression of type:
-                    # [label + address], which the original code couldn't handle
-                    # because at this point, the labels in `eval_ns` merely strings (why tho??)
-                    # so, deal with it somehow...
-                    #
-                    # if this stuff gets parsed as a list, it goes on into instruction.Instruction.__init__
-                    # if one of the arguments is a list, it's converted to pointer.Pointer
-                    raise type(err)('Error parsing operand "%s" on assembly line'
-                                    ' %d:\n    %s' % (op, lineno, str(err)))
-                
-                # apply pointer size if requested
-                if ptype is not None:
-                    arg = getattr(pointer, ptype)(arg)
-                    
-                args.append(arg)
-        else:
-            ops = ''
 
-        # Create instruction
-        try:
-            inst = icls(*args)
-            # generate an error here if there is a compile problem:
+def _parse_statement(statement, eval_ns, encode=True):
+    """Return the code object for one ``(lineno, line, origline)`` statement
+    produced by :func:`_split_lines`. Instructions are encoded right away
+    (to report errors with their line number) unless *encode* is False.
+    """
+    lineno, line, origline = statement
+    
+    m = _statement_re.match(line)
+    if m is None:
+        raise SyntaxError('Expected instruction mnemonic or assembler command on assembly line %d:'
+                          ' "%s"' % (lineno, origline))
+    
+    mnem, ops = m.groups()
+    if mnem[0] == '.':
+        # assembler command
+        return process_command(m)
+    
+    # Get instruction class
+    try:
+        icls = get_mnemonics()[mnem]
+    except KeyError:
+        raise NameError('Unknown instruction "%s" on assembly line %d:' %
+                        (mnem, lineno))
+    
+    args = []
+    if ops is not None:
+        ops = ops.split(',')
+        
+        for op in ops:
+            op = op.strip()
+            try:
+                arg = _parse_operand(op, eval_ns)
+            except Exception as err:
+                raise type(err)('Error parsing operand "%s" on assembly line'
+                                ' %d:\n    %s' % (op, lineno, str(err)))
+            args.append(arg)
+    else:
+        ops = ''
+
+    # Create instruction
+    try:
+        inst = icls(*args)
+        # generate an error here if there is a compile problem:
+        if encode:
             inst.code
-            code.append(inst)
-        except Exception as err:
-            raise type(err)('Error creating instruction "%s %s" on assembly line'
-                            ' %d:\n    %s' % (mnem, ops, lineno, str(err)))
+    except Exception as err:
+        raise type(err)('Error creating instruction "%s %s" on assembly line'
+                        ' %d:\n    %s' % (mnem, ops, lineno, str(err)))
+    return inst
+
+
+def parse_asm(asm, namespace=None, instrument=None):
+    """Parse assembly code and return a list of code objects that may be used
+    to construct a CodePage.
+    
+    The *namespace* argument may a dict that defines symbols used in the 
+    assembly. If an :class:`Instrumentation 
+    <pycca.asm.instrument.Instrumentation>` is given as *instrument*, it 
+    collects timings and counts while parsing.
+    """
+    eval_ns = _eval_ns.copy()
+    if namespace is not None:
+        eval_ns.update(namespace)
+    
+    with _activated(instrument):
+        # first pass: strip comments and labels
+        with _phase(instrument, 'split'):
+            clean = list(_split_lines(asm.split('\n'), eval_ns))
+            
+        # second pass: generate instructions
+        code = []
+        with _phase(instrument, 'parse'):
+            for line in clean:
+                if isinstance(line, Label):
+                    code.append(line)
+                else:
+                    code.append(_parse_statement(line, eval_ns))
+        if instrument is not None:
+            instrument.count_instructions(code)
     
     return code
+
+
+def iter_parse_asm(lines, namespace=None, first_line=1, references=None):
+    """Parse assembly code one line at a time, yielding code objects as they
+    are produced.
+    
+    *lines* may be a string or any iterable of lines, such as an open file.
+    Line numbers in error messages start at *first_line*.
+    Unlike :func:`parse_asm`, the source is never held in memory as a whole,
+    so labels cannot be looked up in advance: any name that is not a 
+    register or defined in *namespace* is assumed to be a label, and an
+    undefined one is only reported when the code is linked. If *references*
+    is a dict, the line on which each assumed label is first used is added
+    to it, so that the error can point to that line (see
+    :func:`undefined_label_error`).
+    """
+    if isinstance(lines, str):
+        lines = lines.split('\n')
+    
+    eval_ns = _StreamNamespace(_eval_ns)
+    if namespace is not None:
+        eval_ns.update(namespace)
+    if references is not None:
+        eval_ns.references = references
+    
+    for item in _split_lines(lines, eval_ns, first_line):
+        if isinstance(item, Label):
+            yield item
+        else:
+            eval_ns.lineno = item[0]
+            yield _parse_statement(item, eval_ns)
@@ -236,6 +236,8 @@ class Pointer(object):
         mov(rax, [0x1000 + rax])
         mov(rax, [0x1000 + rbx*4])
     """
+    __slots__ = ('reg1', 'scale', 'reg2', 'disp', 'label', '_bits')
+    
     def __init__(self, reg1=None, scale=None, reg2=None, disp=None, label=None):
         if isinstance(reg1, (Pointer, list)) and scale is None and reg2 is None and disp is None:
             if isinstance(reg1, list):
@@ -388,6 +390,18 @@ class Pointer(object):
                 (x.scale == self.scale or (x.scale in (1, None) and self.scale in (1, None))) and
                 x.label == self.label)
 
+    def __hash__(self):
+        # Must agree with __eq__, which ignores disp/scale defaults and size
+        return hash((self.reg1, self.reg2, self.label))
+    
+    @property
+    def key(self):
+        """A hashable tuple that identifies exactly how this pointer is 
+        encoded (unlike __eq__, this distinguishes operand sizes and the
+        absence of displacement or scale).
+        """
+        return (Pointer, self.reg1, self.scale, self.reg2, self.disp, self.label, self._bits)
+
     def __str__(self):
         parts = []
         if self.disp is not None:
@@ -467,7 +481,7 @@ class Pointer(object):
                 sz //= 8
                 op_pack = {1: 'b', 2: 'h', 4: 'i'}[sz]
                 disp = Code(b'\0' * sz)
-                disp.replace(0, self.disp, op_pack)
+                disp.relocate(0, self.disp, op_pack)
                 
             mod = {1: 'ind8', 4: 'ind32'}[len(disp)]
 
@@ -497,8 +511,7 @@ class Pointer(object):
                     else:
                         # Prepare code replacement instructions for label
                         code = Code(modrm + b'\0'*4)
-                        code.replace(len(modrm), '%s + %d' % 
-                                     (self.label, disp), 'i')
+                        code.relocate(len(modrm), self.label, 'i', disp)
                         return mrex, code
                 else:
                     mrex, modrm = mod_reg_rm('ind', reg, 'sib')
@@ -523,8 +536,8 @@ class Pointer(object):
                         # Prepare code replacement instructions for label
                         disp = 0 if self.disp is None else self.disp
                         code = Code(modrm + b'\0'*4)
-                        code.replace(len(modrm), '%s + %d - next_instr_addr' % 
-                                     (self.label, disp), 'i')
+                        code.relocate(len(modrm), self.label, 'i', disp,
+                                      relative=True)
                         return mrex, code
                 
                 if regs[0].val == 4:
@@ -664,3 +677,8 @@ def byte(ptr):
         ptr = Pointer(ptr)
     ptr.bits = 8
     return ptr
+
+
+# see the end of register.py
+from . import register as _register
+_register.Pointer = Pointer
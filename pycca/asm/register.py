@@ -53,6 +53,8 @@ from .util import long
 class Register(object):
     """General purpose register.
     """
+    __slots__ = ('_val', '_name', '_bits')
+    
     def __init__(self, val, name, bits):
         self._val = val
         self._name = name
@@ -126,6 +128,11 @@ class Register(object):
     def __str__(self):
         return self._name
 
+    def __hash__(self):
+        # Registers are immutable singletons; hash by name so that hashes do
+        # not depend on object identity.
+        return hash(self._name)
+
     def check_arch(self):
         """Raise an exception if this register is not supported for the current
         architecture. 
@@ -252,4 +259,7 @@ elif ARCH == 64:
         argf = [xmm0, xmm1, xmm2, xmm3, xmm4, xmm5, xmm6, xmm7]
 
 
-from .pointer import Pointer
+# pointer.py imports this module. If it is being imported first, it is not
+# complete yet, and binds Pointer here itself once the class is defined.
+if __name__.rpartition('.')[0] + '.pointer' not in sys.modules:
+    from .pointer import Pointer
@@ -1,6 +1,7 @@
 # -'- coding: utf-8 -'-
 
-from pytest import raises
+import sys
+from pytest import raises, warns
 from pycca.asm import *
 from pycca.asm.pointer import Pointer, rex, pack_int
 from pycca.asm import instructions
@@ -60,6 +61,34 @@ def itest(instr, shouldpass=None):
         raise Exception("code mismatch.")
     
 
+def itest_batch(instrs):
+    """Like itest, for many instructions at once: GNU-as is run only once for
+    the whole list.
+    """
+    asms = [str(instr) for instr in instrs]
+    results = as_code_batch(asms, check_invalid_reg=True, cache=True)
+    mismatches = []
+    for instr, asm, code2 in zip(instrs, asms, results):
+        try:
+            code1 = instr.code
+        except Exception:
+            code1 = None
+        if isinstance(code2, Exception):
+            code2 = None
+        if code1 != code2:
+            mismatches.append(asm)
+            print("\n---------\n" + asm)
+            for name, code in (('py:  ', code1), ('gnu: ', code2)):
+                sys.stdout.write(name)
+                if code is None:
+                    print('[failed]')
+                else:
+                    phexbin(code)
+    if mismatches:
+        raise Exception("code mismatch for %d of %d instructions." 
+                        % (len(mismatches), len(instrs)))
+
+
 def itest_ptr(inst, pre_arg=None, post_arg=None):
     regs = all_registers()
     regs.sort(key=lambda a: (a.bits, a.name))
@@ -122,6 +151,94 @@ def test_instr_names():
             assert obj(*args).name == obj.__name__.rstrip('_')
 
 
+def test_mode_index():
+    # modes are selected once per class and signature
+    i1 = add(ecx, 4)
+    i2 = add(edx, 8)
+    assert i1.sig == i2.sig
+    assert i1.mode is i2.mode
+    assert add.mode_index()[i1.sig] == (i1.use_sig, i1.mode, False)
+    assert sub.mode_index() is not add.mode_index()
+    
+    # backup modes are recorded as such
+    i3 = mov(al, 0xff)
+    assert i3.use_sig == ('r8', 'imm8')
+    assert mov.mode_index()[i3.sig][2] is True
+    
+    # failures are cached too
+    with raises(TypeError):
+        add(eax, bx).code
+    assert add.mode_index()[add(eax, bx).sig] is None
+    with raises(TypeError):
+        add(eax, bx).code
+    
+
+def test_opcode_descriptor():
+    from pycca.asm.instruction import OpcodeDescriptor, ENC_RM, ENC_IMM, ENC_OPCODE
+    d = OpcodeDescriptor(('r/m64', 'imm8'), ['REX.W + 83 /0', 'mi'], add.operand_enc)
+    assert d.rexw and d.opcode == b'\x83' and d.opcode_ext == 0
+    assert d.operands == ((ENC_RM, None), (ENC_IMM, 8))
+    
+    d = OpcodeDescriptor(('r32', 'imm32'), ['b8+rd', 'oi'], mov.operand_enc)
+    assert not d.rexw and d.reg_in_opcode and d.opcode_ext is None
+    assert d.operands == ((ENC_OPCODE, None), (ENC_IMM, 32))
+    
+    # modes are parsed when the class is defined
+    assert set(mov._descriptors) == set(mov.modes)
+    assert mov(eax, ebx).descriptor is mov._descriptors[('r/m32', 'r32')]
+
+
+def test_encoding_cache():
+    from pycca.asm.instruction import encoding_cache
+    encoding_cache.clear()
+    
+    c1 = mov(eax, dword([ebp+8])).code
+    assert encoding_cache.info() == {'hits': 0, 'misses': 1, 'size': 1, 
+                                     'maxsize': encoding_cache.maxsize}
+    assert mov(eax, dword([ebp+8])).code is c1
+    assert encoding_cache.hits == 1
+    
+    # operand size, displacement and scale are part of the key
+    assert mov(eax, [ebp+8]).code == c1
+    assert mov(al, byte([ebp+8])).code != c1
+    assert mov(eax, dword([ebp+4])).code != c1
+    assert mov(eax, dword([ebx])).code != mov(eax, dword([ebx*1])).code
+    assert encoding_cache.hits == 1
+    
+    # short and long branches to the same label are distinct
+    j1 = jmp('x')
+    j2 = jmp('x')
+    j2.short = True
+    assert len(j1) == 5 and len(j2) == 2
+    
+    # unhashable arguments are not cached
+    assert mov(eax, bytearray(b'1234')).cache_key() is None
+    
+    try:
+        encoding_cache.enabled = False
+        n = len(encoding_cache)
+        mov(ecx, 1).code
+        assert len(encoding_cache) == n
+    finally:
+        encoding_cache.enabled = True
+        
+    # least recently used entries are evicted first
+    old_max = encoding_cache.maxsize
+    try:
+        encoding_cache.clear()
+        encoding_cache.maxsize = 2
+        push(eax).code
+        push(ebx).code
+        push(eax).code
+        push(ecx).code
+        assert push(eax).cache_key() in encoding_cache._cache
+        assert push(ebx).cache_key() not in encoding_cache._cache
+    finally:
+        encoding_cache.maxsize = old_max
+        
+    assert hash(Pointer([eax+8])) == hash(Pointer([eax+8]))
+
+
 def test_effective_address():
     # test that register/scale/offset arithmetic works
     assert str(Pointer([eax])) == '[eax]'
@@ -154,6 +271,128 @@ def test_effective_address():
     assert Pointer([r8]).modrm_sib(eax)[0] == rex.b
 
 
+def test_as_code_batch():
+    asms = ['mov eax, ebx', 'foo eax', 'add byte ptr [eax], al', 
+            'mov eax, [ebx+ecx*3]', 'ret', 'mov eax, 0x12345678']
+    results = as_code_batch(asms)
+    for asm, result in zip(asms, results):
+        try:
+            expect = as_code(asm, quiet=True)
+        except Exception as err:
+            assert isinstance(result, Exception)
+            assert str(result) == str(err)
+        else:
+            assert result == expect
+    assert 'no such instruction' in str(results[1])
+    
+    # differential check of a sweep of register operands
+    gp32 = [eax, ebx, ecx, edx, esi, edi, ebp, esp]
+    itest_batch([icls(a, b) for icls in (mov, add, sub, xor, cmp) 
+                 for a in gp32 for b in gp32])
+    
+
+def test_as_code_cache(tmp_path, monkeypatch):
+    from pycca.asm import util
+    path = str(tmp_path / 'as.sqlite')
+    monkeypatch.setattr(util, '_legacy_cache_path', str(tmp_path / 'none.pk'))
+    monkeypatch.setattr(util, 'as_code_cache', util.AsCodeCache(path))
+    
+    assert as_code('mov eax, ebx', cache=True) == b'\x89\xd8'
+    with raises(Exception) as err:
+        as_code('foo eax', quiet=True, cache=True)
+    assert 'no such instruction' in str(err.value)
+    
+    # entries are committed right away and visible to other connections
+    other = util.AsCodeCache(path)
+    assert len(other) == 2
+    assert other[('mov eax, ebx', False)] == (True, b'\x89\xd8')
+    ok, (message, output) = other[('foo eax', False)]
+    assert not ok and 'no such instruction' in message
+    
+    # cached results are returned without running GNU-as
+    monkeypatch.setattr(util, 'run_as', None)
+    assert as_code('mov eax, ebx', cache=True) == b'\x89\xd8'
+    with raises(Exception) as err:
+        as_code('foo eax', cache=True)
+    assert as_code_batch(['mov eax, ebx'], cache=True) == [b'\x89\xd8']
+    
+    # an unusable location falls back to memory
+    (tmp_path / 'file').write_text('')
+    with warns(UserWarning):
+        mem = util.AsCodeCache(str(tmp_path / 'file' / 'as.sqlite'))
+        mem[('ret', False)] = (True, b'\xc3')
+    assert mem[('ret', False)] == (True, b'\xc3')
+
+
+def test_as_code_cache_legacy(tmp_path, monkeypatch):
+    import pickle
+    from pycca.asm import util
+    
+    path = str(tmp_path / 'as.sqlite')
+    legacy = tmp_path / 'gnu_as_cache.pk'
+    monkeypatch.setattr(util, '_legacy_cache_path', str(legacy))
+    util.AsCodeCache(path)[('push eax', False)] = (True, b'\x50')
+    
+    # results in the old pickle are imported once, and the pickle removed
+    legacy.write_bytes(pickle.dumps({
+        '__counter__': 2,
+        ('ret', False): (True, bytearray(b'\xc3')),
+        ('push eax', False): (True, bytearray(b'\x00')),
+    }, protocol=0))
+    cache = util.AsCodeCache(path)
+    assert len(cache) == 2
+    assert not legacy.exists()
+    assert cache[('ret', False)] == (True, b'\xc3')
+    # newer results are kept
+    assert cache[('push eax', False)] == (True, b'\x50')
+    
+    # if the pickle cannot be removed, it is only imported once
+    legacy.write_bytes(pickle.dumps({('nop', False): (True, b'\x90')}, protocol=0))
+    def remove(path):
+        raise OSError(13, 'Permission denied')
+    monkeypatch.setattr(util.os, 'remove', remove)
+    with warns(UserWarning, match='Cannot remove'):
+        assert len(util.AsCodeCache(path)) == 3
+    def load(fh):
+        raise AssertionError("legacy cache read again")
+    monkeypatch.setattr(util.pickle, 'load', load)
+    assert len(util.AsCodeCache(path)) == 3
+    
+    with warns(DeprecationWarning):
+        util.write_as_code_cache()
+
+
+def test_as_code_cache_threads(tmp_path):
+    import threading
+    from pycca.asm import util
+    
+    for path in [str(tmp_path / 'as.sqlite'), str(tmp_path / 'file' / 'as.sqlite')]:
+        if 'file' in path:
+            # the in-memory fallback is shared by all threads
+            (tmp_path / 'file').write_text('')
+            with warns(UserWarning):
+                cache = util.AsCodeCache(path)
+                len(cache)
+        else:
+            cache = util.AsCodeCache(path)
+        errors = []
+        def store(n):
+            try:
+                for i in range(200):
+                    cache[('.byte %d' % i, n)] = (True, bytes([i]))
+                    cache.update([(('nop', n), (True, b'\x90'))] * 3)
+                    assert cache[('.byte %d' % i, n)] == (True, bytes([i]))
+            except Exception as err:
+                errors.append(err)
+        threads = [threading.Thread(target=store, args=(n % 2 == 1,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert errors == [] and len(cache) == 402
+        cache.close()
+    
+
 def test_generate_asm():
     # Need to be sure that str(instr) generates accurate strings or else 
     # we may get false positive tests.
@@ -0,0 +1,65 @@
+"""
+Tests of the benchmark suite. These only check that the measured code paths
+produce correct output; run ``python -m pycca.asm.benchmark`` for timings.
+"""
+import io
+from pycca.asm import *
+from pycca.asm import benchmark
+
+
+def test_generators():
+    for kind, generate in benchmark.GENERATORS.items():
+        src = generate(1000)
+        assert src.count('\n') == 999
+        # every listing must assemble
+        assert len(CodePage(src)) > 0
+
+
+def test_benchmark(tmp_path):
+    log = io.StringIO()
+    suite = benchmark.run_suite(sizes=(1000,), log=log)
+    results = suite['results']
+    assert [r['kind'] for r in results] == list(benchmark.GENERATORS)
+    for r in results:
+        assert r['lines'] == 1000 and r['instructions'] > 500 and r['bytes'] > 0
+        assert set(r['times']) == set(benchmark.STAGES)
+        assert r['rate'] > 0 and r['peak_memory'] > 0
+    assert log.getvalue().count('\n') == len(results) + 1
+    
+    path = str(tmp_path / 'bench.json')
+    benchmark.save_results(suite, path)
+    loaded = benchmark.load_results(path)
+    assert loaded == suite
+    
+    rows = benchmark.compare(loaded, suite)
+    assert len(rows) == len(results) * (len(benchmark.STAGES) + 1)
+    assert all(ratio in (1.0, None) for *_, ratio in rows)
+    assert 'total' in benchmark.format_comparison(rows)
+    
+    out = str(tmp_path / 'new.json')
+    suite = benchmark.main(['--kinds', 'alu', '--sizes', '200', '--no-memory', 
+                            '-o', out, '--compare', path])
+    assert benchmark.load_results(out)['results'][0]['peak_memory'] is None
+
+
+def test_micro():
+    # each micro-benchmark checks that the variants it times agree
+    sizes = {'parse_lines': 2000, 'rebase': 10000}
+    for name, fn in benchmark.MICRO.items():
+        rows = fn(sizes.get(name, 500))
+        assert len(rows) >= 2
+        assert all(seconds > 0 and count > 0 for _, seconds, count, _ in rows)
+        assert benchmark.format_micro(rows).count('\n') == len(rows)
+    
+    results = benchmark.main(['--micro', 'operands'])
+    assert list(results) == ['operands']
+
+
+def test_memory():
+    # instances must not carry a __dict__
+    for obj in [mov(eax, ebx), jmp('x'), Pointer([eax]), eax, label('x')]:
+        assert not hasattr(obj, '__dict__')
+    
+    result = benchmark.run('memory', 6000)
+    # roughly 90 MB per 100k instructions before __slots__ were introduced
+    assert result['peak_memory'] * 1e5 / result['instructions'] < 80e6
@@ -0,0 +1,100 @@
+import os
+from pycca.asm import *
+from pycca.asm.cache import AssemblyCache
+
+
+src = """
+    start:
+        mov eax, data
+        add eax, some_val
+        jne start
+    data:
+        .long 1, data
+"""
+
+
+def test_cache(tmp_path):
+    cache = AssemblyCache(str(tmp_path))
+    ns = {'some_val': 3}
+    
+    cp1 = CodePage(src, namespace=ns, cache=cache)
+    image = cp1.code
+    assert cache.misses == 1 and cache.hits == 0
+    assert len(cache.entries()) == 1
+    
+    # a hit does not parse or encode anything
+    cp2 = CodePage(src, namespace=ns, cache=str(tmp_path))
+    assert cp2.asm is None
+    assert cp2.code == cp1.code and cp2.labels == cp1.labels
+    assert [(r.offset, r.kind, r.symbol, r.addend) for r in cp2.relocations] == \
+           [(r.offset, r.kind, r.symbol, r.addend) for r in cp1.relocations]
+    assert cp2.rebase(0x1000) == cp1.rebase(0x1000)
+    
+    # anything that changes the output changes the key
+    keys = {cache.key(src, ns, relax=True),
+            cache.key(src, {'some_val': 4}, relax=True),
+            cache.key(src, ns, relax=False),
+            cache.key(src + 'ret', ns, relax=True)}
+    assert len(keys) == 4
+    assert cache.key(src, ns, relax=True) == cache.key(src, dict(ns), relax=True)
+    
+    # corrupt entries are ignored
+    for mtime, size, fname in cache.entries():
+        open(fname, 'wb').write(b'junk')
+    cp3 = CodePage(src, namespace=ns, cache=cache)
+    assert cp3.asm is not None and cp3.code == image
+    # no temporary files are left behind
+    assert all(f.endswith(cache.suffix) for f in os.listdir(str(tmp_path)))
+
+
+def test_cache_key(tmp_path):
+    import sys, subprocess, ctypes
+    import pycca
+    
+    # keys of equal namespaces are the same in every process
+    ns_src = ("{'some_val': 3, 'reg': ebx, 'ptr': dword([eax + ecx*2 + 4]), "
+              "'lbl': label('data'), 'vals': (1, 'x', None)}")
+    ns = eval(ns_src)
+    code = ('from pycca.asm import *\n'
+            'from pycca.asm.cache import AssemblyCache\n'
+            'print(AssemblyCache.key(%r, %s, relax=True))' % (src, ns_src))
+    root = os.path.dirname(os.path.dirname(os.path.abspath(pycca.__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    out = subprocess.run([sys.executable, '-c', code], env=env, check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True).stdout
+    key = AssemblyCache.key(src, ns, relax=True)
+    assert out.strip() == key
+    assert AssemblyCache.key(src, dict(ns, reg=ecx), relax=True) != key
+    assert AssemblyCache.key(src, dict(ns, some_val=3.0), relax=True) != key
+    
+    # values without a stable identity are never cached
+    cache = AssemblyCache(str(tmp_path))
+    for value in [lambda: 3, ctypes.c_int(3), object()]:
+        assert cache.key(src, {'some_val': 3, 'f': value}) is None
+    cp = CodePage(src, namespace={'some_val': 3, 'f': len}, cache=cache)
+    assert cp.code == CodePage(src, namespace={'some_val': 3}).code
+    assert cache.entries() == [] and cache.hits == cache.misses == 0
+
+
+def test_cache_eviction(tmp_path):
+    cache = AssemblyCache(str(tmp_path))
+    for i in range(5):
+        CodePage('mov eax, %d\nret' % i, cache=cache)
+    # make entry ages distinguishable
+    entries = sorted(cache.entries(), key=lambda e: e[2])
+    for i, (mtime, size, fname) in enumerate(entries):
+        os.utime(fname, (1000 + i, 1000 + i))
+    size = entries[0][1]
+    
+    # using an entry makes it recent
+    CodePage('mov eax, 0\nret', cache=cache)
+    assert cache.hits == 1
+    
+    cache.max_size = 3 * size
+    assert cache.evict() == 2
+    assert cache.size() <= 3 * size
+    CodePage('mov eax, 0\nret', cache=cache)
+    assert cache.hits == 2
+    
+    cache.clear()
+    assert cache.entries() == []
@@ -1,4 +1,7 @@
+import struct
+from pytest import raises
 from pycca.asm.code import *
+from pycca.asm.code import _expr_cache
 
 
 def test_code():
@@ -14,4 +17,78 @@ def test_code():
     assert c3.compile({'x': 0}) == b'\3\4\0\0' + struct.pack('i', 8) + b'\0\0\1\2'
 
     assert (c1 + c2).compile({'x': 0}) == (b'\0\0' + struct.pack('i', 8) + b'\0\0') * 2 + b'\1\2'
-    
\ No newline at end of file
+    
+
+def test_compile_into():
+    c1 = Code(b'\0' * 8)
+    c1.replace(2, 'x + 8', 'i')
+    
+    buf = bytearray(b'\xff' * 12)
+    c1.compile_into(memoryview(buf), 2, {'x': 10})
+    assert buf == b'\xff\xff\0\0' + struct.pack('i', 18) + b'\0\0\xff\xff'
+
+
+def test_relocate():
+    c1 = Code(b'\x90' + b'\0' * 8)
+    c1.relocate(1, 'x', 'i', 4)
+    c1.relocate(5, 'x', 'i', relative=True)
+    assert [r.kind for r in c1.replacements] == ['abs', 'rel']
+    
+    syms = {'x': 100, 'next_instr_addr': 9}
+    assert c1.compile(syms) == b'\x90' + struct.pack('ii', 104, 91)
+    
+    # relocations move with the code they belong to
+    c2 = b'\1\2' + c1
+    assert [r.offset for r in c2.replacements] == [3, 7]
+    assert c2.compile(syms) == b'\1\2\x90' + struct.pack('ii', 104, 91)
+
+    # plain symbols do not need to be evaluated as expressions
+    c3 = Code(b'\0' * 4)
+    c3.replace(0, 'x', 'i')
+    assert c3.replacements[0].kind == 'abs'
+    
+    with raises(NameError):
+        c3.compile({})
+    
+    # placed relocations resolve to the same values at any base address
+    for reloc in c1.replacements + [Relocation(0, 'i', 'expr', 'x - instr_addr')]:
+        placed = reloc.placed(16, 9)
+        for base in [0, 0x1000]:
+            addrs = {'x': 100, 'instr_addr': base + 16, 'next_instr_addr': base + 25}
+            assert placed.resolve(dict(addrs), base) == reloc.value(addrs)
+    with raises(ValueError):
+        placed.value(addrs)
+        
+    
+def test_expr_cache():
+    c1 = Code(b'\0' * 4)
+    c1.replace(0, 'x * 2', 'i')
+    c2 = Code(b'\0' * 4)
+    c2.replace(0, 'x * 2', 'i')
+    assert c1.compile({'x': 3}) == struct.pack('i', 6)
+    assert c2.compile({'x': 4}) == struct.pack('i', 8)
+    assert _expr_cache['x * 2'] is not None
+
+
+def test_scatter_pack():
+    from pycca.asm.code import scatter_pack, numpy
+    
+    offsets = list(range(0, 400, 4)) + [401]
+    values = [i * 0x01010101 for i in range(len(offsets))]
+    expected = bytearray(410)
+    for off, val in zip(offsets, values):
+        struct.pack_into('I', expected, off, 0x1000 + val)
+    
+    modes = [False] if numpy is None else [False, True]
+    for use_numpy in modes:
+        buf = bytearray(410)
+        scatter_pack(buf, 'I', offsets, values, 0x1000, use_numpy=use_numpy)
+        assert buf == expected
+        
+        buf = bytearray(16)
+        scatter_pack(buf, 'i', [0, 8], [-5, 2**31 - 1], use_numpy=use_numpy)
+        assert struct.unpack('i4xi4x', buf) == (-5, 2**31 - 1)
+        with raises(struct.error):
+            scatter_pack(buf, 'i', [0, 8], [-5, 2**31 - 1], 1, use_numpy=use_numpy)
+        with raises(struct.error):
+            scatter_pack(buf, 'I', [0], [-1], use_numpy=use_numpy)
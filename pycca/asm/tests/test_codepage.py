@@ -1,5 +1,7 @@
-import ctypes
+import mmap, ctypes, struct
+from pytest import raises
 from pycca.asm import *
+from pycca.asm.instruction import RelBranchInstruction
 
 
 def test_labels():
@@ -22,4 +24,325 @@ def test_labels():
     fn = cp.get_function('func2')
     fn.restype = ctypes.c_uint32
     assert fn() == 0xbeadface
-    
\ No newline at end of file
+    
+
+def test_compile():
+    cp = CodePage("""
+        start:
+            mov eax, data
+            jmp start
+        data:
+            .long 1, data
+    """, relax=False)
+    assert cp.labels == {'start': 0, 'data': 10}
+    assert cp.code == (b'\xb8' + struct.pack('i', 10) +
+                       b'\xe9' + struct.pack('i', -10) +
+                       struct.pack('ii', 1, 10))
+    assert len(cp) == len(cp.code)
+    assert cp.compile_rate > 0
+    assert '0x000a: 01000000' in cp.dump()
+
+
+def test_relax():
+    src = ("start:\n  jne start\n  jmp end\n" + 
+           "  mov eax, 1\n" * 30 + 
+           "end:\n  jmp start\n  je end\n  call end\n")
+    
+    cp = CodePage(src)
+    jne_, jmp_end, jmp_start, je_, call_ = [i for i in cp.asm 
+                                            if isinstance(i, RelBranchInstruction)]
+    # backward branch in range
+    assert jne_.short and cp.code[:2] == b'\x75\xfe'
+    # forward branch over 150 bytes must stay long
+    assert not jmp_end.short
+    # long backward branch, short forward branch, call has no short form
+    assert not jmp_start.short
+    assert je_.short
+    assert not call_.short
+    assert cp.code[-7:] == b'\x74\xf9\xe8\xf4\xff\xff\xff'
+    
+    cp2 = CodePage(src, relax=False)
+    assert not any(i.short for i in cp2.asm if isinstance(i, RelBranchInstruction))
+    assert len(cp2.code) == len(cp.code) + 8
+
+    # growing one branch can push another out of range
+    src = "a:\n  jmp b\n" + "  mov eax, 1\n" * 25 + "  jmp a\nb:\n"
+    cp = CodePage(src)
+    assert [i.short for i in cp.asm if isinstance(i, RelBranchInstruction)] == [False, False]
+
+
+def test_builder():
+    from pycca.asm.codepage import CodePageBuilder
+    
+    builder = CodePageBuilder()
+    builder.extend([label('a'), mov(eax, 'b'), jmp('a')])
+    builder.append(label('b'))
+    builder.append(b'\x90')
+    assert builder.labels == {'a': 0, 'b': 10}
+    assert len(builder.relocations) == 2
+    
+    code = builder.link(base=0x1000)
+    assert code == (b'\xb8' + struct.pack('i', 0x100a) +
+                    b'\xe9' + struct.pack('i', -10) + b'\x90')
+
+
+def test_parallel():
+    src = '\n'.join('f%d:\n    mov eax, f%d\n    call f%d\n    jmp f%d' 
+                    % (i, (i + 5) % 40, (i + 11) % 40, i) for i in range(40))
+    page = CodePage.from_lines(src)
+    code = page.code
+    based = page.rebase(0x1000)
+    for workers in (1, 2):
+        par = CodePage.from_lines(src, workers=workers, shard_lines=7)
+        assert par.code == code
+        assert par.labels == page.labels
+        assert par.rebase(0x1000) == based
+    
+    # line numbers in errors count from the start of the source
+    with raises(NameError) as err:
+        CodePage.from_lines(src + '\n    foo eax', workers=2, shard_lines=7)
+    assert 'line 161' in str(err.value)
+    with raises(NameError):
+        CodePage.from_lines(src + '\nf1:', workers=1, shard_lines=7)
+    
+    # a name that is not a register is taken to be a label; if it is never
+    # defined, the error points to where it was used
+    typo = src.replace('call f11', 'call f11\n    mov eax, eaz', 1)
+    for workers in (None, 1, 2):
+        with raises(NameError) as err:
+            CodePage.from_lines(typo, workers=workers, shard_lines=7)
+        assert str(err.value) == ('Name "eaz" on assembly line 4 is not a register '
+                                  'or a defined label')
+
+
+def test_parallel_streaming(monkeypatch):
+    from pycca.asm import codepage
+    
+    # shards are read from the source only a few at a time
+    read = []
+    def lines():
+        for i in range(400):
+            read.append(i)
+            yield 'f%d:\n    call f%d' % (i, i)
+    ahead = []
+    join = codepage._join_shard
+    def join_shard(builder, result, references):
+        join(builder, result, references)
+        ahead.append(len(read) - len(builder.labels))
+    monkeypatch.setattr(codepage, '_join_shard', join_shard)
+    
+    page = CodePage.from_lines(lines(), workers=2, shard_lines=10)
+    assert len(page.labels) == 400
+    assert max(ahead) <= (2 * 2 + 1) * 10
+
+
+def test_load(monkeypatch):
+    from pycca.asm import codepage
+    
+    cp = CodePage("""
+            jmp start
+        value:
+            .long 7
+        start:
+            mov eax, 0x12345
+            ret
+        addr:
+            mov eax, value
+            ret
+    """, relax=False)
+    image = cp.code
+    assert cp.page_addr == 0 and cp.memory is None
+    
+    addr = cp.load()
+    assert addr == cp.page_addr != 0 and not cp.memory.executable
+    assert addr % 16 == 0
+    assert cp.load() == addr
+    # absolute references are relocated; labels stay relative to the page
+    assert cp.labels['value'] == 5
+    assert cp.code[-6:] == b'\xb8' + struct.pack('I', addr + 5) + b'\xc3'
+    assert cp.code[:-6] == image[:-6]
+    assert ctypes.string_at(addr, len(cp.code)) == cp.code
+    
+    if codepage.ARCH != codepage.HOST_ARCH:
+        with raises(RuntimeError):
+            cp.get_function()
+        # this code happens to decode identically in 32- and 64-bit mode
+        monkeypatch.setattr(codepage, 'HOST_ARCH', codepage.ARCH)
+        
+    fn = cp.get_function()
+    assert cp.get_function() is fn and cp.memory.executable
+    fn.restype = ctypes.c_uint32
+    assert fn() == 0x12345
+    fn = cp.get_function('addr')
+    fn.restype = ctypes.c_uint32
+    assert fn() == addr + 5
+    
+    cp.close()
+    assert cp.memory is None and cp.page_addr == 0
+
+
+def test_pool():
+    from pycca.asm.memory import CodePool
+    
+    pool = CodePool(arena_size=4096, align=8)
+    with pool.batch():
+        pages = [CodePage([mov(eax, i), ret(), b'\x90\x90'], pool=pool) 
+                 for i in range(600)]
+        for cp in pages:
+            cp.load()
+            assert not cp.memory.executable
+    # 8-byte blocks in 4 kB arenas; each arena is made executable once
+    stats = pool.stats()
+    assert stats['arenas'] == 2 and stats['blocks'] == 600
+    assert stats['protect_calls'] == 2
+    assert all(cp.memory.executable for cp in pages)
+    assert len(set(cp.page_addr for cp in pages)) == 600
+    assert all(ctypes.string_at(cp.page_addr, 8) == cp.code for cp in pages)
+    assert stats['utilization'] == 4800 / 8192
+    # the space left in sealed arenas cannot be used
+    assert stats['free'] == 0 and stats['sealed_free'] == 8192 - 4800
+    
+    # freeing every other block fragments the arenas..
+    for cp in pages[::2]:
+        cp.close()
+    stats = pool.stats()
+    assert stats['blocks'] == 300 and stats['fragmentation'] > 0.4
+    # ..but sealed arenas are never made writable again, since their code
+    # may be running, so the space freed in them is not reused
+    assert stats['sealed_free'] == 8192 - 2400 and stats['fragmentation'] == 1
+    block = pool.alloc(8)
+    assert block.arena not in [cp.memory.arena for cp in pages[1::2]]
+    assert pool.stats()['mapped'] == 8192 + 4096
+    block.write(b'\xc3')
+    block.seal()
+    assert block.executable and pages[1].memory.executable
+    with raises(PermissionError):
+        block.write(b'\xc3')
+    block.free()
+    
+    # garbage collected pages release their memory; empty arenas are unmapped
+    del cp, pages
+    import gc; gc.collect()
+    assert pool.stats()['arenas'] == 0 and pool.stats()['mapped'] == 0
+    
+    # space freed in an arena that is still writable is reused
+    with pool.batch():
+        a = pool.alloc(8)
+        b = pool.alloc(8)
+        a.free()
+        assert pool.alloc(8).addr == a.addr
+    
+    # alignment and oversized blocks
+    block = pool.alloc(5000, align=64)
+    assert block.addr % 64 == 0 and pool.stats()['mapped'] == 4096 + 8192
+    with raises(ValueError):
+        block.write(b'x' * 5001)
+    block.free()
+    assert pool.stats()['arenas'] == 1
+    for align in [0, 24, 2 * mmap.PAGESIZE]:
+        with raises(ValueError):
+            pool.alloc(8, align=align)
+
+
+def test_pool_shared():
+    from pycca.asm.memory import CodePool
+    
+    # outside of a batch, pages share an arena until one of them is run
+    pool = CodePool(arena_size=4096)
+    pages = [CodePage([mov(eax, i), ret()], pool=pool) for i in range(10)]
+    for cp in pages:
+        cp.load()
+    stats = pool.stats()
+    assert stats['arenas'] == 1 and stats['blocks'] == 10
+    assert stats['protect_calls'] == 0 and stats['mapped'] == 4096
+    assert len(set(cp.page_addr for cp in pages)) == 10
+    assert not any(cp.memory.executable for cp in pages)
+    
+    pages[0].memory.seal()
+    assert all(cp.memory.executable for cp in pages)
+    assert pool.stats()['protect_calls'] == 1
+    cp = CodePage([ret()], pool=pool)
+    cp.load()
+    assert cp.memory.arena is not pages[0].memory.arena
+    
+    # a failed write does not leak its block
+    with raises(ValueError):
+        pool.store(4, lambda addr: b'x' * 5)
+    assert pool.stats()['blocks'] == 11
+
+
+def test_rebase():
+    from pycca.asm.codepage import CodePageBuilder
+    from pycca.asm.code import Code
+    
+    src = """
+        start:
+            mov eax, data
+            mov ecx, dword ptr [ebx + data]
+            jmp start
+            call start
+        data:
+            .long 1, data, start
+    """
+    cp = CodePage(src)
+    image = cp.code
+    kinds = sorted(r.kind for r in cp.relocations)
+    assert kinds == ['abs'] * 4 + ['rel'] * 2
+    assert len(cp._builder.based_relocations()) == 4
+    
+    # an expression relocation depends on the instruction address
+    expr = Code(b'\0' * 4)
+    expr.replace(0, 'data - instr_addr + 0x10000', 'i')
+    cp2 = CodePage(cp.asm + [expr])
+    
+    for base in [0x1000, 0x7fff0000, 0]:
+        for page in [cp, cp2]:
+            builder = CodePageBuilder()
+            builder.extend(page.asm)
+            assert page.rebase(base) == builder.link(base)
+            assert page.page_addr == base
+    assert cp.code == image
+    assert cp2.code[-4:] == struct.pack('i', 0x10000 + cp2.labels['data'] - len(image))
+    
+    cp.load()
+    with raises(ValueError):
+        cp.rebase(0)
+    cp.close()
+    assert cp.code == image
+
+
+def test_rebase_after_append():
+    from pycca.asm.codepage import CodePageBuilder
+    
+    builder = CodePageBuilder()
+    builder.extend([label('start'), mov(eax, 'start')])
+    builder.link(0x1000)
+    builder.rebase(0x2000)
+    
+    # appending to a linked image requires linking it again
+    builder.extend([label('end'), mov(ecx, 'end'), ret()])
+    with raises(RuntimeError):
+        builder.rebase(0x3000)
+    builder.link(0x1000)
+    fresh = CodePageBuilder()
+    fresh.extend([label('start'), mov(eax, 'start'), label('end'), mov(ecx, 'end'), ret()])
+    assert builder.rebase(0x3000) == fresh.link(0x3000)
+    
+    builder.append_image(b'\xc3', {}, [])
+    with raises(RuntimeError):
+        builder.rebase(0x1000)
+
+
+def test_rebase_external():
+    from pycca.asm.codepage import CodePageBuilder
+    
+    # a call to an external symbol depends on where the image is loaded
+    src = [call('ext'), ret()]
+    builder = CodePageBuilder()
+    builder.extend(src)
+    builder.link(0x1000, symbols={'ext': 0x5000})
+    assert len(builder.based_relocations()) == 1
+    for base in [0x2000, 0x800, 0x1000]:
+        fresh = CodePageBuilder()
+        fresh.extend(src)
+        assert builder.rebase(base) == fresh.link(base, symbols={'ext': 0x5000})
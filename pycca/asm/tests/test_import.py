@@ -0,0 +1,89 @@
+import os, sys, types, subprocess
+
+import pycca
+import pycca.asm
+
+
+def test_exports():
+    from pycca.asm import instructions, parser, register
+    
+    # every instruction class is exported, with no need to list it anywhere
+    classes = [name for name, obj in vars(instructions).items()
+               if isinstance(obj, type) and issubclass(obj, instructions.Instruction)]
+    assert len(classes) > 90
+    for name in classes:
+        assert getattr(pycca.asm, name) is getattr(instructions, name)
+        assert name in pycca.asm.__all__
+    # and so are the alternative spellings that are python names
+    assert pycca.asm.setnz is instructions.setne
+    assert set(parser.mnemonic_aliases) <= set(pycca.asm.__all__)
+    
+    ns = {}
+    exec('from pycca.asm import *', ns)
+    assert set(pycca.asm.__all__) <= set(ns)
+    assert ns['eax'] is register.eax and ns['Register'] is register.Register
+    assert isinstance(ns['label'], types.FunctionType)
+    assert ns['CodePage'] is pycca.asm.codepage.CodePage
+    assert ns['as_code'] is pycca.asm.util.as_code
+    assert 'CodePage' in dir(pycca.asm)
+    # modules imported by the submodules are not part of the package, nor
+    # are util's internals
+    for name in ['os', 're', 'sys', 'struct', 'collections', 'OrderedDict', 'sqlite3', 'long',
+                 'user_cache_dir', 'AsCodeCache', 'as_code_cache']:
+        assert name not in ns
+        assert name not in pycca.asm.__all__
+    assert ns['write_as_code_cache'] is pycca.asm.util.write_as_code_cache
+
+
+def import_time(statement):
+    """Run *statement* in a new interpreter with ``-X importtime``. Returns
+    a dict mapping each imported module to its cumulative import time in
+    microseconds, and the total time.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(pycca.__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([root] + [p for p in [env.get('PYTHONPATH')] if p])
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                          env=env, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    total = 0
+    for line in proc.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            if not cumulative.strip().isdigit():
+                continue
+            times[name.strip()] = int(cumulative)
+            # nested imports are indented by two spaces per level
+            if len(name) - len(name.lstrip()) == 1:
+                total += int(cumulative)
+    return times, total
+
+
+def test_import_time():
+    lazy, lazy_total = import_time('import pycca.asm')
+    assert 'pycca.asm' in lazy
+    for name in ['pycca.asm.instructions', 'pycca.asm.codepage', 'pycca.cc', 'numpy']:
+        assert name not in lazy
+
+    eager, eager_total = import_time('import pycca.asm.instructions')
+    print('import pycca.asm: %.1f ms, with instructions: %.1f ms'
+          % (lazy_total / 1e3, eager_total / 1e3))
+    assert lazy['pycca'] < eager['pycca.asm.instructions']
+
+    # unknown names do not import other submodules
+    probe, _ = import_time('import pycca.asm, sys\n'
+                           'assert not hasattr(pycca.asm, "tests")\n'
+                           'assert not hasattr(pycca.asm, "movv")\n'
+                           'assert "pycca.asm.tests" not in sys.modules')
+    for name in ['pycca.asm.codepage', 'pycca.asm.memory', 'pycca.asm.cache']:
+        assert name not in probe
+
+    # names are imported on first use
+    used, _ = import_time('from pycca.asm import mov, CodePage')
+    assert 'pycca.asm.instructions' in used and 'pycca.asm.codepage' in used
+
+
+def test_import_submodules():
+    # with nothing imported eagerly, each submodule must import on its own
+    for name in sorted(pycca.asm._submodules):
+        import_time('import pycca.asm.%s' % name)
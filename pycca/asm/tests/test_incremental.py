@@ -0,0 +1,62 @@
+from pytest import raises
+from pycca.asm import *
+from pycca.asm.incremental import IncrementalAssembler
+
+
+def source(n, edit=None):
+    lines = []
+    for i in range(n):
+        lines.append('f%d:' % i)
+        if i == edit:
+            lines.append('    mov eax, 0x12345678')
+            lines.append('    add eax, 1')
+        else:
+            lines.append('    mov eax, %d' % i)
+        lines.append('    call f%d' % ((i + 7) % n))
+        lines.append('    mov ecx, f%d' % ((i + 3) % n))
+        lines.append('    jmp f%d' % ((i + 1) % n))
+    return '\n'.join(lines)
+
+
+def check(page, src):
+    ref = CodePage(src, relax=False)
+    assert page.code == ref.code
+    assert page.labels == ref.labels
+    assert page.rebase(0x1000) == ref.rebase(0x1000)
+
+
+def test_incremental():
+    asm = IncrementalAssembler()
+    check(asm.assemble(source(50)), source(50))
+    assert asm.reencoded == 200
+    
+    # only the edited region is encoded again; later regions are shifted
+    check(asm.assemble(source(50, edit=20)), source(50, edit=20))
+    assert asm.reencoded == 5
+    assert 0 < asm.repatched < 150
+    
+    # unchanged source: nothing to do
+    check(asm.assemble(source(50, edit=20)), source(50, edit=20))
+    assert asm.reencoded == 0
+    assert asm.repatched == 0
+    
+    check(asm.assemble(source(50)), source(50))
+    assert asm.reencoded == 4
+    
+    with raises(NameError):
+        asm.assemble(source(50) + '\n    jmp missing')
+    check(asm.assemble(source(50)), source(50))
+    assert asm.reencoded == 200
+
+
+def test_deleted_label():
+    asm = IncrementalAssembler()
+    src = 'f0:\n    call f1\n    ret\nf1:\n    ret'
+    check(asm.assemble(src), src)
+    
+    # f0 is reused, but refers to a label that no longer exists; the error
+    # gives the line it is on now
+    with raises(NameError) as err:
+        asm.assemble('\nf0:\n    call f1\n    ret')
+    assert 'line 3' in str(err.value)
+    check(asm.assemble(src), src)
@@ -0,0 +1,88 @@
+from pycca.asm import *
+from pycca.asm import instrument
+from pycca.asm.instrument import Instrumentation
+from pycca.asm.parser import parse_asm
+
+
+src = """
+start:
+    mov eax, data
+    add eax, 0xffffffff     # only a "backup" mode fits this immediate
+    push ebx
+    push ebx
+    jz start
+    call start
+data:
+    .long 1
+"""
+
+
+def test_instrument(tmp_path):
+    phases = []
+    inst = Instrumentation(callback=lambda name, seconds: phases.append(name))
+    page = CodePage(src, instrument=inst, cache=str(tmp_path))
+    assert instrument.active.get() is None
+    
+    stats = inst.stats()
+    assert phases == ['cache', 'split', 'parse', 'relax', 'layout', 'resolve']
+    for name in phases + ['encode', 'mode_selection', 'modrm']:
+        assert stats['times'][name] >= 0
+    assert stats['instructions'] == 6
+    assert stats['mnemonics'] == {'mov': 1, 'add': 1, 'push': 2, 'jz': 1, 'call': 1}
+    assert stats['modes']['add r/m32, imm32'] == 1
+    assert stats['backups'] == {'add': 1}
+    counters = stats['counters']
+    assert counters['relocations.abs'] == 1
+    assert counters['relocations.rel'] == 2
+    assert counters['assembly_cache.misses'] == 1
+    assert counters['encoding_cache.hits'] >= 1    # second push
+    assert 0 < stats['encoding_cache_hit_rate'] < 1
+    
+    # a second page is loaded from the assembly cache
+    inst.reset()
+    CodePage(src, instrument=inst, cache=str(tmp_path))
+    assert inst.stats()['assembly_cache_hit_rate'] == 1.0
+    assert inst.stats()['instructions'] == 0
+    
+    inst.reset()
+    code = parse_asm(src, instrument=inst)
+    assert inst.stats()['mnemonics']['push'] == 2
+    CodePage(code, instrument=inst)
+    assert inst.stats()['mnemonics']['push'] == 4
+    
+    # nothing is collected unless an instrumentation is active
+    inst.reset()
+    CodePage(src)
+    assert inst.stats()['counters'] == {}
+
+
+def test_instrument_cached():
+    # modes are reported the same whether or not the code comes from the
+    # encoding cache
+    src = 'add eax, 0xffffffff\npush ebx'
+    results = []
+    for i in range(2):
+        inst = Instrumentation()
+        parse_asm(src, instrument=inst)
+        stats = inst.stats()
+        results.append((stats['modes'], stats['backups']))
+    assert results[1] == results[0]
+    assert results[0][1] == {'add': 1}
+    assert inst.counters['encoding_cache.hits'] == 2
+
+
+def test_instrument_threads():
+    import threading
+    inst = Instrumentation()
+    
+    def work():
+        # not instrumented, although inst is active in the main thread
+        assert instrument.active.get() is None
+        push(ebx).code
+    
+    with inst.activate():
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+        assert instrument.active.get() is inst
+    assert inst.stats()['counters'] == {}
@@ -0,0 +1,129 @@
+import struct
+from pytest import raises
+from pycca.asm import *
+from pycca.asm.linker import Linker
+
+
+runtime = """
+helper:
+    mov eax, counter
+    jmp done
+counter:
+    .long 0
+done:
+    ret
+"""
+
+main = """
+start:
+    call helper
+    mov ecx, 3
+done:
+    jmp start
+"""
+
+
+def test_linker(tmp_path):
+    linker = Linker(align=16)
+    linker.add('runtime', runtime, exports=['helper'])
+    linker.add('main', main, exports=['start'])
+    assert linker.modules['main'].imports == {'helper'}
+    assert linker.assembled == 2
+    
+    page = linker.link()
+    assert page.labels == {'helper': 0, 'runtime.counter': 10, 
+                           'runtime.done': 14, 'start': 16, 'main.done': 26}
+    # mov eax, counter; jmp done (local to runtime)
+    assert page.code[:10] == (b'\xb8' + struct.pack('<i', 10) + 
+                              b'\xe9' + struct.pack('<i', 14 - 10))
+    assert page.code[15] == 0x90
+    # call helper; jmp start
+    assert page.code[16:21] == b'\xe8' + struct.pack('<i', 0 - 21)
+    assert page.code[26:31] == b'\xe9' + struct.pack('<i', 16 - 31)
+    based = page.rebase(0x1000)
+    assert based[1:5] == struct.pack('<i', 0x100a)
+    
+    # changing one module only reassembles that module
+    linker.add('main', main + '    push ebx\n', exports=['start'])
+    linker.add('runtime', runtime, exports=['helper'])
+    assert linker.assembled == 3 and linker.reused == 1
+    assert len(linker.link()) == 32
+    
+    # encodings may also be kept on disk
+    cache = str(tmp_path / 'cache')
+    Linker(cache=cache).add('runtime', runtime)
+    linker2 = Linker(cache=cache)
+    linker2.add('runtime', runtime)
+    assert linker2.assembled == 0 and linker2.reused == 1
+    
+    with raises(NameError) as err:
+        linker.add('other', 'push ebx\ncall missing\n')
+        linker.link()
+    assert 'line 2' in str(err.value)
+    
+    # modules taken from the cache still report the line
+    Linker(cache=cache).add('other', 'push ebx\n\ncall missing\n')
+    linker2.add('other', 'push ebx\n\ncall missing\n')
+    assert linker2.reused == 2
+    with raises(NameError) as err:
+        linker2.link()
+    assert 'line 3' in str(err.value)
+    linker.remove('other')
+    with raises(NameError):
+        linker.add('other', 'start:\n    ret\n')
+        linker.link()
+    with raises(NameError):
+        linker.add('other', 'ret\n', exports=['nothing'])
+
+
+def test_linker_gc():
+    library = """
+    used:
+        mov eax, table
+        call shared
+        jz used_exit        # conditional: falls through to used_next
+    used_next:
+        add eax, 1
+    used_exit:
+        ret
+    unused:
+        call shared
+        jmp unused
+    shared:
+        ret
+    unused_data:
+        .long 3
+    table:
+        .long 1, 2
+    """
+    main = """
+    start:
+        call used
+        ret
+    """
+    linker = Linker()
+    linker.add('main', main)
+    linker.add('lib', library, exports=['used', 'unused', 'shared'])
+    full = linker.link()
+    assert linker.removed == [] and linker.bytes_saved == 0
+    
+    page = linker.link(entries=['start'])
+    assert sorted(linker.removed) == ['lib.unused_data', 'unused']
+    assert linker.bytes_saved == 14
+    assert len(full) - len(page) == 14
+    assert sorted(page.labels) == ['lib.table', 'lib.used_exit', 'lib.used_next', 
+                                   'shared', 'start', 'used']
+    # shared and table moved back by the size of unused; references to them
+    # still land there
+    used = page.labels['used']
+    assert struct.unpack('<i', page.code[used+1:used+5])[0] == page.labels['lib.table']
+    call = used + 5
+    assert page.code[call] == 0xe8
+    disp = struct.unpack('<i', page.code[call+1:call+5])[0]
+    assert call + 5 + disp == page.labels['shared']
+    
+    # nothing is reachable from a module's data alone
+    linker.link(entries=['lib.table'])
+    assert 'start' in linker.removed and 'used' in linker.removed
+    with raises(NameError):
+        linker.link(entries=['nowhere'])
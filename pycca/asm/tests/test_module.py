@@ -0,0 +1,52 @@
+from pytest import raises
+from pycca.asm import *
+from pycca.asm.code import Code
+from pycca.asm.module import load_module, dump_module, ModuleFormatError
+
+
+def test_module(tmp_path):
+    expr = Code(b'\0' * 4)
+    expr.replace(0, 'data - instr_addr', 'i')
+    cp = CodePage([
+        label('start'),
+        mov(eax, 'data'),
+        jmp('start'),
+        expr,
+        label('data'),
+        b'\x01\x02',
+    ])
+    path = str(tmp_path / 'test.pycca')
+    cp.save(path, lines=[(0, 2), (5, 3)])
+    
+    with load_module(path) as mod:
+        assert isinstance(mod.code, memoryview) and mod.code.readonly
+        assert bytes(mod.code) == cp.code
+        assert mod.labels == cp.labels
+        assert mod.arch == ARCH
+        assert [(r.offset, r.packing, r.kind, r.symbol, r.addend, r.instr, r.end) 
+                for r in mod.relocations] == \
+               [(r.offset, r.packing, r.kind, r.symbol, r.addend, r.instr, r.end) 
+                for r in cp.relocations]
+        assert mod.lines == [(0, 2), (5, 3)]
+        assert 'jmp start' in mod.listing
+        
+        cp2 = CodePage.from_module(mod)
+    assert cp2.code == cp.code and cp2.asm is None
+    assert cp2.rebase(0x400000) == cp.rebase(0x400000)
+    
+    cp3 = CodePage.from_module(path)
+    assert cp3.labels == cp.labels
+    
+    
+def test_module_errors(tmp_path):
+    path = str(tmp_path / 'bad.pycca')
+    for data in [b'', b'PYCA', b'NOPE' + b'\0' * 100, 
+                 dump_module(b'\x90' * 100, {}, [])[:-50]]:
+        open(path, 'wb').write(data)
+        with raises((ModuleFormatError, ValueError)):
+            load_module(path)
+    data = bytearray(dump_module(b'\x90', {}, []))
+    data[4] = 99
+    open(path, 'wb').write(data)
+    with raises(ModuleFormatError):
+        load_module(path)
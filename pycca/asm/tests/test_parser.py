@@ -2,6 +2,7 @@ from pytest import raises
 from pycca.asm.parser import parse_asm
 from pycca.asm import *
 from pycca.asm.instruction import Label
+from pycca.asm.label import Long
 
 
 def check_typs(code, typs):
@@ -87,4 +88,87 @@ def test_parse_errors():
         with raises(TypeError):
             parse_asm(asm)
     
-    
\ No newline at end of file
+    
+
+def test_iter_parse_asm():
+    import io
+    from pycca.asm.parser import iter_parse_asm
+    
+    src = """
+        start:
+            mov eax, data   # forward reference
+            jmp start
+        data:
+            .long 1, data
+    """
+    items = iter_parse_asm(io.StringIO(src))
+    assert not isinstance(items, list)
+    typs = [Label, mov, jmp, Label, Long]
+    code = list(items)
+    check_typs(code, typs)
+    
+    # streaming and whole-source parsing must give identical machine code
+    page = CodePage.from_lines(io.StringIO(src))
+    assert page.code == CodePage(src, relax=False).code
+    assert page.labels == {'start': 0, 'data': 10}
+    assert len(page) == 18
+    
+    # duplicate labels are still detected; undefined labels are only 
+    # reported when the code is linked
+    with raises(NameError):
+        list(iter_parse_asm('label1:\nlabel1:\n'))
+    with raises(NameError):
+        CodePage.from_lines('mov eax, nowhere\n')
+
+
+def test_parse_operand():
+    from pycca.asm.parser import parse_operand
+    
+    assert parse_operand('eax') is eax
+    assert parse_operand('st(3)') is st(3)
+    assert parse_operand('0x10') == 16
+    assert parse_operand('-(2 + 3)*4') == -20
+    assert parse_operand('[ecx+ebx*2 + 1]') == Pointer([ecx + ebx*2 + 1])
+    ptr = parse_operand('dword ptr [ebp - 0x8]')
+    assert ptr == Pointer([ebp - 8]) and ptr.bits == 32
+    assert parse_operand('offset .L1', {'_L1': '_L1'}) == '_L1'
+    
+    for op in ['', '[eax', 'eax]', 'eax eax', '1 + ', 'eax;', '__import__("os")']:
+        with raises((SyntaxError, NameError)):
+            parse_operand(op)
+    with raises(NameError):
+        parse_operand('rsx')
+
+
+def test_mnemonics():
+    from pycca.asm.parser import mnemonics
+    
+    assert mnemonics['or'] is or_ and mnemonics['or_'] is or_
+    assert mnemonics['and'] is and_
+    assert mnemonics['jz'] is jz and mnemonics['je'] is je
+    assert mnemonics['retn'] is ret
+    # only instruction classes are accepted
+    assert 'collections' not in mnemonics and 'Instruction' not in mnemonics
+    check_typs(parse_asm('or eax, ebx\nretn\ncltd'), [or_, ret, cdq])
+
+
+def test_directive_args():
+    import struct
+    from pycca.asm.parser import iter_parse_asm
+    
+    # every argument is kept (previously only the last two were)
+    src = """
+        data:
+            .long 1, 2, 3, data
+            .long 7
+            .ascii "a, b", 10, "c"
+            .asciz "x"
+    """
+    cp = CodePage(src)
+    assert cp.code == struct.pack('4i', 1, 2, 3, 0) + struct.pack('i', 7) + b'a, b\nc' + b'x\0'
+    streamed = list(iter_parse_asm(src.split("\n")))
+    assert [len(item) for item in streamed[1:]] == [16, 4, 6, 2]
+    
+    for src in ['.long 1,, 2', '.long 1, 2,', '.long ,1']:
+        with raises(SyntaxError):
+            parse_asm(src)
@@ -1,12 +1,16 @@
 # -'- coding: utf-8 -'-
 
-import os, re, sys, pickle, tempfile, subprocess, atexit
+import os, re, sys, pickle, shutil, sqlite3, tempfile, threading, warnings, subprocess
 
 try:
     from __builtin__ import long
 except ImportError:
     long = int
 
+__all__ = ['phex', 'pbin', 'phexbin', 'compare', 'run_as', 'as_code', 
+           'as_code_batch', 'as_code_cached', 'write_as_code_cache',
+           'all_registers', 'invalid_regs', 'check_valid_pointer']
+
 
 def phex(code):
     """Print hexadecimal representation of machine code.
@@ -141,8 +145,8 @@ def as_code(asm, quiet=False, check_invalid_reg=False, cache=False):
     architecture (by default, GNU-as silently ignores such symbols).
     
     If *cache* is True, then the result will be cached in 
-    ``pycca/asm/gnu_as_cache.pk`` to speed up subsequent requests for the same
-    instruction.
+    :data:`as_code_cache` (see :class:`AsCodeCache`) to speed up subsequent
+    requests for the same instruction.
     """
     # First try returning cached output
     if cache:
@@ -164,35 +168,353 @@ def as_code(asm, quiet=False, check_invalid_reg=False, cache=False):
     return code
 
 
-_as_code_cache = None
+# Symbols inserted before each instruction by as_code_batch()
+_marker = '__pycca_%d'
+_marker_re = re.compile(r'^([0-9a-f]+)\s.*\s__pycca_(\d+)$')
+_error_re = re.compile(r'^.*?:(\d+): Error:\s*(.*)$')
+_bytes_re = re.compile(r'\s*[a-f0-9]+:\s+(([a-f0-9][a-f0-9]\s)+)')
+
+
+def as_code_batch(asms, quiet=True, check_invalid_reg=False, cache=False,
+                  batch_size=10000):
+    """Use GNU assembler to compile many instructions at once.
+    
+    *asms* is a sequence of assembly strings, as would be passed to 
+    :func:`as_code`. All of them are written to a single file, each preceded
+    by a marker label, and assembled with one run of ``as`` and ``objdump``
+    per *batch_size* instructions; the output is then split at the marker
+    addresses.
+    
+    Returns a list with one item per instruction: its machine code as a 
+    bytearray, or the exception that :func:`as_code` would have raised for it.
+    Instructions that GNU-as rejects are removed and the rest of the batch is
+    assembled again. If *cache* is True, results are looked up in and added
+    to the same cache as :func:`as_code`.
+    """
+    asms = list(asms)
+    results = [None] * len(asms)
+    todo = []
+    for i, asm in enumerate(asms):
+        if cache:
+            entry = as_code_cache.get((asm, check_invalid_reg))
+            if entry is not None:
+                ok, output = entry
+                if ok:
+                    results[i] = output
+                else:
+                    results[i] = Exception(output[0])
+                    results[i].output = output[1]
+                continue
+        if check_invalid_reg:
+            bad = [reg for reg in invalid_regs() if reg.name in asm]
+            if bad:
+                results[i] = Exception("asm '%s' contains invalid register '%s'" 
+                                       % (asm, bad[0].name))
+                continue
+        todo.append(i)
+    
+    for start in range(0, len(todo), batch_size):
+        batch = todo[start:start+batch_size]
+        while batch:
+            codes, errors = _run_as_batch([asms[i] for i in batch], quiet)
+            if codes is not None:
+                for i, code in zip(batch, codes):
+                    results[i] = code
+                break
+            for j, (msg, output) in errors.items():
+                err = Exception(msg)
+                err.asm = asms[batch[j]]
+                err.output = output
+                results[batch[j]] = err
+            batch = [i for j, i in enumerate(batch) if j not in errors]
+    
+    if cache:
+        entries = []
+        for i in todo:
+            result = results[i]
+            if isinstance(result, Exception):
+                entry = (False, (str(result), getattr(result, 'output', '')))
+            else:
+                entry = (True, result)
+            entries.append(((asms[i], check_invalid_reg), entry))
+        as_code_cache.update(entries)
+    return results
+
+
+def _run_as_batch(asms, quiet):
+    # Assemble *asms* in one file. Returns (list of codes, None) on success or
+    # (None, {index: (message, output)}) for the instructions that failed.
+    lines = [".intel_syntax noprefix"]
+    owner = [None]
+    for i, asm in enumerate(asms):
+        lines.append(_marker % i + ':')
+        owner.append(i)
+        for line in asm.split('\n'):
+            lines.append(line)
+            owner.append(i)
+    lines.append(_marker % len(asms) + ':')
+    
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir, 'batch.s')
+        with open(fname, 'w') as fh:
+            fh.write('\n'.join(lines) + '\n')
+        proc = subprocess.run(['as', fname, '-o', fname + '.o'], 
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        out = proc.stdout.decode('ascii', 'replace')
+        if proc.returncode != 0:
+            errors = {}
+            for line in out.split('\n'):
+                m = _error_re.match(line)
+                if m is None:
+                    continue
+                lineno, msg = int(m.group(1)), m.group(2)
+                if 0 < lineno <= len(owner) and owner[lineno-1] is not None:
+                    err = errors.setdefault(owner[lineno-1], (msg, []))
+                    err[1].append(line)
+            errors = {i: (msg, '\n'.join(output)) for i, (msg, output) in errors.items()}
+            if not errors:
+                if not quiet:
+                    print(out)
+                raise Exception("Error running 'as' on a batch of %d "
+                                "instructions." % len(asms))
+            return None, errors
+        
+        dump = subprocess.check_output(['objdump', '-d', '-z', '-t', fname + '.o'])
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    
+    addrs = [None] * (len(asms) + 1)
+    image = bytearray()
+    for line in dump.decode('ascii', 'replace').split('\n'):
+        m = _marker_re.match(line)
+        if m is not None:
+            addrs[int(m.group(2))] = int(m.group(1), 16)
+            continue
+        m = _bytes_re.match(line)
+        if m is not None:
+            image += bytearray.fromhex(m.group(1))
+    if None in addrs:
+        raise Exception("Can't find all instruction markers in objdump output.")
+    return [image[addrs[i]:addrs[i+1]] for i in range(len(asms))], None
+
+
+def user_cache_dir():
+    """Return the directory in which pycca keeps per-user caches.
+    
+    This is ``$PYCCA_CACHE_DIR`` if set, and otherwise ``pycca`` inside the
+    platform's user cache directory (``$XDG_CACHE_HOME`` or ``~/.cache`` on
+    Unix, ``%LOCALAPPDATA%`` on Windows).
+    """
+    path = os.environ.get('PYCCA_CACHE_DIR')
+    if path:
+        return path
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'pycca')
+
+
+# Pickle in which earlier versions of pycca cached as_code() results. Its
+# entries are moved to the sqlite3 cache the first time one is opened.
+_legacy_cache_path = os.path.join(os.path.dirname(__file__), 'gnu_as_cache.pk')
+
+
+class AsCodeCache(object):
+    """Persistent store of :func:`as_code` results, kept in an sqlite3
+    database at *path* (by default ``gnu_as.sqlite`` in :func:`user_cache_dir`).
+    
+    Opening the cache does not read any entries; each lookup is a single 
+    query and each new result is committed as soon as it is stored. Each 
+    thread uses a connection of its own. The database uses write-ahead 
+    logging, so any number of processes (such as parallel test workers) may
+    read and write it at the same time. If the database cannot be created,
+    results are only kept in memory.
+    
+    Results left in ``pycca/asm/gnu_as_cache.pk`` by earlier versions of
+    pycca are imported into the database once (which is recorded in the
+    database), and the pickle is deleted if possible.
+    
+    Keys are ``(asm, check_invalid_reg)``; values are ``(True, code)`` or
+    ``(False, (message, output))``.
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(user_cache_dir(), 'gnu_as.sqlite')
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._dbs = []
+        self._pid = None
+        self._memory = False
+        
+    def _connect(self):
+        # sqlite connections must not be shared between threads or with
+        # forked children
+        db = getattr(self._local, 'db', None)
+        if db is not None and self._pid == os.getpid():
+            return db
+        with self._lock:
+            first = self._pid != os.getpid()
+            if first:
+                self._dbs = []
+                self._pid = os.getpid()
+                self._memory = False
+            db = None
+            if not self._memory:
+                try:
+                    os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                    db = sqlite3.connect(self.path, timeout=60, isolation_level=None,
+                                         check_same_thread=False)
+                    db.execute('PRAGMA journal_mode=WAL')
+                    db.execute('PRAGMA synchronous=NORMAL')
+                except (OSError, sqlite3.Error) as err:
+                    warnings.warn("Cannot open GNU-as cache %s (%s); results will "
+                                  "not be saved." % (self.path, err))
+                    self._memory = True
+            if self._memory:
+                # one in-memory database, shared by the threads of this process
+                db = sqlite3.connect('file:pycca_as_%x?mode=memory&cache=shared' % id(self),
+                                     uri=True, isolation_level=None, 
+                                     check_same_thread=False)
+                db.execute('PRAGMA read_uncommitted=1')
+            db.execute('CREATE TABLE IF NOT EXISTS as_code ('
+                       'asm TEXT NOT NULL, check_reg INTEGER NOT NULL, '
+                       'ok INTEGER NOT NULL, code BLOB, message TEXT, output TEXT, '
+                       'PRIMARY KEY (asm, check_reg))')
+            db.execute('CREATE TABLE IF NOT EXISTS meta ('
+                       'key TEXT PRIMARY KEY, value TEXT)')
+            self._dbs.append(db)
+            self._local.db = db
+            if first and os.path.exists(_legacy_cache_path):
+                self._import_legacy(db)
+        return db
+        
+    def _import_legacy(self, db):
+        try:
+            st = os.stat(_legacy_cache_path)
+        except OSError:
+            return
+        stamp = '%d %d' % (st.st_mtime, st.st_size)
+        row = db.execute("SELECT value FROM meta WHERE key = 'legacy_import'").fetchone()
+        if row is None or row[0] != stamp:
+            try:
+                with open(_legacy_cache_path, 'rb') as fh:
+                    entries = pickle.load(fh)
+            except Exception as err:
+                warnings.warn("Cannot read old GNU-as cache %s (%s)." % (_legacy_cache_path, err))
+                return
+            entries.pop('__counter__', None)
+            # results computed since then take precedence
+            if not self._store(db, entries.items(), replace=False,
+                               meta=[('legacy_import', stamp)]):
+                return
+        try:
+            os.remove(_legacy_cache_path)
+        except OSError as err:
+            if row is None or row[0] != stamp:
+                warnings.warn("Cannot remove old GNU-as cache %s (%s); it will "
+                              "not be read again." % (_legacy_cache_path, err))
+        
+    def get(self, key, default=None):
+        asm, check_reg = key
+        row = self._connect().execute(
+            'SELECT ok, code, message, output FROM as_code '
+            'WHERE asm = ? AND check_reg = ?', (asm, bool(check_reg))).fetchone()
+        if row is None:
+            return default
+        ok, code, message, output = row
+        if ok:
+            return (True, bytearray(code))
+        return (False, (message, output))
+    
+    def __contains__(self, key):
+        return self.get(key) is not None
+    
+    def __getitem__(self, key):
+        entry = self.get(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry
+        
+    def __setitem__(self, key, entry):
+        self.update([(key, entry)])
+        
+    def update(self, items, replace=True):
+        """Store many ``(key, entry)`` pairs in one transaction. Entries
+        already in the cache are kept if *replace* is False.
+        """
+        self._store(self._connect(), items, replace)
+        
+    def _store(self, db, items, replace, meta=()):
+        rows = []
+        for (asm, check_reg), (ok, output) in items:
+            if ok:
+                rows.append((asm, bool(check_reg), True, bytes(output), None, None))
+            else:
+                rows.append((asm, bool(check_reg), False, None, output[0], output[1]))
+        # one transaction at a time per cache; connections to an in-memory
+        # database do not wait for each other's locks
+        with self._lock:
+            try:
+                db.execute('BEGIN IMMEDIATE')
+                db.executemany('INSERT OR %s INTO as_code VALUES (?, ?, ?, ?, ?, ?)'
+                               % ('REPLACE' if replace else 'IGNORE'), rows)
+                db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', meta)
+                db.execute('COMMIT')
+            except sqlite3.Error as err:
+                if db.in_transaction:
+                    db.execute('ROLLBACK')
+                warnings.warn("Cannot write to GNU-as cache %s (%s)." % (self.path, err))
+                return False
+        return True
+            
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM as_code').fetchone()[0]
+    
+    def clear(self):
+        db = self._connect()
+        with self._lock:
+            db.execute('DELETE FROM as_code')
+        
+    def close(self):
+        """Close the connections of all threads. The cache is reopened when
+        it is next used.
+        """
+        with self._lock:
+            for db in self._dbs:
+                db.close()
+            self._dbs = []
+            self._pid = None
+            self._local = threading.local()
+
+
+# Cache used by as_code(..., cache=True); replace it to use another database.
+as_code_cache = AsCodeCache()
+
+
+def write_as_code_cache():
+    """Deprecated; does nothing. Results are written to :data:`as_code_cache`
+    as soon as they are stored.
+    """
+    warnings.warn("write_as_code_cache() is no longer needed; GNU-as results "
+                  "are saved as soon as they are cached.", DeprecationWarning,
+                  stacklevel=2)
+
+
 def as_code_cached(asm, quiet, check_invalid_reg):
     # return cached output of as_code(). This returns the compiled machine
     # code or raises an exception with a cached error message.
-    global _as_code_cache
-    path = os.path.dirname(__file__)
-    cachefile = os.path.join(path, 'gnu_as_cache.pk')
     key = (asm, check_invalid_reg)
-    if _as_code_cache is None:
-        if os.path.exists(cachefile):
-            if sys.version_info.major == 2:
-                _as_code_cache = pickle.load(open(cachefile, 'rb'))
-            else:
-                _as_code_cache = pickle.load(open(cachefile, 'rb'), fix_imports=True)
-        else:
-            _as_code_cache = {'__counter__': 0}
-        atexit.register(write_as_code_cache)
-    if key not in _as_code_cache:
+    entry = as_code_cache.get(key)
+    if entry is None:
         try:
-            _as_code_cache[key] = (True, as_code(asm, quiet, check_invalid_reg, cache=False))
+            entry = (True, as_code(asm, quiet, check_invalid_reg, cache=False))
         except Exception as err:
-            _as_code_cache[key] = (False, (err.message, err.output))
-            raise
-        finally:
-            cnt = (_as_code_cache['__counter__'] + 1) % 100
-            _as_code_cache['__counter__'] = cnt
-            if cnt == 0:
-                write_as_code_cache()
-    ok, output = _as_code_cache[key]
+            entry = (False, (str(err), getattr(err, 'output', '')))
+        as_code_cache[key] = entry
+    ok, output = entry
     if ok:
         return output
     else:
@@ -201,22 +523,6 @@ def as_code_cached(asm, quiet, check_invalid_reg):
         raise err
 
 
-def write_as_code_cache():
-    # write the cache of as_code() results to disk. 
-    global _as_code_cache
-    path = os.path.dirname(__file__)
-    cachefile = os.path.join(path, 'gnu_as_cache.pk')
-    if sys.version_info.major == 2:
-        pk = pickle.dumps(_as_code_cache, protocol=0)
-    else:
-        pk = pickle.dumps(_as_code_cache, protocol=0, fix_imports=True)
-    try:
-        open(cachefile, 'wb').write(pk)
-    except IOError:
-        # probably no write permission; skip caching.
-        pass
-
-
 def all_registers():
     """Return all registers defined in asm.register
     (excluding st(i) registers)